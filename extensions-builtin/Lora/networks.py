@@ -17,7 +17,7 @@ import network_oft
 import torch
 from typing import Union
 
-from modules import shared, devices, sd_models, errors, scripts, sd_hijack
+from modules import shared, devices, sd_models, errors, scripts, sd_hijack, hashes
 import modules.textual_inversion.textual_inversion as textual_inversion
 
 from lora_logger import logger
@@ -593,6 +593,9 @@ def list_available_networks():
         available_network_aliases[name] = entry
         available_network_aliases[entry.alias] = entry
 
+    if shared.opts.hash_models_in_background and not shared.cmd_opts.no_hashing:
+        hashes.calculate_in_background(network.NetworkOnDisk.read_hash, [x for x in available_networks.values() if not x.hash])
+
 
 re_network_name = re.compile(r"(.*)\s*\([0-9a-fA-F]+\)")
 
@@ -1,5 +1,5 @@
+import asyncio
 import base64
-import io
 import os
 import time
 import datetime
@@ -12,24 +12,22 @@ from io import BytesIO
 from fastapi import APIRouter, Depends, FastAPI, Request, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.exceptions import HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from secrets import compare_digest
 
 import modules.shared as shared
-from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart, shared_items, script_callbacks, infotext_utils, sd_models
-from modules.api import models
+from modules import sd_samplers, deepbooru, sd_hijack, images, scripts, ui, postprocessing, errors, restart, shared_items, script_callbacks, infotext_utils, sd_models, batch_scheduler, cond_cache, sd_schedules, sd_models_prefetch, hashes, queue_scheduler, worker_pool
+from modules.api import models, async_tasks, coalescing, transport
 from modules.shared import opts
 from modules.processing import StableDiffusionProcessingTxt2Img, StableDiffusionProcessingImg2Img, process_images
 from modules.textual_inversion.textual_inversion import create_embedding, train_embedding
 from modules.hypernetworks.hypernetwork import create_hypernetwork, train_hypernetwork
-from PIL import PngImagePlugin, Image
+from PIL import Image
 from modules.sd_models_config import find_checkpoint_config_near_filename
 from modules.realesrgan_model import get_realesrgan_models
 from modules import devices
 from typing import Any
-import piexif
-import piexif.helper
 from contextlib import closing
 from modules.progress import create_task_id, add_task_to_queue, start_task, finish_task, current_task
 
@@ -100,36 +98,45 @@ def decode_base64_to_image(encoding):
 
 
 def encode_pil_to_base64(image):
-    with io.BytesIO() as output_bytes:
-        if isinstance(image, str):
-            return image
-        if opts.samples_format.lower() == 'png':
-            use_metadata = False
-            metadata = PngImagePlugin.PngInfo()
-            for key, value in image.info.items():
-                if isinstance(key, str) and isinstance(value, str):
-                    metadata.add_text(key, value)
-                    use_metadata = True
-            image.save(output_bytes, format="PNG", pnginfo=(metadata if use_metadata else None), quality=opts.jpeg_quality)
-
-        elif opts.samples_format.lower() in ("jpg", "jpeg", "webp"):
-            if image.mode == "RGBA":
-                image = image.convert("RGB")
-            parameters = image.info.get('parameters', None)
-            exif_bytes = piexif.dump({
-                "Exif": { piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(parameters or "", encoding="unicode") }
-            })
-            if opts.samples_format.lower() in ("jpg", "jpeg"):
-                image.save(output_bytes, format="JPEG", exif = exif_bytes, quality=opts.jpeg_quality)
-            else:
-                image.save(output_bytes, format="WEBP", exif = exif_bytes, quality=opts.jpeg_quality)
+    if isinstance(image, str):
+        return image
+
+    return base64.b64encode(transport.encode_image(image, opts.samples_format))
+
 
-        else:
-            raise HTTPException(status_code=500, detail="Invalid image format")
+def get_api_credentials():
+    """returns a dict of username -> password for API authentication set with --api-auth"""
 
-        bytes_data = output_bytes.getvalue()
+    credentials = {}
+    if shared.cmd_opts.api_auth:
+        for auth in shared.cmd_opts.api_auth.split(","):
+            user, password = auth.split(":")
+            credentials[user] = password
 
-    return base64.b64encode(bytes_data)
+    return credentials
+
+
+def get_request_user(req: Request):
+    """
+    returns name of the user who sent the request, for fair share in queue: from API authentication if the credentials
+    are valid, from a header set in settings, or client's address
+    """
+
+    authorization = req.headers.get("authorization", "")
+    if shared.cmd_opts.api_auth and authorization.lower().startswith("basic "):
+        try:
+            user, password = base64.b64decode(authorization[6:]).decode().split(":", 1)
+        except Exception:
+            user, password = None, None
+
+        expected_password = get_api_credentials().get(user)
+        if expected_password is not None and compare_digest(password.encode(), expected_password.encode()):
+            return user
+
+    if opts.queue_user_header and req.headers.get(opts.queue_user_header):
+        return req.headers.get(opts.queue_user_header)
+
+    return req.client.host if req.client else None
 
 
 def api_middleware(app: FastAPI):
@@ -164,6 +171,12 @@ def api_middleware(app: FastAPI):
             ))
         return res
 
+    @app.middleware("http")
+    async def queue_identity(req: Request, call_next):
+        priority = req.headers.get(opts.queue_priority_header) if opts.queue_priority_header else None
+        queue_scheduler.set_identity(user=get_request_user(req), priority=priority.lower() if priority else None)
+        return await call_next(req)
+
     def handle_exception(request: Request, e: Exception):
         err = {
             "error": type(e).__name__,
@@ -199,17 +212,18 @@ def api_middleware(app: FastAPI):
 class Api:
     def __init__(self, app: FastAPI, queue_lock: Lock):
         if shared.cmd_opts.api_auth:
-            self.credentials = {}
-            for auth in shared.cmd_opts.api_auth.split(","):
-                user, password = auth.split(":")
-                self.credentials[user] = password
+            self.credentials = get_api_credentials()
 
         self.router = APIRouter()
         self.app = app
         self.queue_lock = queue_lock
+        self.async_tasks = async_tasks.AsyncTaskStore()
         api_middleware(self.app)
         self.add_api_route("/sdapi/v1/txt2img", self.text2imgapi, methods=["POST"], response_model=models.TextToImageResponse)
         self.add_api_route("/sdapi/v1/img2img", self.img2imgapi, methods=["POST"], response_model=models.ImageToImageResponse)
+        self.add_api_route("/sdapi/v1/txt2img/async", self.text2imgapi_async, methods=["POST"], response_model=models.AsyncTaskResponse)
+        self.add_api_route("/sdapi/v1/img2img/async", self.img2imgapi_async, methods=["POST"], response_model=models.AsyncTaskResponse)
+        self.add_api_route("/sdapi/v1/tasks/{task_id}", self.get_async_task, methods=["GET"], response_model=models.AsyncTaskStatusResponse)
         self.add_api_route("/sdapi/v1/extra-single-image", self.extras_single_image_api, methods=["POST"], response_model=models.ExtrasSingleImageResponse)
         self.add_api_route("/sdapi/v1/extra-batch-images", self.extras_batch_images_api, methods=["POST"], response_model=models.ExtrasBatchImagesResponse)
         self.add_api_route("/sdapi/v1/png-info", self.pnginfoapi, methods=["POST"], response_model=models.PNGInfoResponse)
@@ -238,8 +252,13 @@ class Api:
         self.add_api_route("/sdapi/v1/train/embedding", self.train_embedding, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/train/hypernetwork", self.train_hypernetwork, methods=["POST"], response_model=models.TrainResponse)
         self.add_api_route("/sdapi/v1/memory", self.get_memory, methods=["GET"], response_model=models.MemoryResponse)
+        self.add_api_route("/sdapi/v1/cond-cache", self.get_cond_cache, methods=["GET"], response_model=models.CondCacheResponse)
+        self.add_api_route("/sdapi/v1/schedule-cache", self.get_schedule_cache, methods=["GET"], response_model=models.ScheduleCacheResponse)
+        self.add_api_route("/sdapi/v1/hashing", self.get_hashing_progress, methods=["GET"], response_model=models.HashingProgressResponse)
+        self.add_api_route("/sdapi/v1/workers", self.get_workers, methods=["GET"], response_model=list[models.WorkerItem])
         self.add_api_route("/sdapi/v1/unload-checkpoint", self.unloadapi, methods=["POST"])
         self.add_api_route("/sdapi/v1/reload-checkpoint", self.reloadapi, methods=["POST"])
+        self.add_api_route("/sdapi/v1/prefetch-checkpoint", self.prefetch_checkpoint, methods=["POST"], response_model=models.PrefetchCheckpointResponse)
         self.add_api_route("/sdapi/v1/scripts", self.get_scripts_list, methods=["GET"], response_model=models.ScriptsList)
         self.add_api_route("/sdapi/v1/script-info", self.get_script_info, methods=["GET"], response_model=list[models.ScriptInfo])
         self.add_api_route("/sdapi/v1/extensions", self.get_extensions_list, methods=["GET"], response_model=list[models.ExtensionItem])
@@ -428,9 +447,56 @@ class Api:
 
         return params
 
+    def dispatch_to_worker(self, path, req, task_id, response_class):
+        """sends a generation request to an idle worker process started by --worker-devices, and returns its response"""
+
+        req.force_task_id = task_id
+        payload = jsonable_encoder(req.dict(exclude_unset=True))
+
+        add_task_to_queue(task_id)
+        try:
+            worker, response = worker_pool.pool.post(path, payload, stream=True, on_acquire=lambda worker: start_task(task_id))
+        except requests.RequestException as e:
+            finish_task(task_id)
+            raise HTTPException(status_code=502, detail=f"Worker failed to process the request: {e}") from e
+        except BaseException:
+            finish_task(task_id)
+            raise
+
+        content_type = response.headers.get("content-type", "")
+
+        if response.status_code == 200 and content_type.startswith("application/json"):
+            try:
+                return response_class(**response.json())
+            finally:
+                response.close()
+                worker_pool.pool.release(worker)
+                finish_task(task_id)
+
+        # streaming, multipart, and error responses are passed to the client as they are
+        def content():
+            try:
+                yield from response.iter_content(chunk_size=None)
+            finally:
+                response.close()
+                worker_pool.pool.release(worker)
+                finish_task(task_id)
+
+        return StreamingResponse(content(), status_code=response.status_code, media_type=content_type)
+
     def text2imgapi(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
         task_id = txt2imgreq.force_task_id or create_task_id("txt2img")
 
+        # unsupported accept is rejected before anything is generated
+        response_transport = transport.parse_accept(txt2imgreq.accept)
+        if response_transport.file_references and not txt2imgreq.save_images:
+            raise HTTPException(status_code=422, detail="text/uri-list responses refer to saved files, and need save_images to be true")
+
+        if worker_pool.pool is not None:
+            return self.dispatch_to_worker("/sdapi/v1/txt2img", txt2imgreq, task_id, models.TextToImageResponse)
+
+        coalescing_key = coalescing.request_key("txt2img", txt2imgreq)
+
         script_runner = scripts.scripts_txt2img
 
         infotext_script_args = {}
@@ -451,42 +517,77 @@ class Api:
         args.pop('script_args', None) # will refeed them to the pipeline directly after initializing them
         args.pop('alwayson_scripts', None)
         args.pop('infotext', None)
+        args.pop('accept', None)
 
         script_args = self.init_script_args(txt2imgreq, self.default_script_arg_txt2img, selectable_scripts, selectable_script_idx, script_runner, input_script_args=infotext_script_args)
 
         send_images = args.pop('send_images', True)
         args.pop('save_images', None)
 
-        add_task_to_queue(task_id)
-
-        with self.queue_lock:
-            with closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
-                p.is_api = True
-                p.scripts = script_runner
-                p.outpath_grids = opts.outdir_txt2img_grids
-                p.outpath_samples = opts.outdir_txt2img_samples
-
-                try:
-                    shared.state.begin(job="scripts_txt2img")
-                    start_task(task_id)
-                    if selectable_scripts is not None:
-                        p.script_args = script_args
-                        processed = scripts.scripts_txt2img.run(p, *p.script_args) # Need to pass args as list here
-                    else:
-                        p.script_args = tuple(script_args) # Need to pass args as tuple here
-                        processed = process_images(p)
-                    finish_task(task_id)
-                finally:
-                    shared.state.end()
-                    shared.total_tqdm.clear()
-
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
-
-        return models.TextToImageResponse(images=b64images, parameters=vars(txt2imgreq), info=processed.js())
+        # only requests that passed validation start reading their checkpoint ahead; if generation fails, it's dropped
+        prefetched_checkpoint = sd_models_prefetch.prefetch_for_request(txt2imgreq.override_settings)
+
+        def process(on_image=None, cancelled=None):
+            with sd_models_prefetch.discarded_on_error(prefetched_checkpoint), self.queue_lock:
+                with closing(StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
+                    p.is_api = True
+                    p.scripts = script_runner
+                    p.outpath_grids = opts.outdir_txt2img_grids
+                    p.outpath_samples = opts.outdir_txt2img_samples
+                    p.on_image = on_image
+
+                    try:
+                        shared.state.begin(job="scripts_txt2img")
+                        start_task(task_id)
+                        if cancelled is not None and cancelled.is_set():
+                            shared.state.interrupt()
+                        if selectable_scripts is not None:
+                            p.script_args = script_args
+                            processed = scripts.scripts_txt2img.run(p, *p.script_args) # Need to pass args as list here
+                        else:
+                            p.script_args = tuple(script_args) # Need to pass args as tuple here
+                            processed = process_images(p)
+                        finish_task(task_id)
+                    finally:
+                        shared.state.end()
+                        shared.total_tqdm.clear()
+
+            # images are written to disk while the next job is already running
+            images.finish_saves(processed.pending_saves)
+
+            return processed
+
+        if response_transport.streaming:
+            add_task_to_queue(task_id)
+            return transport.streaming_response(process, txt2imgreq.accept, send_images, lambda processed: {"parameters": vars(txt2imgreq), "info": processed.js()}, task_id)
+
+        def generate():
+            add_task_to_queue(task_id)
+
+            # images that alwayson scripts add to results can't always be attributed to requests of a combined batch
+            if opts.api_batch_requests and selectable_scripts is None and not txt2imgreq.alwayson_scripts:
+                processed = batch_scheduler.process_txt2img(task_id, args, script_args, script_runner, self.queue_lock)
+                images.finish_saves(processed.pending_saves)
+                return processed
+
+            return process()
+
+        processed = coalescing.run(coalescing_key, task_id, generate)
+
+        return transport.images_response(models.TextToImageResponse, processed.images if send_images else [], txt2imgreq.accept, parameters=vars(txt2imgreq), info=processed.js())
 
     def img2imgapi(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
         task_id = img2imgreq.force_task_id or create_task_id("img2img")
 
+        response_transport = transport.parse_accept(img2imgreq.accept)
+        if response_transport.file_references and not img2imgreq.save_images:
+            raise HTTPException(status_code=422, detail="text/uri-list responses refer to saved files, and need save_images to be true")
+
+        if worker_pool.pool is not None:
+            return self.dispatch_to_worker("/sdapi/v1/img2img", img2imgreq, task_id, models.ImageToImageResponse)
+
+        coalescing_key = coalescing.request_key("img2img", img2imgreq)
+
         init_images = img2imgreq.init_images
         if init_images is None:
             raise HTTPException(status_code=404, detail="Init image not found")
@@ -517,43 +618,115 @@ class Api:
         args.pop('script_args', None)  # will refeed them to the pipeline directly after initializing them
         args.pop('alwayson_scripts', None)
         args.pop('infotext', None)
+        args.pop('accept', None)
 
         script_args = self.init_script_args(img2imgreq, self.default_script_arg_img2img, selectable_scripts, selectable_script_idx, script_runner, input_script_args=infotext_script_args)
 
         send_images = args.pop('send_images', True)
         args.pop('save_images', None)
 
-        add_task_to_queue(task_id)
-
-        with self.queue_lock:
-            with closing(StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)) as p:
-                p.init_images = [decode_base64_to_image(x) for x in init_images]
-                p.is_api = True
-                p.scripts = script_runner
-                p.outpath_grids = opts.outdir_img2img_grids
-                p.outpath_samples = opts.outdir_img2img_samples
-
-                try:
-                    shared.state.begin(job="scripts_img2img")
-                    start_task(task_id)
-                    if selectable_scripts is not None:
-                        p.script_args = script_args
-                        processed = scripts.scripts_img2img.run(p, *p.script_args) # Need to pass args as list here
-                    else:
-                        p.script_args = tuple(script_args) # Need to pass args as tuple here
-                        processed = process_images(p)
-                    finish_task(task_id)
-                finally:
-                    shared.state.end()
-                    shared.total_tqdm.clear()
-
-        b64images = list(map(encode_pil_to_base64, processed.images)) if send_images else []
+        # only requests that passed validation start reading their checkpoint ahead; if generation fails, it's dropped
+        prefetched_checkpoint = sd_models_prefetch.prefetch_for_request(img2imgreq.override_settings)
+
+        def process(on_image=None, cancelled=None):
+            with sd_models_prefetch.discarded_on_error(prefetched_checkpoint), self.queue_lock:
+                with closing(StableDiffusionProcessingImg2Img(sd_model=shared.sd_model, **args)) as p:
+                    p.init_images = [decode_base64_to_image(x) for x in init_images]
+                    p.is_api = True
+                    p.scripts = script_runner
+                    p.outpath_grids = opts.outdir_img2img_grids
+                    p.outpath_samples = opts.outdir_img2img_samples
+                    p.on_image = on_image
+
+                    try:
+                        shared.state.begin(job="scripts_img2img")
+                        start_task(task_id)
+                        if cancelled is not None and cancelled.is_set():
+                            shared.state.interrupt()
+                        if selectable_scripts is not None:
+                            p.script_args = script_args
+                            processed = scripts.scripts_img2img.run(p, *p.script_args) # Need to pass args as list here
+                        else:
+                            p.script_args = tuple(script_args) # Need to pass args as tuple here
+                            processed = process_images(p)
+                        finish_task(task_id)
+                    finally:
+                        shared.state.end()
+                        shared.total_tqdm.clear()
+
+            # images are written to disk while the next job is already running
+            images.finish_saves(processed.pending_saves)
+
+            return processed
 
         if not img2imgreq.include_init_images:
             img2imgreq.init_images = None
             img2imgreq.mask = None
 
-        return models.ImageToImageResponse(images=b64images, parameters=vars(img2imgreq), info=processed.js())
+        if response_transport.streaming:
+            add_task_to_queue(task_id)
+            return transport.streaming_response(process, img2imgreq.accept, send_images, lambda processed: {"parameters": vars(img2imgreq), "info": processed.js()}, task_id)
+
+        def generate():
+            add_task_to_queue(task_id)
+            return process()
+
+        processed = coalescing.run(coalescing_key, task_id, generate)
+
+        return transport.images_response(models.ImageToImageResponse, processed.images if send_images else [], img2imgreq.accept, parameters=vars(img2imgreq), info=processed.js())
+
+    def validate_async_accept(self, accept):
+        response_transport = transport.parse_accept(accept)
+        if response_transport.container == "multipart/mixed" or response_transport.streaming:
+            raise HTTPException(status_code=422, detail=f"{response_transport.container} responses are not available for async tasks; results are returned as JSON")
+
+    def text2imgapi_async(self, txt2imgreq: models.StableDiffusionTxt2ImgProcessingAPI):
+        task_id = txt2imgreq.force_task_id or create_task_id("txt2img")
+        txt2imgreq.force_task_id = task_id
+        self.validate_async_accept(txt2imgreq.accept)
+        validate_sampler_name(txt2imgreq.sampler_name or txt2imgreq.sampler_index)
+
+        prefetched_checkpoint = sd_models_prefetch.prefetch_for_request(txt2imgreq.override_settings)
+        task = self.async_tasks.submit(task_id, self.text2imgapi, txt2imgreq)
+        sd_models_prefetch.discard_if_fails(task.future, prefetched_checkpoint)
+
+        return models.AsyncTaskResponse(task_id=task_id)
+
+    def img2imgapi_async(self, img2imgreq: models.StableDiffusionImg2ImgProcessingAPI):
+        task_id = img2imgreq.force_task_id or create_task_id("img2img")
+        img2imgreq.force_task_id = task_id
+        self.validate_async_accept(img2imgreq.accept)
+        validate_sampler_name(img2imgreq.sampler_name or img2imgreq.sampler_index)
+
+        prefetched_checkpoint = sd_models_prefetch.prefetch_for_request(img2imgreq.override_settings)
+        task = self.async_tasks.submit(task_id, self.img2imgapi, img2imgreq)
+        sd_models_prefetch.discard_if_fails(task.future, prefetched_checkpoint)
+
+        return models.AsyncTaskResponse(task_id=task_id)
+
+    async def get_async_task(self, task_id: str, wait: float = 0):
+        task = self.async_tasks.get(task_id)
+        if task is None:
+            raise HTTPException(status_code=404, detail="Task not found")
+
+        # long polling: wait for the task to finish, but no longer than a minute so that proxies don't time out
+        if wait > 0 and not task.future.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(task.future)), timeout=min(wait, 60))
+            except Exception:
+                pass
+
+        status = task.status
+        result = None
+        error = None
+
+        if status == "done":
+            result = task.future.result().dict()
+        elif status == "failed":
+            e = task.future.exception()
+            error = f"{type(e).__name__}: {vars(e).get('detail', e)}"
+
+        return models.AsyncTaskStatusResponse(task_id=task_id, status=status, queue_position=self.async_tasks.queue_position(task_id), result=result, error=error)
 
     def extras_single_image_api(self, req: models.ExtrasSingleImageRequest):
         reqDict = setUpscalers(req)
@@ -652,6 +825,15 @@ class Api:
 
         return {}
 
+    def prefetch_checkpoint(self, req: models.PrefetchCheckpointRequest):
+        checkpoint_info = sd_models.get_closet_checkpoint_match(req.sd_model_checkpoint)
+        if checkpoint_info is None:
+            raise HTTPException(status_code=404, detail=f"model {req.sd_model_checkpoint!r} not found")
+
+        started = sd_models_prefetch.prefetch(checkpoint_info) is not None
+
+        return models.PrefetchCheckpointResponse(title=checkpoint_info.title, started=started)
+
     def skip(self):
         shared.state.skip()
 
@@ -705,7 +887,9 @@ class Api:
 
     def get_sd_models(self):
         import modules.sd_models as sd_models
-        return [{"title": x.title, "model_name": x.model_name, "hash": x.shorthash, "sha256": x.sha256, "filename": x.filename, "config": find_checkpoint_config_near_filename(x)} for x in sd_models.checkpoints_list.values()]
+        with sd_models.checkpoints_lock:
+            checkpoints = list(sd_models.checkpoints_list.values())
+        return [{"title": x.title, "model_name": x.model_name, "hash": x.shorthash, "sha256": x.sha256, "filename": x.filename, "config": find_checkpoint_config_near_filename(x)} for x in checkpoints]
 
     def get_sd_vaes(self):
         import modules.sd_vae as sd_vae
@@ -863,6 +1047,21 @@ class Api:
             cuda = {'error': f'{err}'}
         return models.MemoryResponse(ram=ram, cuda=cuda)
 
+    def get_cond_cache(self):
+        return models.CondCacheResponse(**cond_cache.cache.stats())
+
+    def get_schedule_cache(self):
+        return models.ScheduleCacheResponse(**sd_schedules.stats())
+
+    def get_workers(self):
+        if worker_pool.pool is None:
+            return []
+
+        return [models.WorkerItem(**x) for x in worker_pool.pool.status()]
+
+    def get_hashing_progress(self):
+        return models.HashingProgressResponse(**hashes.progress.stats())
+
     def get_extensions_list(self):
         from modules import extensions
         extensions.list_extensions()
@@ -0,0 +1,101 @@
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from modules import progress, worker_pool
+from modules.shared import opts
+
+
+class AsyncTask:
+    def __init__(self, id_task, future):
+        self.id_task = id_task
+        self.future = future
+        self.time_submitted = time.time()
+        self.time_finished = None
+
+    @property
+    def status(self):
+        if self.future.done():
+            return "failed" if self.future.exception() is not None else "done"
+
+        if progress.current_task == self.id_task:
+            return "running"
+
+        return "queued"
+
+
+class AsyncTaskStore:
+    """Runs API requests in background threads and keeps a bounded number of their results for clients to poll."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = OrderedDict()
+        self.executor = None
+        self.executor_workers = 0
+
+    def get_executor(self):
+        """Returns the executor for tasks, replacing it with a new one if settings now call for a different number of threads."""
+
+        # generation is serialized by queue_lock anyway; extra workers are only useful to let the batch scheduler see several requests at once
+        workers = opts.api_batch_max_size if opts.api_batch_requests else 1
+        if worker_pool.pool is not None:
+            # with worker processes, as many tasks can run at once as there are workers
+            workers = max(workers, len(worker_pool.pool.workers))
+
+        if self.executor is None or workers != self.executor_workers:
+            if self.executor is not None:
+                # tasks already submitted to the old executor still run to completion
+                self.executor.shutdown(wait=False)
+
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api-async")
+            self.executor_workers = workers
+
+        return self.executor
+
+    def submit(self, id_task, func, *args):
+        progress.add_task_to_queue(id_task)
+
+        with self.lock:
+            # run in a copy of the submitting request's context, so that the task keeps its user and priority in queue
+            future = self.get_executor().submit(contextvars.copy_context().run, func, *args)
+            task = AsyncTask(id_task, future)
+            self.tasks[id_task] = task
+            future.add_done_callback(lambda _: self.on_finished(task))
+
+        return task
+
+    def on_finished(self, task):
+        task.time_finished = time.time()
+        self.evict()
+
+    def get(self, id_task):
+        self.evict()
+
+        with self.lock:
+            return self.tasks.get(id_task)
+
+    def evict(self):
+        """Removes results of finished tasks that are too old, or that are over the limit; oldest first."""
+
+        now = time.time()
+        ttl = opts.api_async_results_ttl
+        limit = opts.api_async_results_limit
+
+        with self.lock:
+            finished = [task for task in self.tasks.values() if task.time_finished is not None]
+
+            for i, task in enumerate(finished):
+                expired = ttl > 0 and now - task.time_finished > ttl
+                over_limit = len(finished) - i > limit
+
+                if expired or over_limit:
+                    self.tasks.pop(task.id_task, None)
+
+    def queue_position(self, id_task):
+        pending = progress.get_queue()
+        if id_task not in pending:
+            return None
+
+        return pending.index(id_task)
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from fastapi.encoders import jsonable_encoder
+
+from modules import progress
+from modules.shared import opts
+
+ignored_fields = {"force_task_id", "accept", "send_images"}
+"""request fields that only affect how the result is returned, not what is generated"""
+
+cache_limit = 16
+"""how many results can be kept for the result cache at once; they hold full-size images"""
+
+lock = threading.Lock()
+
+in_flight = {}
+"""key -> Future for generations that are running now"""
+
+results = OrderedDict()
+"""key -> (time when finished, result) for recently finished generations; oldest first"""
+
+
+def generation_options():
+    """returns values of settings that are recorded in infotext; these are the ones that change generated images"""
+
+    return {key: opts.data.get(key, info.default) for key, info in opts.data_labels.items() if info.infotext}
+
+
+def is_deterministic(req):
+    """returns True if generating the request twice gives the same images: its seeds are fixed rather than random"""
+
+    if req.seed is None or req.seed == -1:
+        return False
+
+    if req.subseed_strength and (req.subseed is None or req.subseed == -1):
+        return False
+
+    return True
+
+
+def request_key(kind, req):
+    """
+    Returns a hash of the normalized request (all of its fields with defaults filled in, except those in ignored_fields)
+    together with settings that affect generation, or None if the request should not be coalesced: because it's disabled
+    in settings, because its seed is random and an identical request is expected to produce different images, or because
+    it asks to save images, which every request must do on its own.
+    """
+
+    if not opts.api_coalesce_requests or not is_deterministic(req) or req.save_images:
+        return None
+
+    data = jsonable_encoder(req.dict(exclude=ignored_fields))
+
+    # images also depend on settings that are not overridden by the request, such as the loaded checkpoint
+    text = json.dumps([kind, data, generation_options()], sort_keys=True, default=str)
+
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def get_cached(key, now):
+    """returns result for key from the result cache, or None; must be called with lock held"""
+
+    ttl = opts.api_result_cache_ttl
+
+    while results:
+        oldest_key, (finished, _) = next(iter(results.items()))
+        if ttl > 0 and now - finished <= ttl:
+            break
+
+        results.pop(oldest_key)
+
+    entry = results.get(key)
+    return entry[1] if entry is not None else None
+
+
+def run(key, task_id, func):
+    """
+    Returns the result of func(), which generates images for the request with the given key. If a request with the
+    same key is being generated right now, waits for it to finish and returns its result instead of calling func; if
+    one has finished within the result cache TTL set in settings, returns its result right away. Errors are shared the
+    same way. With key None, just calls func.
+
+    Requests that are given a result of another one are marked as finished in progress tracking under their own task_id.
+    """
+
+    if key is None:
+        return func()
+
+    with lock:
+        result = get_cached(key, time.time())
+        future = in_flight.get(key)
+
+        if result is None and future is None:
+            future = Future()
+            in_flight[key] = future
+            owner = True
+        else:
+            owner = False
+
+    if not owner:
+        try:
+            return result if result is not None else future.result()
+        finally:
+            # an async task is added to queue before it gets here
+            progress.pending_tasks.pop(task_id, None)
+            progress.finish_task(task_id)
+
+    try:
+        result = func()
+    except BaseException as e:
+        with lock:
+            in_flight.pop(key, None)
+
+        future.set_exception(e)
+        raise
+
+    with lock:
+        in_flight.pop(key, None)
+
+        if opts.api_result_cache_ttl > 0:
+            results[key] = (time.time(), result)
+            while len(results) > cache_limit:
+                results.popitem(last=False)
+
+    future.set_result(result)
+
+    return result
@@ -109,6 +109,7 @@ StableDiffusionTxt2ImgProcessingAPI = PydanticModelGenerator(
         {"key": "alwayson_scripts", "type": dict, "default": {}},
         {"key": "force_task_id", "type": str, "default": None},
         {"key": "infotext", "type": str, "default": None},
+        {"key": "accept", "type": str, "default": None},
     ]
 ).generate_model()
 
@@ -128,6 +129,7 @@ StableDiffusionImg2ImgProcessingAPI = PydanticModelGenerator(
         {"key": "alwayson_scripts", "type": dict, "default": {}},
         {"key": "force_task_id", "type": str, "default": None},
         {"key": "infotext", "type": str, "default": None},
+        {"key": "accept", "type": str, "default": None},
     ]
 ).generate_model()
 
@@ -141,6 +143,16 @@ class ImageToImageResponse(BaseModel):
     parameters: dict
     info: str
 
+class AsyncTaskResponse(BaseModel):
+    task_id: str = Field(title="Task ID", description="ID of the submitted task; use it with /sdapi/v1/tasks/{task_id} to get the result")
+
+class AsyncTaskStatusResponse(BaseModel):
+    task_id: str = Field(title="Task ID")
+    status: Literal["queued", "running", "done", "failed"] = Field(title="Status")
+    queue_position: Optional[int] = Field(default=None, title="Queue position", description="Number of tasks ahead of this one in queue, if it's queued")
+    result: Optional[dict] = Field(default=None, title="Result", description="Same as the response of the synchronous endpoint; present once the task is done")
+    error: Optional[str] = Field(default=None, title="Error", description="Error message if the task has failed")
+
 class ExtrasBaseRequest(BaseModel):
     resize_mode: Literal[0, 1] = Field(default=0, title="Resize Mode", description="Sets the resize mode: 0 to upscale by upscaling_resize amount, 1 to upscale up to upscaling_resize_h x upscaling_resize_w.")
     show_extras_results: bool = Field(default=True, title="Show results", description="Should the backend return the generated image?")
@@ -291,6 +303,41 @@ class MemoryResponse(BaseModel):
     ram: dict = Field(title="RAM", description="System memory stats")
     cuda: dict = Field(title="CUDA", description="nVidia CUDA memory stats")
 
+class HashingProgressResponse(BaseModel):
+    files_total: int = Field(title="Files total", description="Number of files whose hashing started since hashing was last idle")
+    files_done: int = Field(title="Files done", description="Number of those files that have been hashed")
+    bytes_total: int = Field(title="Bytes total", description="Total size of those files")
+    bytes_done: int = Field(title="Bytes done", description="Number of bytes that have been read so far")
+    current: list[str] = Field(title="Current", description="Files that are being hashed right now")
+
+class WorkerItem(BaseModel):
+    index: int = Field(title="Index")
+    device: str = Field(title="Device", description="Device the worker generates on, as specified in --worker-devices")
+    url: str = Field(title="URL", description="Address of the worker's API")
+    ready: bool = Field(title="Ready", description="Whether the worker has started and accepts requests")
+    busy: bool = Field(title="Busy", description="Whether the worker is processing a request")
+    tasks_done: int = Field(title="Tasks done", description="Number of requests the worker has processed")
+
+class PrefetchCheckpointRequest(BaseModel):
+    sd_model_checkpoint: str = Field(title="Checkpoint", description="Name of the checkpoint to read into memory in background, so that switching to it later is faster")
+
+class PrefetchCheckpointResponse(BaseModel):
+    title: str = Field(title="Title", description="Title of the checkpoint")
+    started: bool = Field(title="Started", description="False if the checkpoint is already loaded or being prefetched")
+
+class CondCacheResponse(BaseModel):
+    hits: int = Field(title="Hits", description="Number of prompts for which conds were taken from cache")
+    misses: int = Field(title="Misses", description="Number of prompts for which conds had to be calculated")
+    entries: int = Field(title="Entries", description="Number of prompts currently in cache")
+    size: int = Field(title="Size", description="Total size of cached conds, in bytes")
+    limit: int = Field(title="Limit", description="Maximum size of cached conds, in bytes")
+
+class ScheduleCacheResponse(BaseModel):
+    hits: int = Field(title="Hits", description="Number of times a sigma schedule or timestep tensors were taken from cache")
+    misses: int = Field(title="Misses", description="Number of times a sigma schedule or timestep tensors had to be calculated")
+    entries: int = Field(title="Entries", description="Number of schedules currently in cache")
+    limit: int = Field(title="Limit", description="Maximum number of schedules kept in cache")
+
 
 class ScriptsList(BaseModel):
     txt2img: list = Field(default=None, title="Txt2img", description="Titles of scripts (txt2img)")
@@ -0,0 +1,309 @@
+import base64
+import io
+import json
+import os
+import queue
+import threading
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import piexif
+import piexif.helper
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import HTTPException
+from fastapi.responses import Response, StreamingResponse
+from PIL import PngImagePlugin
+
+from modules import errors, progress, shared
+from modules.shared import opts
+
+image_media_types = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/webp": "webp",
+}
+
+streaming_media_types = ["application/x-ndjson", "text/event-stream"]
+
+container_media_types = ["application/json", "multipart/mixed", "text/uri-list"] + streaming_media_types
+
+extension_media_types = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+executor = None
+
+keepalive_interval = 5
+"""seconds without events after which a streaming response sends an empty line, so that a client that has gone away is noticed"""
+
+
+class Transport:
+    def __init__(self, container="application/json", image_format=None):
+        self.container = container
+        """
+        application/json for base64 images inside JSON, multipart/mixed for raw image bytes after a JSON part, text/uri-list
+        for references to saved files inside JSON; application/x-ndjson or text/event-stream to stream every image as a
+        separate event as soon as it's ready
+        """
+
+        self.image_format = image_format
+        """png, jpg or webp; None to use the format from settings"""
+
+    @property
+    def streaming(self):
+        return self.container in streaming_media_types
+
+    @property
+    def file_references(self):
+        return self.container == "text/uri-list"
+
+    @property
+    def lossless_webp(self):
+        # WebP that was explicitly asked for is meant as a faster lossless replacement for PNG; WebP from settings is
+        # encoded the same way as it always was for API responses
+        return self.image_format == "webp"
+
+
+def parse_accept(accept):
+    """
+    Parses the accept field of a request: a comma-separated list of media types in order of preference, optionally
+    with q= weights, like the HTTP Accept header. Container type (application/json, multipart/mixed, text/uri-list,
+    or application/x-ndjson and text/event-stream for streaming) and image type (image/png, image/jpeg or image/webp) are chosen independently, for example:
+    "multipart/mixed, image/webp" for raw lossless WebP images, or "image/jpeg" for base64 JPEG images inside JSON.
+    """
+
+    if not accept:
+        return Transport()
+
+    entries = []
+    for i, item in enumerate(accept.split(",")):
+        media_type, *params = [x.strip() for x in item.split(";")]
+        weight = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    pass
+
+        if weight > 0:
+            entries.append((-weight, i, media_type.lower()))
+
+    media_types = [media_type for _, _, media_type in sorted(entries)]
+
+    container = next((x for x in media_types if x in container_media_types), None)
+    image_format = next((image_media_types[x] for x in media_types if x in image_media_types), None)
+
+    if container is None and image_format is None:
+        raise HTTPException(status_code=406, detail=f"None of requested media types are supported: {accept}; supported: {', '.join(container_media_types + list(image_media_types))}")
+
+    return Transport(container or "application/json", image_format)
+
+
+def encode_image(image, image_format, lossless_webp=False):
+    """Encodes PIL image into bytes of the specified format, with generation parameters from image.info embedded as metadata"""
+
+    with io.BytesIO() as output_bytes:
+        if image_format.lower() == 'png':
+            use_metadata = False
+            metadata = PngImagePlugin.PngInfo()
+            for key, value in image.info.items():
+                if isinstance(key, str) and isinstance(value, str):
+                    metadata.add_text(key, value)
+                    use_metadata = True
+            image.save(output_bytes, format="PNG", pnginfo=(metadata if use_metadata else None), quality=opts.jpeg_quality)
+
+        elif image_format.lower() in ("jpg", "jpeg", "webp"):
+            if image.mode == "RGBA":
+                image = image.convert("RGB")
+            parameters = image.info.get('parameters', None)
+            exif_bytes = piexif.dump({
+                "Exif": {piexif.ExifIFD.UserComment: piexif.helper.UserComment.dump(parameters or "", encoding="unicode")}
+            })
+            if image_format.lower() in ("jpg", "jpeg"):
+                image.save(output_bytes, format="JPEG", exif=exif_bytes, quality=opts.jpeg_quality)
+            elif lossless_webp:
+                # method 0 is the fastest; lossless WebP is still smaller than PNG at that setting
+                image.save(output_bytes, format="WEBP", exif=exif_bytes, lossless=True, quality=0, method=0)
+            else:
+                image.save(output_bytes, format="WEBP", exif=exif_bytes, quality=opts.jpeg_quality)
+
+        else:
+            raise HTTPException(status_code=500, detail="Invalid image format")
+
+        return output_bytes.getvalue()
+
+
+def get_executor():
+    global executor
+
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix="api-encode")
+
+    return executor
+
+
+def encode_images(image_list, transport):
+    """Encodes images in parallel (PIL releases GIL while compressing); returns a list of bytes in the same order as image_list"""
+
+    image_format = transport.image_format or opts.samples_format
+    lossless_webp = transport.lossless_webp
+
+    if len(image_list) <= 1:
+        return [encode_image(image, image_format, lossless_webp) for image in image_list]
+
+    return list(get_executor().map(lambda image: encode_image(image, image_format, lossless_webp), image_list))
+
+
+def saved_filename(image):
+    """returns absolute path to the file the image was saved to by save_image, or None if it wasn't saved"""
+
+    filename = getattr(image, 'already_saved_as', None)
+    if not filename or not os.path.isfile(filename):
+        return None
+
+    return os.path.abspath(filename)
+
+
+def file_references(image_list, transport):
+    """
+    Returns a URI for every image: a /file= URL for images that have been saved to disk, which the web UI serves for
+    files in directories allowed with --gradio-allowed-path (the data directory with outputs by default); a data: URI
+    with the encoded image for images that have not been saved, like grids or masks that settings don't save.
+    """
+
+    image_format = transport.image_format or opts.samples_format
+    media_type = extension_media_types.get(image_format.lower(), "application/octet-stream")
+
+    unsaved = [image for image in image_list if saved_filename(image) is None]
+    encoded = dict(zip(map(id, unsaved), encode_images(unsaved, transport)))
+
+    res = []
+    for image in image_list:
+        filename = saved_filename(image)
+        if filename is not None:
+            res.append("/file=" + urllib.parse.quote(filename, safe="/:\\"))
+        else:
+            res.append(f"data:{media_type};base64,{base64.b64encode(encoded[id(image)]).decode()}")
+
+    return res
+
+
+def multipart_response(data, encoded_images, image_format):
+    """Creates a multipart/mixed response with JSON data in the first part, and every image as raw bytes in its own part after it"""
+
+    boundary = uuid.uuid4().hex
+    media_type = extension_media_types.get(image_format.lower(), "application/octet-stream")
+
+    parts = [f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode() + json.dumps(jsonable_encoder(data)).encode()]
+    for i, image_bytes in enumerate(encoded_images):
+        header = f"--{boundary}\r\nContent-Type: {media_type}\r\nContent-Disposition: attachment; filename=\"{i:05}.{image_format}\"\r\n\r\n"
+        parts.append(header.encode() + image_bytes)
+
+    body = b"\r\n".join(parts) + f"\r\n--{boundary}--\r\n".encode()
+
+    return Response(content=body, media_type=f"multipart/mixed; boundary={boundary}")
+
+
+def images_response(response_class, image_list, accept, **kwargs):
+    """
+    Creates a response for an API endpoint that returns generated images, encoding images in the way requested by the
+    accept field of the request. response_class is a pydantic model with images field; kwargs are its other fields.
+    """
+
+    transport = parse_accept(accept)
+
+    if transport.file_references:
+        return response_class(images=file_references(image_list, transport), **kwargs)
+
+    encoded = encode_images(image_list, transport)
+
+    if transport.container == "multipart/mixed":
+        data = response_class(images=[], **kwargs).dict()
+        return multipart_response(data, encoded, transport.image_format or opts.samples_format)
+
+    return response_class(images=[base64.b64encode(x) for x in encoded], **kwargs)
+
+
+def format_event(transport, event, data):
+    data = json.dumps(jsonable_encoder(data))
+
+    if transport.container == "text/event-stream":
+        return f"event: {event}\ndata: {data}\n\n"
+
+    return data + "\n"
+
+
+def streaming_response(process, accept, send_images, finish, task_id):
+    """
+    Creates a response that streams generated images as they are produced, one event per image, followed by a final event
+    with the result. process(on_image, cancelled) must generate images, calling on_image(image, infotext) for each, and return
+    Processed; it's run in a separate thread. finish(processed) returns a dict with fields for the final event. Images from
+    Processed that were not streamed (for example, grids) are included in the final event.
+
+    Events are sent as newline-delimited JSON objects with an "event" field for application/x-ndjson, or as server-sent
+    events for text/event-stream. Event types are "image", "done" and "error"; empty lines or SSE comments are sent to keep
+    the connection alive. If the client disconnects, the cancelled Event is set, and task_id is interrupted if it's running;
+    process must interrupt the job itself if it starts after that.
+
+    Images that were streamed are not kept in Processed, so server memory use does not grow with the number of images,
+    unless a grid is made from them.
+    """
+
+    transport = parse_accept(accept)
+    events = queue.Queue()
+    streamed = set()
+    cancelled = threading.Event()
+
+    def encode(image):
+        return base64.b64encode(encode_image(image, transport.image_format or opts.samples_format, transport.lossless_webp)).decode()
+
+    def on_image(image, infotext):
+        # images are encoded by the thread that sends the response, so that generation does not wait for it
+        streamed.add(id(image))
+        events.put(("image", {"index": len(streamed) - 1, "image": image if send_images else None, "info": infotext}))
+
+    def run():
+        try:
+            processed = process(on_image, cancelled)
+            remaining = [image for image in processed.images if id(image) not in streamed] if send_images else []
+            events.put(("done", {"images": remaining, **finish(processed)}))
+        except Exception as e:
+            if not isinstance(e, HTTPException):
+                errors.display(e, "streaming API request")
+            events.put(("error", {"error": type(e).__name__, "detail": vars(e).get('detail', str(e))}))
+
+    threading.Thread(target=run, name="api-stream", daemon=True).start()
+
+    def generate():
+        finished = False
+
+        try:
+            while True:
+                try:
+                    event, data = events.get(timeout=keepalive_interval)
+                except queue.Empty:
+                    yield ":\n\n" if transport.container == "text/event-stream" else "\n"
+                    continue
+
+                if event == "image" and data["image"] is not None:
+                    data["image"] = encode(data["image"])
+                elif event == "done":
+                    data["images"] = [encode(image) for image in data["images"]]
+
+                if transport.container == "application/x-ndjson":
+                    data = {"event": event, **data}
+
+                yield format_event(transport, event, data)
+
+                if event != "image":
+                    finished = True
+                    break
+        finally:
+            # the generator is closed early when the client disconnects; nobody is going to receive the rest of the images
+            if not finished:
+                cancelled.set()
+                if progress.current_task == task_id:
+                    shared.state.interrupt()
+
+    return StreamingResponse(generate(), media_type=transport.container)
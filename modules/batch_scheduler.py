@@ -0,0 +1,208 @@
+import copy
+import json
+import threading
+from collections import OrderedDict
+from contextlib import closing
+
+from modules import progress, processing, shared
+from modules.shared import opts
+
+# parameters that are allowed to differ between requests that are fused into a single batch
+per_request_fields = {"prompt", "negative_prompt", "seed", "subseed", "batch_size", "force_task_id"}
+
+pending = OrderedDict()
+pending_lock = threading.Lock()
+
+
+class BatchedTask:
+    def __init__(self, id_task, args, script_args):
+        self.id_task = id_task
+        self.args = args
+        self.script_args = script_args
+        self.processed = None
+        self.error = None
+        self.done = threading.Event()
+        self.key = self.compatibility_key()
+
+    @property
+    def batch_size(self):
+        return self.args.get("batch_size") or 1
+
+    def compatibility_key(self):
+        """Returns a string identifying requests that can be generated together in one batch, or None if this request can't be batched"""
+
+        if (self.args.get("n_iter") or 1) != 1:
+            return None
+
+        if isinstance(self.args.get("prompt"), list) or isinstance(self.args.get("negative_prompt"), list):
+            return None
+
+        # a combined batch never makes a grid, so only requests that would not have gotten one can be fused
+        if not self.args.get("do_not_save_grid") and not (self.batch_size == 1 and opts.grid_only_if_multiple):
+            return None
+
+        shared_args = {k: v for k, v in self.args.items() if k not in per_request_fields}
+
+        try:
+            return json.dumps([shared_args, list(self.script_args)], sort_keys=True)
+        except (TypeError, ValueError):
+            return None
+
+    def fixed_seeds(self):
+        seed = processing.get_fixed_seed(self.args.get("seed", -1))
+        subseed = processing.get_fixed_seed(self.args.get("subseed", -1))
+        subseed_strength = self.args.get("subseed_strength") or 0
+
+        seeds = [int(seed) + (x if subseed_strength == 0 else 0) for x in range(self.batch_size)]
+        subseeds = [int(subseed) + x for x in range(self.batch_size)]
+
+        return seeds, subseeds
+
+
+def take_group(task):
+    """Removes task and all pending tasks compatible with it from the pending list, and returns them in queue order."""
+
+    with pending_lock:
+        pending.pop(task.id_task, None)
+        group = [task]
+
+        if task.key is None:
+            return group
+
+        total = task.batch_size
+        for other in list(pending.values()):
+            if other.key != task.key or total + other.batch_size > opts.api_batch_max_size:
+                continue
+
+            pending.pop(other.id_task)
+            group.append(other)
+            total += other.batch_size
+
+    return group
+
+
+def split_processed(processed, group, generated):
+    """
+    Makes a separate Processed object for every task in the group from the combined result. generated is a list of
+    (image, infotext) for every image of the combined batch in order, as reported to p.on_image; each task gets its own
+    range of them. Other images in the result were added by scripts, which ran with the same arguments for all tasks,
+    so every task gets all of them after its own images.
+    """
+
+    generated_ids = {id(image) for image, _ in generated}
+    extra_images = [image for image in processed.images[processed.index_of_first_image:] if id(image) not in generated_ids]
+
+    res = []
+    position = 0
+
+    for task in group:
+        part = copy.copy(processed)
+        start, end = position, position + task.batch_size
+
+        part.images = [image for image, _ in generated[start:end]] + extra_images
+        part.infotexts = [text for _, text in generated[start:end]]
+        part.all_prompts = processed.all_prompts[start:end]
+        part.all_negative_prompts = processed.all_negative_prompts[start:end]
+        part.all_seeds = processed.all_seeds[start:end]
+        part.all_subseeds = processed.all_subseeds[start:end]
+        part.prompt = part.all_prompts[0]
+        part.negative_prompt = part.all_negative_prompts[0]
+        part.seed = part.all_seeds[0]
+        part.subseed = part.all_subseeds[0]
+        part.info = part.infotexts[0] if part.infotexts else processed.info
+        part.batch_size = task.batch_size
+        part.index_of_first_image = 0
+
+        res.append(part)
+        position = end
+
+    return res
+
+
+def run_group(group, script_runner):
+    args = dict(group[0].args)
+
+    if len(group) > 1:
+        seeds, subseeds = [], []
+        for task in group:
+            task_seeds, task_subseeds = task.fixed_seeds()
+            seeds += task_seeds
+            subseeds += task_subseeds
+
+        args["prompt"] = [task.args.get("prompt", "") for task in group for _ in range(task.batch_size)]
+        args["negative_prompt"] = [task.args.get("negative_prompt", "") for task in group for _ in range(task.batch_size)]
+        args["seed"] = seeds
+        args["subseed"] = subseeds
+        args["batch_size"] = len(seeds)
+        args["do_not_save_grid"] = True
+
+    generated = []
+
+    with closing(processing.StableDiffusionProcessingTxt2Img(sd_model=shared.sd_model, **args)) as p:
+        p.is_api = True
+        p.scripts = script_runner
+        p.outpath_grids = opts.outdir_txt2img_grids
+        p.outpath_samples = opts.outdir_txt2img_samples
+        if len(group) > 1:
+            # images reported to on_image are not in the combined result; split_processed hands them out to tasks
+            p.on_image = lambda image, text: generated.append((image, text))
+
+        try:
+            shared.state.begin(job="scripts_txt2img")
+            progress.start_task(group[0].id_task)
+            for task in group[1:]:
+                progress.pending_tasks.pop(task.id_task, None)
+
+            p.script_args = tuple(group[0].script_args)
+            processed = processing.process_images(p)
+        finally:
+            shared.state.end()
+            shared.total_tqdm.clear()
+
+            for task in group:
+                progress.finish_task(task.id_task)
+
+    if len(group) == 1:
+        return [processed]
+
+    return split_processed(processed, group, generated)
+
+
+def process_txt2img(id_task, args, script_args, script_runner, queue_lock):
+    """
+    Generates images for an API txt2img request without a selectable script.
+
+    While waiting for queue_lock, the request is kept in a list of pending requests. Whoever gets the lock
+    first takes all pending requests that differ only in prompts, seeds and batch size, and generates them
+    as one batch, so that requests waiting behind it find their results ready once they get the lock.
+    """
+
+    task = BatchedTask(id_task, args, script_args)
+
+    with pending_lock:
+        pending[id_task] = task
+
+    try:
+        with queue_lock:
+            if not task.done.is_set():
+                group = take_group(task)
+
+                try:
+                    results = run_group(group, script_runner)
+                    for member, processed in zip(group, results):
+                        member.processed = processed
+                except Exception as e:
+                    for member in group:
+                        member.error = e
+                    raise
+                finally:
+                    for member in group:
+                        member.done.set()
+    finally:
+        with pending_lock:
+            pending.pop(id_task, None)
+
+    if task.error is not None:
+        raise task.error
+
+    return task.processed
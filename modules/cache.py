@@ -1,22 +1,255 @@
 import json
 import os
 import os.path
+import sqlite3
 import threading
 import time
 
 from modules.paths import data_path, script_path
 
 cache_filename = os.environ.get('SD_WEBUI_CACHE_FILE', os.path.join(data_path, "cache.json"))
+cache_db_filename = os.path.splitext(cache_filename)[0] + ".db"
 cache_data = None
 cache_lock = threading.Lock()
 
 dump_cache_after = None
 dump_cache_thread = None
 
+missing_recheck_interval = 60
+"""seconds after which an entry that was not found in the database is looked up again, since other processes using the same database can add it"""
+
+
+class CacheStore:
+    """
+    SQLite database with one table for each cache subsection. Entries are stored as JSON, and are written
+    incrementally: only the entries that changed since the last write.
+    """
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.conn = self.connect(filename)
+
+    def connect(self, filename):
+        try:
+            conn = sqlite3.connect(filename, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS _meta (key TEXT PRIMARY KEY, value TEXT)")
+            return conn
+        except sqlite3.DatabaseError:
+            os.replace(filename, os.path.join(script_path, "tmp", os.path.basename(filename)))
+            print(f'[ERROR] issue occurred while trying to open {filename}, move current cache to tmp/ and create new cache')
+            return self.connect(filename)
+
+    @staticmethod
+    def table(subsection):
+        return '"section:' + subsection.replace('"', '""') + '"'
+
+    def create_table(self, subsection):
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table(subsection)} (key TEXT PRIMARY KEY, value TEXT)")
+
+    def read(self, subsection, key):
+        with self.lock:
+            try:
+                row = self.conn.execute(f"SELECT value FROM {self.table(subsection)} WHERE key = ?", (key, )).fetchone()
+            except sqlite3.OperationalError:  # no such table
+                return None
+
+        return None if row is None else json.loads(row[0])
+
+    def read_all(self, subsection):
+        with self.lock:
+            try:
+                rows = self.conn.execute(f"SELECT key, value FROM {self.table(subsection)}").fetchall()
+            except sqlite3.OperationalError:  # no such table
+                return []
+
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def write(self, changes):
+        """changes is a list of (subsection, key, value) tuples; value of None deletes the entry"""
+
+        with self.lock, self.conn:
+            for subsection in {x[0] for x in changes}:
+                self.create_table(subsection)
+
+            for subsection, key, value in changes:
+                if value is None:
+                    self.conn.execute(f"DELETE FROM {self.table(subsection)} WHERE key = ?", (key, ))
+                else:
+                    self.conn.execute(f"INSERT OR REPLACE INTO {self.table(subsection)} (key, value) VALUES (?, ?)", (key, json.dumps(value, ensure_ascii=False)))
+
+    def is_migrated(self):
+        with self.lock:
+            return self.conn.execute("SELECT value FROM _meta WHERE key = 'migrated'").fetchone() is not None
+
+    def migrate(self, filename):
+        """one-time import of all data from old cache.json file"""
+
+        if self.is_migrated():
+            return
+
+        data = {}
+        try:
+            with open(filename, "r", encoding="utf8") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            pass
+        except Exception:
+            print(f'[ERROR] issue occurred while trying to read {filename}, it will not be imported into the new cache')
+
+        self.write([(subsection, key, value) for subsection, entries in data.items() for key, value in entries.items()])
+
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO _meta (key, value) VALUES ('migrated', ?)", (filename, ))
+
+        if data:
+            print(f"Imported {sum(len(x) for x in data.values())} entries from {filename} into {cache_db_filename}")
+
+
+class CacheSection(dict):
+    """
+    A dict with cache entries for one subsection, read from the database lazily, one entry at a time when it's accessed,
+    or all entries at once if the dict is iterated over. Entries that are assigned or deleted are remembered and are
+    written to the database by dump_cache(). Values must be replaced as a whole for the change to be written.
+    """
+
+    def __init__(self, store, subsection):
+        super().__init__()
+        self.store = store
+        self.subsection = subsection
+        self.fully_loaded = False
+        self.fully_loaded_at = 0
+        self.known_missing = {}
+        """key -> time when it was found to be missing from the database"""
+        self.changed = set()
+        self.changed_lock = threading.Lock()
+
+    def load(self, key):
+        if dict.__contains__(self, key):
+            return
+
+        now = time.time()
+        if now - max(self.known_missing.get(key, 0), self.fully_loaded_at) < missing_recheck_interval:
+            return
+
+        value = self.store.read(self.subsection, key)
+
+        # the entry could have been set by another thread while it was being read; the database has an older value then
+        with self.changed_lock:
+            if dict.__contains__(self, key) or key in self.changed:
+                return
+
+            if value is None:
+                self.known_missing[key] = now
+            else:
+                dict.__setitem__(self, key, value)
+                self.known_missing.pop(key, None)
+
+    def load_all(self):
+        if self.fully_loaded:
+            return
+
+        entries = self.store.read_all(self.subsection)
+
+        with self.changed_lock:
+            for key, value in entries:
+                if not dict.__contains__(self, key) and key not in self.changed:
+                    dict.__setitem__(self, key, value)
+
+            self.fully_loaded = True
+            self.fully_loaded_at = time.time()
+
+    def __contains__(self, key):
+        self.load(key)
+        return dict.__contains__(self, key)
+
+    def __getitem__(self, key):
+        self.load(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self.load(key)
+        return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        with self.changed_lock:
+            dict.__setitem__(self, key, value)
+            self.known_missing.pop(key, None)
+            self.changed.add(key)
+
+    def __delitem__(self, key):
+        self.load(key)
+        with self.changed_lock:
+            dict.__delitem__(self, key)
+            self.changed.add(key)
+
+    def pop(self, key, *args):
+        self.load(key)
+        with self.changed_lock:
+            if dict.__contains__(self, key):
+                self.changed.add(key)
+            return dict.pop(self, key, *args)
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __iter__(self):
+        self.load_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.load_all()
+        return dict.__len__(self)
+
+    def keys(self):
+        self.load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
+    def take_changes(self):
+        with self.changed_lock:
+            res = [(self.subsection, key, dict.get(self, key)) for key in self.changed]
+            self.changed = set()
+
+        return res
+
+    def return_changes(self, keys):
+        """marks entries taken by take_changes as changed again, because they could not be written"""
+
+        with self.changed_lock:
+            self.changed.update(keys)
+
+
+cache_store = None
+
+
+def get_cache_store():
+    global cache_store
+
+    if cache_store is None:
+        store = CacheStore(cache_db_filename)
+        store.migrate(cache_filename)
+        cache_store = store
+
+    return cache_store
+
 
 def dump_cache():
     """
-    Marks cache for writing to disk. 5 seconds after no one else flags the cache for writing, it is written.
+    Marks cache for writing to disk. 5 seconds after no one else flags the cache for writing, changed entries are written.
     """
 
     global dump_cache_after
@@ -30,15 +263,20 @@ def dump_cache():
             time.sleep(1)
 
         with cache_lock:
-            cache_filename_tmp = cache_filename + "-"
-            with open(cache_filename_tmp, "w", encoding="utf8") as file:
-                json.dump(cache_data, file, indent=4, ensure_ascii=False)
-
-            os.replace(cache_filename_tmp, cache_filename)
+            changes = [change for section in cache_data.values() for change in section.take_changes()]
 
             dump_cache_after = None
             dump_cache_thread = None
 
+        try:
+            get_cache_store().write(changes)
+        except Exception as e:
+            print(f'[ERROR] issue occurred while writing cache to {cache_db_filename}, will try again with the next change: {e}')
+
+            with cache_lock:
+                for section in cache_data.values():
+                    section.return_changes([key for subsection, key, _ in changes if subsection == section.subsection])
+
     with cache_lock:
         dump_cache_after = time.time() + 5
         if dump_cache_thread is None:
@@ -62,18 +300,14 @@ def cache(subsection):
     if cache_data is None:
         with cache_lock:
             if cache_data is None:
-                try:
-                    with open(cache_filename, "r", encoding="utf8") as file:
-                        cache_data = json.load(file)
-                except FileNotFoundError:
-                    cache_data = {}
-                except Exception:
-                    os.replace(cache_filename, os.path.join(script_path, "tmp", "cache.json"))
-                    print('[ERROR] issue occurred while trying to read cache.json, move current cache to tmp/cache.json and create new cache')
-                    cache_data = {}
-
-    s = cache_data.get(subsection, {})
-    cache_data[subsection] = s
+                get_cache_store()
+                cache_data = {}
+
+    with cache_lock:
+        s = cache_data.get(subsection)
+        if s is None:
+            s = CacheSection(get_cache_store(), subsection)
+            cache_data[subsection] = s
 
     return s
 
@@ -2,9 +2,11 @@ from functools import wraps
 import html
 import time
 
-from modules import shared, progress, errors, devices, fifo_lock
+import gradio as gr
 
-queue_lock = fifo_lock.FIFOLock()
+from modules import shared, progress, errors, devices, queue_scheduler
+
+queue_lock = queue_scheduler.SchedulingLock()
 
 
 def wrap_queued_call(func):
@@ -28,17 +30,26 @@ def wrap_gradio_gpu_call(func, extra_outputs=None):
         else:
             id_task = None
 
-        with queue_lock:
-            shared.state.begin(job=id_task)
-            progress.start_task(id_task)
+        request = next((x for x in args if isinstance(x, gr.Request)), None)
+        queue_scheduler.set_identity(user=getattr(request, 'username', None), priority=shared.opts.queue_ui_priority)
+
+        from modules import images
+
+        with images.collect_saves() as saves:
+            with queue_lock:
+                shared.state.begin(job=id_task)
+                progress.start_task(id_task)
+
+                try:
+                    res = func(*args, **kwargs)
+                    progress.record_results(id_task, res)
+                finally:
+                    progress.finish_task(id_task)
 
-            try:
-                res = func(*args, **kwargs)
-                progress.record_results(id_task, res)
-            finally:
-                progress.finish_task(id_task)
+                shared.state.end()
 
-            shared.state.end()
+        # images are written to disk while the next job is already running
+        images.finish_saves(saves)
 
         return res
 
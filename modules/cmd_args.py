@@ -122,3 +122,6 @@ parser.add_argument('--timeout-keep-alive', type=int, default=30, help='set time
 parser.add_argument("--disable-all-extensions", action='store_true', help="prevent all extensions from running regardless of any other settings", default=False)
 parser.add_argument("--disable-extra-extensions", action='store_true', help="prevent all extensions except built-in from running regardless of any other settings", default=False)
 parser.add_argument("--skip-load-model-at-start", action='store_true', help="if load a model at web start, only take effect when --nowebui", )
+parser.add_argument("--worker-devices", type=str, help="comma-separated list of devices to start a generation worker process for, each with its own copy of the model; txt2img and img2img API requests are sent to idle workers. Use CUDA device ids, or cpu, for example: 0,1", default=None)
+parser.add_argument("--worker-base-port", type=int, help="port for the first worker process started by --worker-devices; following workers use next ports. Defaults to the port after the one used by webui", default=None)
+parser.add_argument("--worker-timeout", type=float, help="how long to wait for a worker started by --worker-devices to respond to a request, in seconds; non-streaming requests respond only once generation is done", default=3600)
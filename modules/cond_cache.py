@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict
+
+import torch
+
+from modules import shared
+
+
+def hashable(x):
+    """converts x into something that can be used as a dict key; dicts, lists and extra network params are converted to tuples"""
+
+    if isinstance(x, dict):
+        return tuple((k, hashable(v)) for k, v in sorted(x.items(), key=lambda kv: str(kv[0])))
+
+    if isinstance(x, (list, tuple)):
+        return tuple(hashable(v) for v in x)
+
+    items = getattr(x, 'items', None)
+    if isinstance(items, list):  # ExtraNetworkParams
+        return hashable(items)
+
+    try:
+        hash(x)
+    except TypeError:
+        return repr(x)
+
+    return x
+
+
+def size_of(x):
+    """returns number of bytes taken by tensors in x"""
+
+    if isinstance(x, torch.Tensor):
+        return x.numel() * x.element_size()
+
+    if isinstance(x, dict):
+        return sum(size_of(v) for v in x.values())
+
+    if isinstance(x, (list, tuple)):
+        return sum(size_of(v) for v in x)
+
+    return 0
+
+
+class ConditioningCache:
+    """
+    A process-wide LRU cache for results of encoding prompts with text encoder. Keys should include everything that
+    can change the result: prompt text, model, clip skip, emphasis, extra networks, step schedule, etc.
+
+    The cache is limited by total size of stored tensors, set by opts.cond_cache_size in megabytes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def limit(self):
+        return int(shared.opts.cond_cache_size * 1024 * 1024)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = size_of(value)
+        limit = self.limit
+
+        if size > limit:
+            return
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > limit and self.entries:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+                "size": self.size,
+                "limit": self.limit,
+            }
+
+
+cache = ConditioningCache()
@@ -1,5 +1,8 @@
 import hashlib
 import os.path
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from modules import shared
 import modules.cache
@@ -7,18 +10,131 @@ import modules.cache
 dump_cache = modules.cache.dump_cache
 cache = modules.cache.cache
 
+blksize = 1024 * 1024
+
+io_lock = threading.Lock()
+io_semaphore = None
+io_semaphore_size = None
+
+executor = None
+executor_lock = threading.Lock()
+
+in_progress = {}
+"""filename -> Event set when the file is done being hashed; so that the same file is never read for hashing twice at once"""
+
+in_progress_lock = threading.Lock()
+
+
+class HashingProgress:
+    """Keeps track of files being hashed, for reporting progress to console, UI and API"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files_total = 0
+        self.files_done = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.current = {}
+
+    def begin(self, filename, size):
+        with self.lock:
+            self.files_total += 1
+            self.bytes_total += size
+            self.current[filename] = 0
+
+    def update(self, filename, size):
+        with self.lock:
+            self.bytes_done += size
+            self.current[filename] = self.current.get(filename, 0) + size
+
+    def end(self, filename):
+        with self.lock:
+            self.files_done += 1
+            self.current.pop(filename, None)
+
+            if not self.current:
+                self.files_total = self.files_done = self.bytes_total = self.bytes_done = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "files_total": self.files_total,
+                "files_done": self.files_done,
+                "bytes_total": self.bytes_total,
+                "bytes_done": self.bytes_done,
+                "current": list(self.current),
+            }
+
+
+progress = HashingProgress()
+
+
+def get_io_semaphore():
+    """returns semaphore that limits the number of files read for hashing at the same time to opts.hash_io_limit"""
+
+    global io_semaphore, io_semaphore_size
+
+    size = max(1, shared.opts.hash_io_limit)
+
+    with io_lock:
+        if io_semaphore is None or io_semaphore_size != size:
+            io_semaphore = threading.BoundedSemaphore(size)
+            io_semaphore_size = size
+
+        return io_semaphore
+
+
+def hash_file(filename, hashers_for_offset):
+    """
+    Reads the file once, feeding its contents into hashers. hashers_for_offset is a list of (offset, hasher) pairs;
+    each hasher gets all file's data starting from its offset.
+    """
+
+    size = os.path.getsize(filename)
+    progress.begin(filename, size)
+
+    try:
+        with get_io_semaphore(), open(filename, "rb") as f:
+            position = 0
+            for chunk in iter(lambda: f.read(blksize), b""):
+                for offset, hasher in hashers_for_offset:
+                    if offset < position + len(chunk):
+                        hasher.update(chunk[max(0, offset - position):])
+
+                position += len(chunk)
+                progress.update(filename, len(chunk))
+    finally:
+        progress.end(filename)
+
 
 def calculate_sha256(filename):
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
 
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(blksize), b""):
-            hash_sha256.update(chunk)
+    hash_file(filename, [(0, hash_sha256)])
 
     return hash_sha256.hexdigest()
 
 
+def safetensors_data_offset(filename):
+    """returns the offset at which the tensor data (after the header) starts in a safetensors file"""
+
+    with open(filename, "rb") as file:
+        header = file.read(8)
+
+    return int.from_bytes(header, "little") + 8
+
+
+def calculate_sha256_and_addnet_hash(filename):
+    """calculates both the sha256 of the whole file, and kohya-ss's addnet hash of its data region, reading the file only once"""
+
+    hash_sha256 = hashlib.sha256()
+    hash_addnet = hashlib.sha256()
+
+    hash_file(filename, [(0, hash_sha256), (safetensors_data_offset(filename), hash_addnet)])
+
+    return hash_sha256.hexdigest(), hash_addnet.hexdigest()
+
+
 def sha256_from_cache(filename, title, use_addnet_hash=False):
     hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
     try:
@@ -41,23 +157,58 @@ def sha256_from_cache(filename, title, use_addnet_hash=False):
 def sha256(filename, title, use_addnet_hash=False):
     hashes = cache("hashes-addnet") if use_addnet_hash else cache("hashes")
 
-    sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
-    if sha256_value is not None:
-        return sha256_value
+    while True:
+        sha256_value = sha256_from_cache(filename, title, use_addnet_hash)
+        if sha256_value is not None:
+            return sha256_value
+
+        if shared.cmd_opts.no_hashing:
+            return None
+
+        with in_progress_lock:
+            other = in_progress.get(filename)
+            if other is None:
+                hashing = in_progress[filename] = threading.Event()
+
+        if other is None:
+            break
+
+        # another thread, usually hashing in background, is reading this file; wait for it and check the cache again
+        other.wait()
+
+    try:
+        return calculate_and_cache_sha256(hashes, filename, title, use_addnet_hash)
+    finally:
+        with in_progress_lock:
+            del in_progress[filename]
+
+        hashing.set()
 
-    if shared.cmd_opts.no_hashing:
-        return None
 
-    print(f"Calculating sha256 for {filename}: ", end='')
-    if use_addnet_hash:
-        with open(filename, "rb") as file:
+def calculate_and_cache_sha256(hashes, filename, title, use_addnet_hash):
+    mtime = os.path.getmtime(filename)
+    started = time.time()
+
+    if filename.lower().endswith(".safetensors"):
+        # both kinds of hash come out of a single read, so store both
+        full_value, addnet_value = calculate_sha256_and_addnet_hash(filename)
+        sha256_value = addnet_value if use_addnet_hash else full_value
+
+        other_hashes = cache("hashes") if use_addnet_hash else cache("hashes-addnet")
+        other_hashes[title] = {
+            "mtime": mtime,
+            "sha256": full_value if use_addnet_hash else addnet_value,
+        }
+    elif use_addnet_hash:
+        with get_io_semaphore(), open(filename, "rb") as file:
             sha256_value = addnet_hash_safetensors(file)
     else:
         sha256_value = calculate_sha256(filename)
-    print(f"{sha256_value}")
+
+    print(f"Calculated sha256 for {filename} in {time.time() - started:.1f}s: {sha256_value}")
 
     hashes[title] = {
-        "mtime": os.path.getmtime(filename),
+        "mtime": mtime,
         "sha256": sha256_value,
     }
 
@@ -66,10 +217,34 @@ def sha256(filename, title, use_addnet_hash=False):
     return sha256_value
 
 
+def get_executor():
+    global executor
+
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max(1, shared.opts.hash_threads), thread_name_prefix="hashing")
+
+        return executor
+
+
+def sha256_in_background(filename, title, use_addnet_hash=False):
+    """same as sha256(), but runs in the hashing thread pool; returns a Future"""
+
+    return get_executor().submit(sha256, filename, title, use_addnet_hash)
+
+
+def calculate_in_background(func, items):
+    """
+    Calls func (usually, a method that calculates hash of an object and remembers it, like CheckpointInfo.calculate_shorthash)
+    for every element of items in the hashing thread pool. Returns the list of Futures.
+    """
+
+    return [get_executor().submit(func, item) for item in items]
+
+
 def addnet_hash_safetensors(b):
     """kohya-ss hash for safetensors from https://github.com/kohya-ss/sd-scripts/blob/main/library/train_util.py"""
     hash_sha256 = hashlib.sha256()
-    blksize = 1024 * 1024
 
     b.seek(0)
     header = b.read(8)
@@ -81,4 +256,3 @@ def addnet_hash_safetensors(b):
         hash_sha256.update(chunk)
 
     return hash_sha256.hexdigest()
-
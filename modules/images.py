@@ -8,6 +8,10 @@ import math
 import os
 from collections import namedtuple
 import re
+import threading
+import concurrent.futures
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import piexif
@@ -502,9 +506,18 @@ class FilenameGenerator:
         return res
 
 
-def get_next_sequence_number(path, basename):
+sequence_numbers = {}
+"""(directory, basename) -> next sequence number to use when saving into the directory; found by a scan once, then counted in memory"""
+
+sequence_numbers_lock = threading.Lock()
+
+reservation_lock = threading.Lock()
+
+
+def scan_sequence_number(path, basename):
     """
-    Determines and returns the next sequence number to use when saving an image in the specified directory.
+    Determines and returns the next sequence number to use when saving an image in the specified directory by looking
+    at all files in it.
 
     The sequence starts at 0.
     """
@@ -524,6 +537,151 @@ def get_next_sequence_number(path, basename):
     return result + 1
 
 
+def get_next_sequence_number(path, basename, rescan=False):
+    """
+    Determines and returns the next sequence number to use when saving an image in the specified directory.
+
+    The directory is only scanned the first time it's used, or if rescan is True; after that, the number is kept in
+    memory and advanced by reserve_numbered_filename.
+
+    The sequence starts at 0.
+    """
+
+    key = (os.path.abspath(path), basename)
+
+    with sequence_numbers_lock:
+        number = sequence_numbers.get(key)
+
+    if number is None or rescan:
+        scanned = scan_sequence_number(path, basename)
+
+        with sequence_numbers_lock:
+            number = max(scanned, sequence_numbers.get(key, 0))
+            sequence_numbers[key] = number
+
+    return number
+
+
+@contextmanager
+def shared_sequence_counter(path, basename):
+    """
+    Opens a small file in the directory that keeps the next sequence number for basename, and locks it for the duration
+    of the with block, so that processes saving into the same directory take numbers one at a time. Yields the file, or
+    None if it can't be used; then numbers are only coordinated between threads of this process.
+    """
+
+    filename = os.path.join(path, f".{basename}-sequence" if basename else ".sequence")
+
+    try:
+        file = open(filename, "a+", encoding="utf8")
+    except OSError:
+        yield None
+        return
+
+    with file:
+        try:
+            if os.name == "nt":
+                import msvcrt
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        except OSError:
+            yield None
+            return
+
+        try:
+            yield file
+        finally:
+            if os.name == "nt":
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+def read_sequence_counter(counter):
+    if counter is None:
+        return 0
+
+    counter.seek(0)
+    text = counter.read().strip()
+
+    return int(text) if text.isdigit() else 0
+
+
+def write_sequence_counter(counter, number):
+    if counter is None:
+        return
+
+    counter.seek(0)
+    counter.truncate()
+    counter.write(str(number))
+    counter.flush()
+
+
+def reserve_numbered_filename(path, basename, file_decoration, extension):
+    """
+    Picks the next numbered filename in the specified directory and reserves it by atomically creating an empty file with
+    that name. The number itself is shared with other processes saving into the same directory through a locked counter
+    file, so that they never use the same number, even though the rest of their filenames usually differ. If the file
+    already exists, someone else has saved into the directory, and it's scanned again.
+
+    Returns a tuple of (filename, reserved); if the file could not be created (for example, because its name is too long),
+    reserved is False and the filename is only checked to not exist.
+    """
+
+    key = (os.path.abspath(path), basename)
+
+    with reservation_lock, shared_sequence_counter(path, basename) as counter:
+        number = max(get_next_sequence_number(path, basename), read_sequence_counter(counter))
+        rescanned = False
+        fullfn = None
+        reserved = False
+
+        for _ in range(500):
+            fn = f"{number:05}" if basename == '' else f"{basename}-{number:04}"
+            fullfn = os.path.join(path, f"{fn}{file_decoration}.{extension}")
+
+            try:
+                if is_pending_save(fullfn):
+                    raise FileExistsError(fullfn)
+
+                os.close(os.open(fullfn, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                reserved = True
+            except FileExistsError:
+                if rescanned:
+                    number += 1
+                else:
+                    number = max(number + 1, get_next_sequence_number(path, basename, rescan=True))
+                    rescanned = True
+                continue
+            except OSError:
+                reserved = False
+
+            with sequence_numbers_lock:
+                sequence_numbers[key] = max(number + 1, sequence_numbers.get(key, 0))
+
+            write_sequence_counter(counter, number + 1)
+            break
+
+    return fullfn, reserved
+
+
+def remove_reserved_filename(filename):
+    """Removes the empty file created by reserve_numbered_filename if nothing has been written into it, so that a failed save does not leave it behind"""
+
+    if filename is None:
+        return
+
+    try:
+        if os.path.getsize(filename) == 0:
+            os.remove(filename)
+    except OSError:
+        pass
+
+
 def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_pnginfo=None, pnginfo_section_name='parameters'):
     """
     Saves image to filename, including geninfo as text information for generation info.
@@ -572,7 +730,93 @@ def save_image_with_geninfo(image, geninfo, filename, extension=None, existing_p
         image.save(filename, format=image_format, quality=opts.jpeg_quality)
 
 
-def save_image(image, path, basename, seed=None, prompt=None, extension='png', info=None, short_filename=False, no_prompt=False, grid=False, pnginfo_section_name='parameters', p=None, existing_info=None, forced_filename=None, suffix="", save_to_dirs=None):
+saving_executor = None
+saving_lock = threading.Lock()
+
+pending_saves = {}
+"""filename -> Future for images that are being written to disk in background by save_image"""
+
+saves_of_thread = threading.local()
+
+
+def get_saving_executor():
+    global saving_executor
+
+    if saving_executor is None:
+        saving_executor = ThreadPoolExecutor(max_workers=max(1, opts.save_images_threads), thread_name_prefix="image-saving")
+
+    return saving_executor
+
+
+def save_in_background(filename, func):
+    """
+    Runs func, which writes filename to disk, in the image saving thread pool; until it finishes, filename is considered
+    taken. Returns a Future; if writing fails, the error is both printed and kept in the Future.
+    """
+
+    def run():
+        try:
+            func()
+        except Exception as e:
+            errors.display(e, f"saving image {filename}")
+            raise
+        finally:
+            with saving_lock:
+                if pending_saves.get(filename) is future:
+                    del pending_saves[filename]
+
+    with saving_lock:
+        future = get_saving_executor().submit(run)
+        pending_saves[filename] = future
+
+    collected = getattr(saves_of_thread, 'futures', None)
+    if collected is not None:
+        collected.append(future)
+
+    return future
+
+
+@contextmanager
+def collect_saves():
+    """
+    Returns a list that gets Futures for all images that start being saved in background on this thread while in the with
+    block, so that they can be waited for with finish_saves after the block, once queue lock is no longer held.
+    """
+
+    previous = getattr(saves_of_thread, 'futures', None)
+    saves_of_thread.futures = []
+
+    try:
+        yield saves_of_thread.futures
+    finally:
+        saves_of_thread.futures = previous
+
+
+def is_pending_save(filename):
+    with saving_lock:
+        return filename in pending_saves
+
+
+def wait_for_pending_saves(filename=None):
+    """
+    Waits until the image with given filename, or all images if it's None, that are being saved in background are
+    written to disk or have failed to be written
+    """
+
+    with saving_lock:
+        futures = [x for x in (pending_saves.values() if filename is None else [pending_saves.get(filename)]) if x is not None]
+
+    concurrent.futures.wait(futures)
+
+
+def finish_saves(futures):
+    """Waits for images saved in background by save_image to be written to disk; raises the error of the first one that failed"""
+
+    for future in futures:
+        future.result()
+
+
+def save_image(image, path, basename, seed=None, prompt=None, extension='png', info=None, short_filename=False, no_prompt=False, grid=False, pnginfo_section_name='parameters', p=None, existing_info=None, forced_filename=None, suffix="", save_to_dirs=None, background=False):
     """Save an image.
 
     Args:
@@ -598,6 +842,13 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
             If specified, `basename` and filename pattern will be ignored.
         save_to_dirs (bool):
             If true, the image will be saved into a subdirectory of `path`.
+        background (bool):
+            If true, and saving in background is enabled in settings, only the filename is chosen before returning;
+            the image is encoded and written to disk by a thread pool. The image must not be changed after this call.
+            The Future for the write is added to p.pending_saves, which Processed for the job shares; whoever started the
+            job should wait for it with finish_saves after releasing the queue lock.
+            If any extension has registered image_saved callback, the image is saved right away instead, so that the
+            callback runs on the calling thread.
 
     Returns: (fullfn, txt_fullfn)
         fullfn (`str`):
@@ -606,6 +857,7 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
             If a text file is saved for this image, this will be its full path. Otherwise None.
     """
     namegen = FilenameGenerator(p, seed, prompt, image)
+    reserved_fullfn = None
 
     # WebP and JPG formats have maximum dimension limits of 16383 and 65535 respectively. switch to PNG which has a much higher limit
     if (image.height > 65535 or image.width > 65535) and extension.lower() in ("jpg", "jpeg") or (image.height > 16383 or image.width > 16383) and extension.lower() == "webp":
@@ -637,13 +889,9 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
             file_decoration = f"-{file_decoration}"
 
         if add_number:
-            basecount = get_next_sequence_number(path, basename)
-            fullfn = None
-            for i in range(500):
-                fn = f"{basecount + i:05}" if basename == '' else f"{basename}-{basecount + i:04}"
-                fullfn = os.path.join(path, f"{fn}{file_decoration}.{extension}")
-                if not os.path.exists(fullfn):
-                    break
+            fullfn, reserved = reserve_numbered_filename(path, basename, file_decoration, extension)
+            if reserved:
+                reserved_fullfn = fullfn
         else:
             fullfn = os.path.join(path, f"{file_decoration}.{extension}")
     else:
@@ -654,7 +902,12 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
         pnginfo[pnginfo_section_name] = info
 
     params = script_callbacks.ImageSaveParams(image, p, fullfn, pnginfo)
-    script_callbacks.before_image_saved_callback(params)
+
+    try:
+        script_callbacks.before_image_saved_callback(params)
+    except BaseException:
+        remove_reserved_filename(reserved_fullfn)
+        raise
 
     image = params.image
     fullfn = params.filename
@@ -671,49 +924,74 @@ def save_image(image, path, basename, seed=None, prompt=None, extension='png', i
         filename = filename_without_extension + extension
         if shared.opts.save_images_replace_action != "Replace":
             n = 0
-            while os.path.exists(filename):
+            while os.path.exists(filename) and filename != reserved_fullfn:
                 n += 1
                 filename = f"{filename_without_extension}-{n}{extension}"
         os.replace(temp_file_path, filename)
 
     fullfn_without_extension, extension = os.path.splitext(params.filename)
     if hasattr(os, 'statvfs'):
-        max_name_len = os.statvfs(path).f_namemax
+        try:
+            max_name_len = os.statvfs(path).f_namemax
+        except BaseException:
+            remove_reserved_filename(reserved_fullfn)
+            raise
+
         fullfn_without_extension = fullfn_without_extension[:max_name_len - max(4, len(extension))]
         params.filename = fullfn_without_extension + extension
         fullfn = params.filename
-    _atomically_save_image(image, fullfn_without_extension, extension)
 
-    image.already_saved_as = fullfn
-
-    oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
-    if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
-        ratio = image.width / image.height
-        resize_to = None
-        if oversize and ratio > 1:
-            resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
-        elif oversize:
-            resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
-
-        if resize_to is not None:
-            try:
-                # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
-                image = image.resize(resize_to, LANCZOS)
-            except Exception:
-                image = image.resize(resize_to)
-        try:
-            _atomically_save_image(image, fullfn_without_extension, ".jpg")
-        except Exception as e:
-            errors.display(e, "saving image as downscaled JPG")
+    if reserved_fullfn is not None and reserved_fullfn != fullfn:
+        # the filename was changed by a callback; the empty file that reserved the original name is no longer needed
+        os.remove(reserved_fullfn)
+        reserved_fullfn = None
 
     if opts.save_txt and info is not None:
         txt_fullfn = f"{fullfn_without_extension}.txt"
-        with open(txt_fullfn, "w", encoding="utf8") as file:
-            file.write(f"{info}\n")
     else:
         txt_fullfn = None
 
-    script_callbacks.image_saved_callback(params)
+    def _write_files(image):
+        try:
+            _atomically_save_image(image, fullfn_without_extension, extension)
+        except BaseException:
+            remove_reserved_filename(reserved_fullfn)
+            raise
+
+        oversize = image.width > opts.target_side_length or image.height > opts.target_side_length
+        if opts.export_for_4chan and (oversize or os.stat(fullfn).st_size > opts.img_downscale_threshold * 1024 * 1024):
+            ratio = image.width / image.height
+            resize_to = None
+            if oversize and ratio > 1:
+                resize_to = round(opts.target_side_length), round(image.height * opts.target_side_length / image.width)
+            elif oversize:
+                resize_to = round(image.width * opts.target_side_length / image.height), round(opts.target_side_length)
+
+            if resize_to is not None:
+                try:
+                    # Resizing image with LANCZOS could throw an exception if e.g. image mode is I;16
+                    image = image.resize(resize_to, LANCZOS)
+                except Exception:
+                    image = image.resize(resize_to)
+            try:
+                _atomically_save_image(image, fullfn_without_extension, ".jpg")
+            except Exception as e:
+                errors.display(e, "saving image as downscaled JPG")
+
+        if txt_fullfn is not None:
+            with open(txt_fullfn, "w", encoding="utf8") as file:
+                file.write(f"{info}\n")
+
+        script_callbacks.image_saved_callback(params)
+
+    image.already_saved_as = fullfn
+
+    pending_saves_of_p = getattr(p, 'pending_saves', None)
+
+    if background and opts.save_images_in_background and pending_saves_of_p is not None and not script_callbacks.callback_map['callbacks_image_saved']:
+        pending_saves_of_p.append(save_in_background(fullfn, lambda: _write_files(image)))
+    else:
+        _write_files(image)
 
     return fullfn, txt_fullfn
 
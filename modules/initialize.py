@@ -151,7 +151,8 @@ def initialize_rest(*, reload_script_modules=False):
             sd_hijack.apply_optimizations()
 
         devices.first_time_calculation()
-    if not shared.cmd_opts.skip_load_model_at_start:
+    # with --worker-devices, generation happens in worker processes that load their own models
+    if not shared.cmd_opts.skip_load_model_at_start and not shared.cmd_opts.worker_devices:
         Thread(target=load_model).start()
 
     from modules import shared_items
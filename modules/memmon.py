@@ -21,6 +21,7 @@ class MemUsageMonitor(threading.Thread):
         self.daemon = True
         self.run_flag = threading.Event()
         self.data = defaultdict(int)
+        self.earlier_peaks = defaultdict(int)
 
         try:
             self.cuda_mem_get_info()
@@ -42,6 +43,7 @@ class MemUsageMonitor(threading.Thread):
 
             torch.cuda.reset_peak_memory_stats()
             self.data.clear()
+            self.earlier_peaks.clear()
 
             if self.opts.memmon_poll_rate <= 0:
                 self.run_flag.clear()
@@ -72,6 +74,16 @@ class MemUsageMonitor(threading.Thread):
     def monitor(self):
         self.run_flag.set()
 
+    def reset_peak_memory_stats(self):
+        """resets torch's peak memory stats so that a part of the job can be measured; peaks reached before that are still reported by read()"""
+
+        if not self.disabled:
+            torch_stats = torch.cuda.memory_stats(self.device)
+            for key in ("active_bytes.all.peak", "reserved_bytes.all.peak"):
+                self.earlier_peaks[key] = max(self.earlier_peaks[key], torch_stats[key])
+
+        torch.cuda.reset_peak_memory_stats(self.device)
+
     def read(self):
         if not self.disabled:
             free, total = self.cuda_mem_get_info()
@@ -80,9 +92,9 @@ class MemUsageMonitor(threading.Thread):
 
             torch_stats = torch.cuda.memory_stats(self.device)
             self.data["active"] = torch_stats["active.all.current"]
-            self.data["active_peak"] = torch_stats["active_bytes.all.peak"]
+            self.data["active_peak"] = max(torch_stats["active_bytes.all.peak"], self.earlier_peaks["active_bytes.all.peak"])
             self.data["reserved"] = torch_stats["reserved_bytes.all.current"]
-            self.data["reserved_peak"] = torch_stats["reserved_bytes.all.peak"]
+            self.data["reserved_peak"] = max(torch_stats["reserved_bytes.all.peak"], self.earlier_peaks["reserved_bytes.all.peak"])
             self.data["system_peak"] = total - self.data["min_free"]
 
         return self.data
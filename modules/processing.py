@@ -16,7 +16,7 @@ from skimage import exposure
 from typing import Any
 
 import modules.sd_hijack
-from modules import devices, prompt_parser, masking, sd_samplers, lowvram, infotext_utils, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, rng
+from modules import devices, prompt_parser, masking, sd_samplers, lowvram, infotext_utils, extra_networks, sd_vae_approx, scripts, sd_samplers_common, sd_unet, errors, rng, cond_cache, sd_vae_tiling, queue_scheduler
 from modules.rng import slerp # noqa: F401
 from modules.sd_hijack import model_hijack
 from modules.sd_samplers_common import images_tensor_to_samples, decode_first_stage, approximation_indexes
@@ -227,6 +227,12 @@ class StableDiffusionProcessing:
 
     is_api: bool = field(default=False, init=False)
 
+    on_image: Any = field(default=None, init=False)
+    """if set, called as on_image(image, infotext) for every generated image as soon as it's postprocessed, for streaming results; such images are not included in images of Processed"""
+
+    pending_saves: list = field(default_factory=list, init=False)
+    """Futures for images that are being written to disk in background by images.save_image"""
+
     def __post_init__(self):
         if self.sampler_index is not None:
             print("sampler_index argument for StableDiffusionProcessing does not do anything; use sampler_name", file=sys.stderr)
@@ -487,6 +493,11 @@ class StableDiffusionProcessing:
 
         cache = caches[0]
 
+        if isinstance(required_prompts, prompt_parser.SdConditioning):
+            # for the process-wide cache, everything except prompts themselves identifies the result
+            cache_key = cond_cache.hashable((cached_params[1:], required_prompts.is_negative_prompt, opts.use_old_emphasis_implementation, opts.comma_padding_backtrack))
+            required_prompts = prompt_parser.SdConditioning(required_prompts, copy_from=required_prompts, cache_key=cache_key)
+
         with devices.autocast():
             cache[1] = function(shared.sd_model, required_prompts, steps, hires_steps, shared.opts.use_old_scheduling)
 
@@ -544,6 +555,7 @@ class Processed:
         self.denoising_strength = getattr(p, 'denoising_strength', None)
         self.extra_generation_params = p.extra_generation_params
         self.index_of_first_image = index_of_first_image
+        self.pending_saves = getattr(p, 'pending_saves', [])
         self.styles = p.styles
         self.job_timestamp = state.job_timestamp
         self.clip_skip = opts.CLIP_stop_at_last_layers
@@ -625,16 +637,45 @@ class DecodedSamples(list):
     already_decoded = True
 
 
+def decode_latent_chunk(model, latents, tiled):
+    if tiled:
+        return sd_vae_tiling.decode_tiled(lambda x: decode_first_stage(model, x), latents)
+
+    return decode_first_stage(model, latents)
+
+
 def decode_latent_batch(model, batch, target_device=None, check_for_nans=False):
+    """
+    Decodes latents with VAE, as many at once as fits into free memory. If even one latent does not fit, or the decode
+    runs out of memory for a single latent, it's decoded in overlapping tiles (depending on settings).
+    """
+
     samples = DecodedSamples()
 
-    for i in range(batch.shape[0]):
-        sample = decode_first_stage(model, batch[i:i + 1])[0]
+    full_vae = approximation_indexes.get(opts.sd_vae_decode_method, 0) == 0
+    batch_size = sd_vae_tiling.get_decode_batch_size(batch) if full_vae else batch.shape[0]
+
+    i = 0
+    while i < batch.shape[0]:
+        count = max(batch_size, 1)
+        tiled = batch_size == 0
+
+        try:
+            decoded = decode_latent_chunk(model, batch[i:i + count], tiled)
+        except Exception as e:
+            if not full_vae or not sd_vae_tiling.is_out_of_memory(e) or tiled or (batch_size == 1 and shared.opts.sd_vae_tiling == "Never"):
+                raise
+
+            devices.torch_gc()
+            batch_size //= 2
+            print(f"VAE ran out of memory; retrying with {'batch size ' + str(batch_size) if batch_size > 0 else 'tiles'}")
+            continue
 
         if check_for_nans:
 
             try:
-                devices.test_for_nans(sample, "vae")
+                for sample in decoded:
+                    devices.test_for_nans(sample, "vae")
             except devices.NansException as e:
                 if shared.opts.auto_vae_precision_bfloat16:
                     autofix_dtype = torch.bfloat16
@@ -662,12 +703,15 @@ def decode_latent_batch(model, batch, target_device=None, check_for_nans=False):
                 model.first_stage_model.to(devices.dtype_vae)
                 batch = batch.to(devices.dtype_vae)
 
-                sample = decode_first_stage(model, batch[i:i + 1])[0]
+                decoded = decode_latent_chunk(model, batch[i:i + count], tiled)
 
-        if target_device is not None:
-            sample = sample.to(target_device)
+        for sample in decoded:
+            if target_device is not None:
+                sample = sample.to(target_device)
 
-        samples.append(sample)
+            samples.append(sample)
+
+        i += count
 
     return samples
 
@@ -850,6 +894,12 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
     infotexts = []
     output_images = []
+
+    # images passed to p.on_image are not kept in the result, so that a streaming job does not hold all of them in memory
+    # until it ends; only if a grid is going to be made from them, they are kept until then
+    streamed_images = set()
+    keep_streamed_images = (opts.return_grid or opts.grid_save) and not p.do_not_save_grid
+
     with torch.no_grad(), p.sd_model.ema_scope():
         with devices.autocast():
             p.init(p.all_prompts, p.all_seeds, p.all_subseeds)
@@ -866,6 +916,12 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
         for n in range(p.n_iter):
             p.iteration = n
 
+            if n > 0 and queue_scheduler.preemption_point():
+                # another job has run in between; restore global state that it could have changed
+                modules.sd_hijack.model_hijack.apply_circular(p.tiling)
+                sd_models.apply_token_merging(p.sd_model, p.get_token_merging_ratio())
+                sd_unet.apply_unet()
+
             if state.skipped:
                 state.skipped = False
 
@@ -967,7 +1023,7 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
 
                 if p.restore_faces:
                     if save_samples and opts.save_images_before_face_restoration:
-                        images.save_image(Image.fromarray(x_sample), p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-before-face-restoration")
+                        images.save_image(Image.fromarray(x_sample), p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-before-face-restoration", background=True)
 
                     devices.torch_gc()
 
@@ -998,7 +1054,7 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                 if p.color_corrections is not None and i < len(p.color_corrections):
                     if save_samples and opts.save_images_before_color_correction:
                         image_without_cc, _ = apply_overlay(image, p.paste_to, overlay_image)
-                        images.save_image(image_without_cc, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-before-color-correction")
+                        images.save_image(image_without_cc, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-before-color-correction", background=True)
                     image = apply_color_correction(p.color_corrections[i], image)
 
                 # If the intention is to show the output from the model
@@ -1012,27 +1068,35 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                     p.scripts.postprocess_image_after_composite(p, pp)
                     image = pp.image
 
-                if save_samples:
-                    images.save_image(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p)
-
                 text = infotext(i)
                 infotexts.append(text)
                 if opts.enable_pnginfo:
                     image.info["parameters"] = text
-                output_images.append(image)
+
+                if save_samples:
+                    images.save_image(image, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=text, p=p, background=True)
+
+                if p.on_image is None:
+                    output_images.append(image)
+                else:
+                    p.on_image(image, text)
+
+                    if keep_streamed_images:
+                        output_images.append(image)
+                        streamed_images.add(id(image))
 
                 if mask_for_overlay is not None:
                     if opts.return_mask or opts.save_mask:
                         image_mask = mask_for_overlay.convert('RGB')
                         if save_samples and opts.save_mask:
-                            images.save_image(image_mask, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-mask")
+                            images.save_image(image_mask, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-mask", background=True)
                         if opts.return_mask:
                             output_images.append(image_mask)
 
                     if opts.return_mask_composite or opts.save_mask_composite:
                         image_mask_composite = Image.composite(original_denoised_image.convert('RGBA').convert('RGBa'), Image.new('RGBa', image.size), images.resize_image(2, mask_for_overlay, image.width, image.height).convert('L')).convert('RGBA')
                         if save_samples and opts.save_mask_composite:
-                            images.save_image(image_mask_composite, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-mask-composite")
+                            images.save_image(image_mask_composite, p.outpath_samples, "", p.seeds[i], p.prompts[i], opts.samples_format, info=infotext(i), p=p, suffix="-mask-composite", background=True)
                         if opts.return_mask_composite:
                             output_images.append(image_mask_composite)
 
@@ -1058,7 +1122,10 @@ def process_images_inner(p: StableDiffusionProcessing) -> Processed:
                 output_images.insert(0, grid)
                 index_of_first_image = 1
             if opts.grid_save:
-                images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(use_main_prompt=True), short_filename=not opts.grid_extended_filename, p=p, grid=True)
+                images.save_image(grid, p.outpath_grids, "grid", p.all_seeds[0], p.all_prompts[0], opts.grid_format, info=infotext(use_main_prompt=True), short_filename=not opts.grid_extended_filename, p=p, grid=True, background=True)
+
+        if streamed_images:
+            output_images = [image for image in output_images if id(image) not in streamed_images]
 
     if not p.disable_extra_networks and p.extra_network_data:
         extra_networks.deactivate(p, p.extra_network_data)
@@ -1290,7 +1357,7 @@ class StableDiffusionProcessingTxt2Img(StableDiffusionProcessing):
                 image = sd_samplers.sample_to_image(image, index, approximation=0)
 
             info = create_infotext(self, self.all_prompts, self.all_seeds, self.all_subseeds, [], iteration=self.iteration, position_in_batch=index)
-            images.save_image(image, self.outpath_samples, "", seeds[index], prompts[index], opts.samples_format, info=info, p=self, suffix="-before-highres-fix")
+            images.save_image(image, self.outpath_samples, "", seeds[index], prompts[index], opts.samples_format, info=info, p=self, suffix="-before-highres-fix", background=True)
 
         img2img_sampler_name = self.hr_sampler_name or self.sampler_name
 
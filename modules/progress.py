@@ -1,11 +1,17 @@
+import asyncio
 import base64
 import io
+import json
+import threading
 import time
 
 import gradio as gr
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
+from starlette.concurrency import run_in_threadpool
 
 from modules.shared import opts
+from modules import queue_scheduler
 
 import modules.shared as shared
 from collections import OrderedDict
@@ -19,6 +25,13 @@ finished_tasks = []
 recorded_results = []
 recorded_results_limit = 2
 
+live_preview_lock = threading.Lock()
+live_preview_encoded = (-1, None)
+live_preview_key = None
+
+unknown_task_timeout = 10
+"""seconds for which progress stream waits for a task it knows nothing about to be queued; the client may start listening before the task is submitted"""
+
 
 def start_task(id_task):
     global current_task
@@ -50,11 +63,29 @@ def record_results(id_task, res):
 
 
 def add_task_to_queue(id_job):
-    pending_tasks[id_job] = time.time()
+    # a task submitted through the async API is added before it's run; keep its original place in queue
+    pending_tasks.setdefault(id_job, time.time())
+    queue_scheduler.task_id.set(id_job)
+
+
+def get_queue():
+    """returns ids of pending tasks in the order they are going to run"""
+
+    return queue_scheduler.pending_order(list(pending_tasks))
+
+
+class PendingTaskItem(BaseModel):
+    id_task: str = Field(title="Task ID")
+    user: str = Field(default=None, title="User", description="user the task counts towards for fair share")
+    priority: str = Field(default=None, title="Priority class")
+    waiting: bool = Field(title="Whether the task is waiting for the queue lock", description="false for tasks that are accepted but not yet ready to run")
+    time_queued: float = Field(title="Time when the task was added to queue")
 
 class PendingTasksResponse(BaseModel):
     size: int = Field(title="Pending task size")
-    tasks: List[str] = Field(title="Pending task ids")
+    tasks: List[str] = Field(title="Pending task ids", description="in the order they are going to run")
+    current_task: str = Field(default=None, title="Task that is running now")
+    details: List[PendingTaskItem] = Field(default=[], title="Pending tasks with their scheduling information")
 
 class ProgressRequest(BaseModel):
     id_task: str = Field(default=None, title="Task ID", description="id of the task to get progress for")
@@ -75,13 +106,71 @@ class ProgressResponse(BaseModel):
 
 def setup_progress_api(app):
     app.add_api_route("/internal/pending-tasks", get_pending_tasks, methods=["GET"])
+    app.add_api_route("/internal/progress/stream", progress_stream_api, methods=["GET"])
     return app.add_api_route("/internal/progress", progressapi, methods=["POST"], response_model=ProgressResponse)
 
 
 def get_pending_tasks():
-    pending_tasks_ids = list(pending_tasks)
+    pending_tasks_ids = get_queue()
     pending_len = len(pending_tasks_ids)
-    return PendingTasksResponse(size=pending_len, tasks=pending_tasks_ids)
+
+    from modules import call_queue
+    waiters = {waiter.id_task: waiter for waiter in call_queue.queue_lock.queue()} if isinstance(call_queue.queue_lock, queue_scheduler.SchedulingLock) else {}
+
+    details = []
+    for id_task in pending_tasks_ids:
+        waiter = waiters.get(id_task)
+        if waiter is not None:
+            details.append(PendingTaskItem(id_task=id_task, user=waiter.user, priority=waiter.priority, waiting=True, time_queued=pending_tasks.get(id_task, waiter.time_queued)))
+        else:
+            details.append(PendingTaskItem(id_task=id_task, waiting=False, time_queued=pending_tasks.get(id_task, 0)))
+
+    return PendingTasksResponse(size=pending_len, tasks=pending_tasks_ids, current_task=current_task, details=details)
+
+
+def queue_textinfo(id_task):
+    queued = get_queue()
+    if id_task not in queued:
+        return "Waiting..."
+
+    return "In queue: {}/{}".format(queued.index(id_task) + 1, len(queued))
+
+
+def get_live_preview():
+    """returns a tuple of (id_live_preview, data: uri) for the current live preview; the image is encoded only once for every new preview regardless of how many clients ask for it"""
+
+    global live_preview_encoded, live_preview_key
+
+    with live_preview_lock:
+        id_live_preview = shared.state.id_live_preview
+
+        # preview ids start from 0 for every job, so the job is a part of the key
+        key = (shared.state.job_timestamp, shared.state.time_start, id_live_preview)
+        if live_preview_key == key:
+            return live_preview_encoded
+
+        image = shared.state.current_image
+        if image is None:
+            return id_live_preview, None
+
+        buffered = io.BytesIO()
+
+        if opts.live_previews_image_format == "png":
+            # using optimize for large images takes an enormous amount of time
+            if max(*image.size) <= 256:
+                save_kwargs = {"optimize": True}
+            else:
+                save_kwargs = {"optimize": False, "compress_level": 1}
+
+        else:
+            save_kwargs = {}
+
+        image.save(buffered, format=opts.live_previews_image_format, **save_kwargs)
+        base64_image = base64.b64encode(buffered.getvalue()).decode('ascii')
+        live_preview_encoded = (id_live_preview, f"data:image/{opts.live_previews_image_format};base64,{base64_image}")
+        live_preview_key = key
+
+        return live_preview_encoded
 
 
 def progressapi(req: ProgressRequest):
@@ -90,11 +179,7 @@ def progressapi(req: ProgressRequest):
     completed = req.id_task in finished_tasks
 
     if not active:
-        textinfo = "Waiting..."
-        if queued:
-            sorted_queued = sorted(pending_tasks.keys(), key=lambda x: pending_tasks[x])
-            queue_index = sorted_queued.index(req.id_task)
-            textinfo = "In queue: {}/{}".format(queue_index + 1, len(sorted_queued))
+        textinfo = queue_textinfo(req.id_task)
         return ProgressResponse(active=active, queued=queued, completed=completed, id_live_preview=-1, textinfo=textinfo)
 
     progress = 0
@@ -119,26 +204,63 @@ def progressapi(req: ProgressRequest):
     if opts.live_previews_enable and req.live_preview:
         shared.state.set_current_image()
         if shared.state.id_live_preview != req.id_live_preview:
-            image = shared.state.current_image
-            if image is not None:
-                buffered = io.BytesIO()
+            preview_id, preview = get_live_preview()
+            if preview is not None:
+                live_preview = preview
+                id_live_preview = preview_id
+
+    return ProgressResponse(active=active, queued=queued, completed=completed, progress=progress, eta=eta, live_preview=live_preview, id_live_preview=id_live_preview, textinfo=shared.state.textinfo)
 
-                if opts.live_previews_image_format == "png":
-                    # using optimize for large images takes an enormous amount of time
-                    if max(*image.size) <= 256:
-                        save_kwargs = {"optimize": True}
-                    else:
-                        save_kwargs = {"optimize": False, "compress_level": 1}
 
-                else:
-                    save_kwargs = {}
+def progress_stream_api(id_task: str, live_preview: bool = True):
+    """
+    Streams progress of a task as server-sent events instead of making the client poll /internal/progress.
 
-                image.save(buffered, format=opts.live_previews_image_format, **save_kwargs)
-                base64_image = base64.b64encode(buffered.getvalue()).decode('ascii')
-                live_preview = f"data:image/{opts.live_previews_image_format};base64,{base64_image}"
-                id_live_preview = shared.state.id_live_preview
+    Every event is a JSON object with only the fields of ProgressResponse that have changed since the previous event,
+    plus queue_position while the task is queued. Live preview is sent only when there is a new one. The stream ends
+    once the task is completed, or if the task is not known: not queued, running or finished, for example because its
+    id is wrong or it has finished too long ago to be remembered.
+    """
 
-    return ProgressResponse(active=active, queued=queued, completed=completed, progress=progress, eta=eta, live_preview=live_preview, id_live_preview=id_live_preview, textinfo=shared.state.textinfo)
+    async def events():
+        last = {}
+        id_live_preview = -1
+        was_active = False
+        was_seen = False
+        started = time.time()
+
+        while True:
+            req = ProgressRequest(id_task=id_task, id_live_preview=id_live_preview, live_preview=live_preview)
+            res = await run_in_threadpool(progressapi, req)
+
+            current = res.dict()
+            if res.queued:
+                queued = get_queue()
+                current["queue_position"] = queued.index(id_task) if id_task in queued else None
+
+            if current.get("live_preview") is None:
+                current.pop("live_preview")
+                current["id_live_preview"] = id_live_preview
+
+            delta = {k: v for k, v in current.items() if k == "live_preview" or last.get(k) != v}
+            if delta:
+                yield f"data: {json.dumps(delta)}\n\n"
+
+            last.update(current)
+            id_live_preview = current["id_live_preview"]
+            was_active = was_active or res.active
+            was_seen = was_seen or res.queued or res.active
+
+            if res.completed or (was_active and not res.active):
+                break
+
+            unknown = not res.queued and not res.active
+            if unknown and (was_seen or any(x[0] == id_task for x in recorded_results) or time.time() - started > unknown_task_timeout):
+                break
+
+            await asyncio.sleep(max(opts.live_preview_refresh_period, 100) / 1000)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 
 def restore_progress(id_task):
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import functools
 import re
 from collections import namedtuple
 import lark
@@ -63,6 +64,18 @@ def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=N
     [[5, 'a  c'], [10, 'a b c']]
     """
 
+    promptdict = {prompt: [list(x) for x in get_prompt_schedule(prompt, base_steps, hires_steps, use_old_scheduling)] for prompt in set(prompts)}
+    return [promptdict[prompt] for prompt in prompts]
+
+
+@functools.lru_cache(maxsize=4096)
+def get_prompt_schedule(prompt, base_steps, hires_steps=None, use_old_scheduling=False):
+    """
+    Returns the schedule for a single prompt as a tuple of (step, text) pairs. Results are memoized, so a prompt is only parsed
+    once for each combination of steps and scheduling mode. Prompts that have no colons or pipes after the first square bracket
+    can't have scheduling or alternation, so they skip the parser entirely.
+    """
+
     if hires_steps is None or use_old_scheduling:
         int_offset = 0
         flt_offset = 0
@@ -119,18 +132,19 @@ def get_learned_conditioning_prompt_schedules(prompts, base_steps, hires_steps=N
                     yield child
         return AtStep().transform(tree)
 
-    def get_schedule(prompt):
-        try:
-            tree = schedule_parser.parse(prompt)
-        except lark.exceptions.LarkError:
-            if 0:
-                import traceback
-                traceback.print_exc()
-            return [[steps, prompt]]
-        return [[t, at_step(t, tree)] for t in collect_steps(steps, tree)]
-
-    promptdict = {prompt: get_schedule(prompt) for prompt in set(prompts)}
-    return [promptdict[prompt] for prompt in prompts]
+    bracket = prompt.find('[')
+    if bracket == -1 or (':' not in prompt[bracket:] and '|' not in prompt[bracket:]):
+        return ((steps, prompt), )
+
+    try:
+        tree = schedule_parser.parse(prompt)
+    except lark.exceptions.LarkError:
+        if 0:
+            import traceback
+            traceback.print_exc()
+        return ((steps, prompt), )
+
+    return tuple((t, at_step(t, tree)) for t in collect_steps(steps, tree))
 
 
 ScheduledPromptConditioning = namedtuple("ScheduledPromptConditioning", ["end_at_step", "cond"])
@@ -141,7 +155,7 @@ class SdConditioning(list):
     A list with prompts for stable diffusion's conditioner model.
     Can also specify width and height of created image - SDXL needs it.
     """
-    def __init__(self, prompts, is_negative_prompt=False, width=None, height=None, copy_from=None):
+    def __init__(self, prompts, is_negative_prompt=False, width=None, height=None, copy_from=None, cache_key=None):
         super().__init__()
         self.extend(prompts)
 
@@ -152,6 +166,13 @@ class SdConditioning(list):
         self.width = width or getattr(copy_from, 'width', None)
         self.height = height or getattr(copy_from, 'height', None)
 
+        # if set, results of encoding these prompts are stored in the process-wide cache (modules.cond_cache) under this key;
+        # it must cover everything that affects the result, other than the prompt text and step schedule
+        self.cache_key = cache_key or getattr(copy_from, 'cache_key', None)
+
+        # if set, the list holds texts of multiple prompts one after another, and this is the number of texts for each prompt
+        self.segments = None
+
 
 
 def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps, hires_steps=None, use_old_scheduling=False):
@@ -172,34 +193,95 @@ def get_learned_conditioning(model, prompts: SdConditioning | list[str], steps,
         ]
     ]
     """
-    res = []
+    from modules import cond_cache
 
     prompt_schedules = get_learned_conditioning_prompt_schedules(prompts, steps, hires_steps, use_old_scheduling)
     cache = {}
+    missing = {}
 
-    for prompt, prompt_schedule in zip(prompts, prompt_schedules):
+    cache_key = getattr(prompts, 'cache_key', None)
+    if cache_key is not None and cond_cache.cache.limit <= 0:
+        cache_key = None
 
-        cached = cache.get(prompt, None)
-        if cached is not None:
-            res.append(cached)
+    for prompt, prompt_schedule in zip(prompts, prompt_schedules):
+        if prompt in cache or prompt in missing:
             continue
 
-        texts = SdConditioning([x[1] for x in prompt_schedule], copy_from=prompts)
+        if cache_key is not None:
+            cached = cond_cache.cache.get((cache_key, prompt, steps, hires_steps, use_old_scheduling))
+            if cached is not None:
+                cache[prompt] = cached
+                continue
+
+        missing[prompt] = prompt_schedule
+
+    for group in group_prompts_for_encoding(model, missing):
+        texts = SdConditioning([x[1] for prompt in group for x in missing[prompt]], copy_from=prompts)
+        texts.segments = [len(missing[prompt]) for prompt in group]
         conds = model.get_learned_conditioning(texts)
 
-        cond_schedule = []
-        for i, (end_at_step, _) in enumerate(prompt_schedule):
-            if isinstance(conds, dict):
-                cond = {k: v[i] for k, v in conds.items()}
-            else:
-                cond = conds[i]
+        i = 0
+        for prompt in group:
+            cond_schedule = []
+            for end_at_step, _ in missing[prompt]:
+                if isinstance(conds, dict):
+                    cond = {k: v[i] for k, v in conds.items()}
+                else:
+                    cond = conds[i]
 
-            cond_schedule.append(ScheduledPromptConditioning(end_at_step, cond))
+                cond_schedule.append(ScheduledPromptConditioning(end_at_step, cond))
+                i += 1
 
-        cache[prompt] = cond_schedule
-        res.append(cond_schedule)
+            cache[prompt] = cond_schedule
 
-    return res
+            if cache_key is not None:
+                cond_cache.cache.put((cache_key, prompt, steps, hires_steps, use_old_scheduling), cond_schedule)
+
+    return [cache[prompt] for prompt in prompts]
+
+
+def group_prompts_for_encoding(model, prompt_schedules):
+    """
+    Splits prompts (keys of prompt_schedules dict) into groups such that all texts from all schedules of prompts in a group
+    can be passed to the text encoder in one call without changing the result: they are padded to the same number of
+    chunks, and they agree on whether the negative prompt is entirely empty (SDXL zeroes those).
+    """
+
+    if len(prompt_schedules) <= 1:
+        return [list(prompt_schedules)] if prompt_schedules else []
+
+    groups = {}
+    for prompt, prompt_schedule in prompt_schedules.items():
+        texts = [x[1] for x in prompt_schedule]
+        chunk_counts = get_chunk_counts(model, texts)
+        key = (chunk_counts, all(x == '' for x in texts)) if chunk_counts is not None else (None, prompt)
+
+        groups.setdefault(key, []).append(prompt)
+
+    return list(groups.values())
+
+
+def get_chunk_counts(model, texts):
+    """returns the number of 75-token chunks that each text encoder of the model will use for texts, or None if it can't be determined"""
+
+    from modules import shared
+
+    if shared.opts.use_old_emphasis_implementation:
+        return None
+
+    conditioner = getattr(model, 'conditioner', None)
+    embedders = conditioner.embedders if conditioner is not None else [getattr(model, 'cond_stage_model', None)]
+
+    res = []
+    for embedder in embedders:
+        process_texts = getattr(embedder, 'process_texts', None)
+        if process_texts is None:
+            continue
+
+        batch_chunks, _ = process_texts(texts)
+        res.append(max(len(x) for x in batch_chunks))
+
+    return tuple(res) or None
 
 
 re_AND = re.compile(r"\bAND\b")
@@ -403,6 +485,16 @@ def parse_prompt_attention(text):
      ['.', 1.1]]
     """
 
+    return [list(x) for x in parse_prompt_attention_cached(text)]
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_prompt_attention_cached(text):
+    """same as parse_prompt_attention, but memoized, and returns a tuple of tuples; text without any special characters is returned as is"""
+
+    if not any(c in text for c in '\\()[]') and 'BREAK' not in text:
+        return ((text, 1.0), )
+
     res = []
     round_brackets = []
     square_brackets = []
@@ -455,7 +547,7 @@ def parse_prompt_attention(text):
         else:
             i += 1
 
-    return res
+    return tuple(tuple(x) for x in res)
 
 if __name__ == "__main__":
     import doctest
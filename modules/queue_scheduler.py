@@ -0,0 +1,216 @@
+import contextvars
+import itertools
+import threading
+import time
+
+from modules import shared
+
+priorities = {"high": 0, "normal": 1, "low": 2}
+default_priority = "normal"
+
+negligible_usage = 0.01
+"""users whose decayed usage, in seconds, falls below this are forgotten, so that usage records do not grow without bound"""
+
+identity = contextvars.ContextVar("queue_identity", default=None)
+"""(user, priority) of the request being handled in the current context; set by API middleware and by wrap_gradio_gpu_call"""
+
+task_id = contextvars.ContextVar("queue_task_id", default=None)
+"""id of the task that is about to wait for the queue lock in the current context; set by progress.add_task_to_queue"""
+
+state_fields = [
+    "skipped", "interrupted", "stopping_generation", "job", "job_no", "job_count", "processing_has_refined_job_count", "job_timestamp",
+    "sampling_step", "sampling_steps", "current_latent", "current_image", "current_image_sampling_step", "textinfo", "time_start",
+]
+"""fields of shared.state that belong to the job holding the queue lock, and are restored when the job is resumed after preemption"""
+
+
+def set_identity(user=None, priority=None):
+    if priority not in priorities:
+        priority = default_priority
+
+    identity.set((user, priority))
+
+
+def get_identity():
+    return identity.get() or (None, default_priority)
+
+
+class Waiter:
+    def __init__(self, user, priority, id_task, seq):
+        self.user = user
+        self.priority = priority
+        self.id_task = id_task
+        self.seq = seq
+        self.time_queued = time.time()
+        self.event = threading.Event()
+        self.thread = threading.get_ident()
+
+
+class SchedulingLock:
+    """
+    A lock for the generation queue that, when released, is handed to the waiting thread whose request has the highest
+    priority class; among equal priorities, to the one whose user has held the lock the least recently (fair share,
+    measured as holding time that decays with a half-life set in settings); and then in order of arrival. With a single
+    user and priority, it works the same as FIFOLock.
+
+    Used as a drop-in replacement of FIFOLock: identity of the waiting request is taken from context variables.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seq = itertools.count()
+        self.waiters = []
+        self.owner = None
+        self.acquired_at = None
+
+        self.usage = {}
+        """user -> (seconds of holding the lock, time when it was last updated)"""
+
+    def get_usage(self, user, now):
+        seconds, updated = self.usage.get(user, (0.0, now))
+
+        half_life = shared.opts.queue_fair_share_half_life
+        if half_life > 0:
+            seconds *= 0.5 ** ((now - updated) / half_life)
+
+        if self.owner is not None and self.owner.user == user:
+            seconds += now - self.acquired_at
+
+        return seconds
+
+    def sort_key(self, waiter, now):
+        usage = self.get_usage(waiter.user, now) if shared.opts.queue_fair_share else 0
+
+        return priorities.get(waiter.priority, priorities[default_priority]), usage, waiter.seq
+
+    def _take(self, waiter):
+        self.owner = waiter
+        self.acquired_at = time.time()
+
+    def _hand_over(self, now):
+        """records usage for the current owner, and gives the lock to the next waiter if there is one; must be called with self._lock held"""
+
+        owner = self.owner
+        self.usage[owner.user] = (self.get_usage(owner.user, now), now)
+        self.owner = None
+
+        for user in list(self.usage):
+            if self.get_usage(user, now) < negligible_usage:
+                del self.usage[user]
+
+        if self.waiters:
+            waiter = min(self.waiters, key=lambda x: self.sort_key(x, now))
+            self.waiters.remove(waiter)
+            self._take(waiter)
+            waiter.event.set()
+
+    def acquire(self, blocking=True):
+        user, priority = get_identity()
+
+        with self._lock:
+            waiter = Waiter(user, priority, task_id.get(), next(self.seq))
+
+            if self.owner is None and not self.waiters:
+                self._take(waiter)
+                return True
+            elif not blocking:
+                return False
+
+            self.waiters.append(waiter)
+
+        waiter.event.wait()
+        return True
+
+    def release(self):
+        with self._lock:
+            self._hand_over(time.time())
+
+    def _should_yield(self, now):
+        owner = self.owner
+        if owner is None or owner.thread != threading.get_ident() or not self.waiters:
+            return False
+
+        return min(self.sort_key(x, now) for x in self.waiters) < self.sort_key(owner, now)
+
+    def should_yield(self):
+        """returns True if the lock is held by the current thread and a waiting request should go before it"""
+
+        with self._lock:
+            return self._should_yield(time.time())
+
+    def yield_to_waiters(self):
+        """
+        If a waiting request should go before the current owner, gives it the lock, and waits to get the lock back,
+        keeping the current owner's original place in queue. Returns True if the lock was given away.
+        """
+
+        with self._lock:
+            now = time.time()
+            if not self._should_yield(now):
+                return False
+
+            owner = self.owner
+            owner.event = threading.Event()
+            self._hand_over(now)
+            self.waiters.append(owner)
+
+        owner.event.wait()
+        return True
+
+    def queue(self):
+        """returns waiters in the order they will get the lock, if no new requests arrive"""
+
+        with self._lock:
+            now = time.time()
+            return sorted(self.waiters, key=lambda x: self.sort_key(x, now))
+
+    __enter__ = acquire
+
+    def __exit__(self, t, v, tb):
+        self.release()
+
+
+def preemption_point(prepare=None):
+    """
+    Called by long jobs between their units of work, such as batch iterations in process_images_inner or cells of X/Y/Z
+    plot. If preemption is enabled in settings and the queue lock is held by the current thread, lets a waiting request
+    that should go before the current job run, and waits for it to finish. Returns True if that happened; the caller must
+    then restore any global state it depends on that the other job might have changed.
+
+    If prepare is given, it's called right before the lock is given away, to put global settings that the current job
+    has changed back to what other jobs expect.
+    """
+
+    from modules import call_queue, progress
+
+    lock = call_queue.queue_lock
+    if not shared.opts.queue_preemption or not isinstance(lock, SchedulingLock) or not lock.should_yield():
+        return False
+
+    if prepare is not None:
+        prepare()
+
+    saved_state = {k: getattr(shared.state, k) for k in state_fields}
+    saved_task = progress.current_task
+
+    if not lock.yield_to_waiters():
+        return False
+
+    for k, v in saved_state.items():
+        setattr(shared.state, k, v)
+
+    progress.start_task(saved_task)
+
+    return True
+
+
+def pending_order(pending_tasks):
+    """returns ids of pending tasks in the order they will run: ones waiting for the queue lock in scheduling order, then the rest in order of arrival"""
+
+    from modules import call_queue
+
+    lock = call_queue.queue_lock
+    waiting = [waiter.id_task for waiter in lock.queue() if waiter.id_task in pending_tasks] if isinstance(lock, SchedulingLock) else []
+    waiting_set = set(waiting)
+
+    return waiting + [x for x in pending_tasks if x not in waiting_set]
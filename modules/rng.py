@@ -1,7 +1,14 @@
+from collections import OrderedDict
+
 import torch
 
 from modules import devices, rng_philox, shared
 
+noise_cache = OrderedDict()
+"""parameters of ImageRNG -> (noise it made on first call, states of its generators after that) for recently made noise; oldest first"""
+
+noise_cache_limit = 8
+
 
 def randn(seed, shape, generator=None):
     """Generate a tensor with random numbers from a normal distribution using seed.
@@ -96,6 +103,22 @@ def slerp(val, low, high):
     return res
 
 
+def paste_resized(x, noise):
+    """places noise generated for a different resolution into the center of x, as done for "Resize seed from" """
+
+    dx = (x.shape[2] - noise.shape[2]) // 2
+    dy = (x.shape[1] - noise.shape[1]) // 2
+    w = noise.shape[2] if dx >= 0 else noise.shape[2] + 2 * dx
+    h = noise.shape[1] if dy >= 0 else noise.shape[1] + 2 * dy
+    tx = 0 if dx < 0 else dx
+    ty = 0 if dy < 0 else dy
+    dx = max(-dx, 0)
+    dy = max(-dy, 0)
+
+    x[:, ty:ty + h, tx:tx + w] = noise[:, dy:dy + h, dx:dx + w]
+    return x
+
+
 class ImageRNG:
     def __init__(self, shape, seeds, subseeds=None, subseed_strength=0.0, seed_resize_from_h=0, seed_resize_from_w=0):
         self.shape = tuple(map(int, shape))
@@ -109,9 +132,90 @@ class ImageRNG:
 
         self.is_first = True
 
+    def noise_cache_key(self, noise_shape):
+        subseeds = tuple(self.subseeds) if self.subseeds is not None and self.subseed_strength != 0 else None
+
+        return shared.opts.randn_source, str(devices.device), self.shape, noise_shape, tuple(self.seeds), subseeds, self.subseed_strength
+
+    def get_generator_states(self):
+        return [g.offset if isinstance(g, rng_philox.Generator) else g.get_state() for g in self.generators]
+
+    def set_generator_states(self, states):
+        for generator, state in zip(self.generators, states):
+            if isinstance(generator, rng_philox.Generator):
+                generator.offset = state
+            else:
+                generator.set_state(state)
+
     def first(self):
         noise_shape = self.shape if self.seed_resize_from_h <= 0 or self.seed_resize_from_w <= 0 else (self.shape[0], int(self.seed_resize_from_h) // 8, int(self.seed_resize_from_w // 8))
 
+        # noise for the same seeds is often made again, for example by X/Y/Z plot or when upscaling a result with hires fix
+        cache_key = self.noise_cache_key(noise_shape)
+        cached = noise_cache.get(cache_key)
+
+        if cached is not None:
+            noise_cache.move_to_end(cache_key)
+            res, states = cached
+            res = res.clone()
+
+            # leave generators in the same state as making the noise would; the global one is always left seeded with the last seed
+            self.set_generator_states(states)
+            manual_seed(self.seeds[-1])
+        elif shared.opts.randn_source == "NV":
+            res = self.first_philox(noise_shape)
+        else:
+            res = self.first_torch(noise_shape)
+
+        if cached is None:
+            noise_cache[cache_key] = (res.clone(), self.get_generator_states())
+            while len(noise_cache) > noise_cache_limit:
+                noise_cache.popitem(last=False)
+
+        eta_noise_seed_delta = shared.opts.eta_noise_seed_delta or 0
+        if eta_noise_seed_delta:
+            self.generators = [create_generator(seed + eta_noise_seed_delta) for seed in self.seeds]
+
+        return res
+
+    def first_philox(self, noise_shape):
+        """
+        Makes first noise for NV RNG source: the same as first_torch, but generates numbers for all seeds and subseeds in
+        one vectorized call each, and copies them to device at once.
+        """
+
+        noise = torch.asarray(rng_philox.randn_seeds(self.seeds, 0, noise_shape), device=devices.device)
+
+        subnoise = None
+        if self.subseeds is not None and self.subseed_strength != 0:
+            subseeds = [0 if i >= len(self.subseeds) else self.subseeds[i] for i in range(len(self.seeds))]
+            subnoise = torch.asarray(rng_philox.randn_seeds(subseeds, 0, noise_shape), device=devices.device)
+
+        resized = noise_shape != self.shape
+        if resized:
+            x = torch.asarray(rng_philox.randn_seeds(self.seeds, 0, self.shape), device=devices.device)
+
+        xs = []
+        for i in range(len(self.seeds)):
+            image_noise = noise[i]
+
+            if subnoise is not None:
+                image_noise = slerp(self.subseed_strength, image_noise, subnoise[i])
+
+            if resized:
+                image_noise = paste_resized(x[i], image_noise)
+
+            xs.append(image_noise)
+
+        for generator in self.generators:
+            generator.offset = 1
+
+        # first_torch leaves the global generator seeded with the last seed
+        manual_seed(self.seeds[-1])
+
+        return torch.stack(xs).to(shared.device)
+
+    def first_torch(self, noise_shape):
         xs = []
 
         for i, (seed, generator) in enumerate(zip(self.seeds, self.generators)):
@@ -129,25 +233,10 @@ class ImageRNG:
                 noise = slerp(self.subseed_strength, noise, subnoise)
 
             if noise_shape != self.shape:
-                x = randn(seed, self.shape, generator=generator)
-                dx = (self.shape[2] - noise_shape[2]) // 2
-                dy = (self.shape[1] - noise_shape[1]) // 2
-                w = noise_shape[2] if dx >= 0 else noise_shape[2] + 2 * dx
-                h = noise_shape[1] if dy >= 0 else noise_shape[1] + 2 * dy
-                tx = 0 if dx < 0 else dx
-                ty = 0 if dy < 0 else dy
-                dx = max(-dx, 0)
-                dy = max(-dy, 0)
-
-                x[:, ty:ty + h, tx:tx + w] = noise[:, dy:dy + h, dx:dx + w]
-                noise = x
+                noise = paste_resized(randn(seed, self.shape, generator=generator), noise)
 
             xs.append(noise)
 
-        eta_noise_seed_delta = shared.opts.eta_noise_seed_delta or 0
-        if eta_noise_seed_delta:
-            self.generators = [create_generator(seed + eta_noise_seed_delta) for seed in self.seeds]
-
         return torch.stack(xs).to(shared.device)
 
     def next(self):
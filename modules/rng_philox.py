@@ -25,8 +25,8 @@ two_pow32_inv_2pi = np.array([2.3283064e-10 * 6.2831855], dtype=np.float32)
 
 
 def uint32(x):
-    """Converts (N,) np.uint64 array into (2, N) np.unit32 array."""
-    return x.view(np.uint32).reshape(-1, 2).transpose(1, 0)
+    """Converts np.uint64 array of any shape into np.uint32 array with an extra first dimension of size 2 for low and high halves."""
+    return np.moveaxis(x.view(np.uint32).reshape(x.shape + (2,)), -1, 0)
 
 
 def philox4_round(counter, key):
@@ -49,6 +49,9 @@ def philox4_32(counter, key, rounds=10):
         key (numpy.ndarray): A 2xN array of 32-bit integers representing the key values (seed).
         rounds (int): The number of rounds to perform.
 
+    Both arrays can have more dimensions after the first one, as long as key broadcasts to counter: for example, 4xSxN counter
+    and 2xSx1 key to generate numbers for S seeds at once.
+
     Returns:
         numpy.ndarray: A 4xN array of 32-bit integers containing the generated random numbers.
     """
@@ -74,6 +77,28 @@ def box_muller(x, y):
     return r1.astype(np.float32)
 
 
+def randn_seeds(seeds, offset, shape):
+    """
+    Generates normal random numbers for all seeds at once: returns an array of shape (len(seeds), *shape), where every
+    element along the first dimension is the same as Generator(seed).randn(shape) at the given offset would return.
+    """
+
+    n = 1
+    for x in shape:
+        n *= x
+
+    counter = np.zeros((4, len(seeds), n), dtype=np.uint32)
+    counter[0] = offset
+    counter[2] = np.arange(n, dtype=np.uint32)  # up to 2^32 numbers can be generated - if you want more you'd need to spill into counter[3]
+
+    # key is the same for all numbers of a seed, so it's broadcast rather than repeated n times
+    key = uint32(np.array(seeds, dtype=np.uint64).reshape(-1, 1))
+
+    g = philox4_32(counter, key)
+
+    return box_muller(g[0], g[1]).reshape((len(seeds),) + tuple(shape))  # discard g[2] and g[3]
+
+
 class Generator:
     """RNG that produces same outputs as torch.randn(..., device='cuda') on CPU"""
 
@@ -84,19 +109,7 @@ class Generator:
     def randn(self, shape):
         """Generate a sequence of n standard normal random variables using the Philox 4x32 random number generator and the Box-Muller transform."""
 
-        n = 1
-        for x in shape:
-            n *= x
-
-        counter = np.zeros((4, n), dtype=np.uint32)
-        counter[0] = self.offset
-        counter[2] = np.arange(n, dtype=np.uint32)  # up to 2^32 numbers can be generated - if you want more you'd need to spill into counter[3]
+        res = randn_seeds([self.seed], self.offset, shape)[0]
         self.offset += 1
 
-        key = np.empty(n, dtype=np.uint64)
-        key.fill(self.seed)
-        key = uint32(key)
-
-        g = philox4_32(counter, key)
-
-        return box_muller(g[0], g[1]).reshape(shape)  # discard g[2] and g[3]
+        return res
@@ -207,7 +207,8 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         An example shape returned by this function can be: (2, 77, 768).
         For SDXL, instead of returning one tensor avobe, it returns a tuple with two: the other one with shape (B, 1280) with pooled values.
         Webui usually sends just one text at a time through this function - the only time when texts is an array with more than one elemenet
-        is when you do prompt editing: "a picture of a [cat:dog:0.4] eating ice cream"
+        is when you do prompt editing: "a picture of a [cat:dog:0.4] eating ice cream", or when prompt_parser.get_learned_conditioning
+        encodes multiple prompts at once; in latter case texts.segments has the number of texts that belong to each prompt.
         """
 
         if opts.use_old_emphasis_implementation:
@@ -219,20 +220,16 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         used_embeddings = {}
         chunk_count = max([len(x) for x in batch_chunks])
 
-        zs = []
+        batch_chunk_groups = []
         for i in range(chunk_count):
             batch_chunk = [chunks[i] if i < len(chunks) else self.empty_chunk() for chunks in batch_chunks]
+            batch_chunk_groups.append(batch_chunk)
 
-            tokens = [x.tokens for x in batch_chunk]
-            multipliers = [x.multipliers for x in batch_chunk]
-            self.hijack.fixes = [x.fixes for x in batch_chunk]
-
-            for fixes in self.hijack.fixes:
-                for _position, embedding in fixes:
+            for chunk in batch_chunk:
+                for _position, embedding in chunk.fixes:
                     used_embeddings[embedding.name] = embedding
 
-            z = self.process_tokens(tokens, multipliers)
-            zs.append(z)
+        zs = self.process_chunk_groups(batch_chunk_groups, getattr(texts, 'segments', None))
 
         if opts.textual_inversion_add_hashes_to_infotext and used_embeddings:
             hashes = []
@@ -257,6 +254,43 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         else:
             return torch.hstack(zs)
 
+    def process_chunk_groups(self, batch_chunk_groups, segments=None):
+        """
+        sends all prompt chunks to be encoded by transformers neural network in one batch, and returns a list of tensors, one for
+        each element of batch_chunk_groups - same as calling process_tokens on each of them would, but without running
+        the network once per chunk.
+        batch_chunk_groups is a list where i-th element has i-th PromptChunk of every text. segments, if specified, is a list
+        of numbers of consecutive texts that come from one prompt; emphasis is applied to each of those separately, so that
+        results don't depend on what other prompts were encoded together.
+        """
+        batch_size = len(batch_chunk_groups[0])
+        rows = [chunk for batch_chunk in batch_chunk_groups for chunk in batch_chunk]
+
+        self.hijack.fixes = [x.fixes for x in rows]
+        z_all = self.encode_tokens([x.tokens for x in rows])
+        pooled = getattr(z_all, 'pooled', None)
+
+        zs = []
+        for i, batch_chunk in enumerate(batch_chunk_groups):
+            start = i * batch_size
+            z = z_all[start:start + batch_size]
+
+            parts = []
+            position = 0
+            for count in segments or [batch_size]:
+                chunks = batch_chunk[position:position + count]
+                parts.append(self.apply_emphasis(z[position:position + count], [x.tokens for x in chunks], [x.multipliers for x in chunks]))
+                position += count
+
+            z = parts[0] if len(parts) == 1 else torch.cat(parts)
+
+            if pooled is not None:
+                z.pooled = pooled[start:start + batch_size]
+
+            zs.append(z)
+
+        return zs
+
     def process_tokens(self, remade_batch_tokens, batch_multipliers):
         """
         sends one single prompt chunk to be encoded by transformers neural network.
@@ -265,6 +299,21 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         Multipliers are used to give more or less weight to the outputs of transformers network. Each multiplier
         corresponds to one token.
         """
+
+        z = self.encode_tokens(remade_batch_tokens)
+
+        pooled = getattr(z, 'pooled', None)
+
+        z = self.apply_emphasis(z, remade_batch_tokens, batch_multipliers)
+
+        if pooled is not None:
+            z.pooled = pooled
+
+        return z
+
+    def encode_tokens(self, remade_batch_tokens):
+        """runs transformers network on a batch of tokens; self.hijack.fixes must have textual inversion fixes for each element of the batch"""
+
         tokens = torch.asarray(remade_batch_tokens).to(devices.device)
 
         # this is for SD2: SD1 uses the same token for padding and end of text, while SD2 uses different ones.
@@ -273,9 +322,10 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
                 index = remade_batch_tokens[batch_pos].index(self.id_end)
                 tokens[batch_pos, index+1:tokens.shape[1]] = self.id_pad
 
-        z = self.encode_with_transformers(tokens)
+        return self.encode_with_transformers(tokens)
 
-        pooled = getattr(z, 'pooled', None)
+    def apply_emphasis(self, z, remade_batch_tokens, batch_multipliers):
+        """applies weights from batch_multipliers to output of transformers network for one prompt chunk, using currently selected emphasis mode"""
 
         emphasis = sd_emphasis.get_current_option(opts.emphasis)()
         emphasis.tokens = remade_batch_tokens
@@ -284,12 +334,7 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
 
         emphasis.after_transformers()
 
-        z = emphasis.z
-
-        if pooled is not None:
-            z.pooled = pooled
-
-        return z
+        return emphasis.z
 
 
 class FrozenCLIPEmbedderWithCustomWords(FrozenCLIPEmbedderWithCustomWordsBase):
@@ -13,7 +13,7 @@ import ldm.modules.midas as midas
 
 from ldm.util import instantiate_from_config
 
-from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl, cache, extra_networks, processing, lowvram, sd_hijack, patches
+from modules import paths, shared, modelloader, devices, script_callbacks, sd_vae, sd_disable_initialization, errors, hashes, sd_models_config, sd_unet, sd_models_xl, cache, extra_networks, processing, lowvram, sd_hijack, patches, sd_models_residency, sd_models_streaming, sd_models_prefetch
 from modules.timer import Timer
 from modules.shared import opts
 import tomesd
@@ -27,6 +27,9 @@ checkpoint_aliases = {}
 checkpoint_alisases = checkpoint_aliases  # for compatibility with old name
 checkpoints_loaded = collections.OrderedDict()
 
+checkpoints_lock = threading.RLock()
+"""held while checkpoints_list and checkpoint_aliases are changed, which also happens in hashing threads, and while they are searched"""
+
 
 def replace_key(d, key, new_key, value):
     keys = list(d.keys())
@@ -93,30 +96,35 @@ class CheckpointInfo:
             self.ids += [self.shorthash, self.sha256, f'{self.name} [{self.shorthash}]', f'{self.name_for_extra} [{self.shorthash}]']
 
     def register(self):
-        checkpoints_list[self.title] = self
-        for id in self.ids:
-            checkpoint_aliases[id] = self
+        with checkpoints_lock:
+            checkpoints_list[self.title] = self
+            for id in self.ids:
+                checkpoint_aliases[id] = self
 
     def calculate_shorthash(self):
-        self.sha256 = hashes.sha256(self.filename, f"checkpoint/{self.name}")
-        if self.sha256 is None:
+        # the file is read without holding the lock; only the registration under new title is done with it
+        sha256 = hashes.sha256(self.filename, f"checkpoint/{self.name}")
+        if sha256 is None:
             return
 
-        shorthash = self.sha256[0:10]
-        if self.shorthash == self.sha256[0:10]:
-            return self.shorthash
+        with checkpoints_lock:
+            self.sha256 = sha256
 
-        self.shorthash = shorthash
+            shorthash = self.sha256[0:10]
+            if self.shorthash == self.sha256[0:10]:
+                return self.shorthash
 
-        if self.shorthash not in self.ids:
-            self.ids += [self.shorthash, self.sha256, f'{self.name} [{self.shorthash}]', f'{self.name_for_extra} [{self.shorthash}]']
+            self.shorthash = shorthash
 
-        old_title = self.title
-        self.title = f'{self.name} [{self.shorthash}]'
-        self.short_title = f'{self.name_for_extra} [{self.shorthash}]'
+            if self.shorthash not in self.ids:
+                self.ids += [self.shorthash, self.sha256, f'{self.name} [{self.shorthash}]', f'{self.name_for_extra} [{self.shorthash}]']
 
-        replace_key(checkpoints_list, old_title, self.title, self)
-        self.register()
+            old_title = self.title
+            self.title = f'{self.name} [{self.shorthash}]'
+            self.short_title = f'{self.name_for_extra} [{self.shorthash}]'
+
+            replace_key(checkpoints_list, old_title, self.title, self)
+            self.register()
 
         return self.shorthash
 
@@ -140,13 +148,11 @@ def setup_model():
 
 
 def checkpoint_tiles(use_short=False):
-    return [x.short_title if use_short else x.title for x in checkpoints_list.values()]
+    with checkpoints_lock:
+        return [x.short_title if use_short else x.title for x in checkpoints_list.values()]
 
 
 def list_models():
-    checkpoints_list.clear()
-    checkpoint_aliases.clear()
-
     cmd_ckpt = shared.cmd_opts.ckpt
     if shared.cmd_opts.no_download_sd_model or cmd_ckpt != shared.sd_model_file or os.path.exists(cmd_ckpt):
         model_url = None
@@ -155,17 +161,26 @@ def list_models():
 
     model_list = modelloader.load_models(model_path=model_path, model_url=model_url, command_path=shared.cmd_opts.ckpt_dir, ext_filter=[".ckpt", ".safetensors"], download_name="v1-5-pruned-emaonly.safetensors", ext_blacklist=[".vae.ckpt", ".vae.safetensors"])
 
-    if os.path.exists(cmd_ckpt):
-        checkpoint_info = CheckpointInfo(cmd_ckpt)
-        checkpoint_info.register()
+    with checkpoints_lock:
+        checkpoints_list.clear()
+        checkpoint_aliases.clear()
+
+        if os.path.exists(cmd_ckpt):
+            checkpoint_info = CheckpointInfo(cmd_ckpt)
+            checkpoint_info.register()
+
+            shared.opts.data['sd_model_checkpoint'] = checkpoint_info.title
+        elif cmd_ckpt is not None and cmd_ckpt != shared.default_sd_model_file:
+            print(f"Checkpoint in --ckpt argument not found (Possible it was moved to {model_path}: {cmd_ckpt}", file=sys.stderr)
+
+        for filename in model_list:
+            checkpoint_info = CheckpointInfo(filename)
+            checkpoint_info.register()
 
-        shared.opts.data['sd_model_checkpoint'] = checkpoint_info.title
-    elif cmd_ckpt is not None and cmd_ckpt != shared.default_sd_model_file:
-        print(f"Checkpoint in --ckpt argument not found (Possible it was moved to {model_path}: {cmd_ckpt}", file=sys.stderr)
+        unhashed = [x for x in checkpoints_list.values() if x.sha256 is None]
 
-    for filename in model_list:
-        checkpoint_info = CheckpointInfo(filename)
-        checkpoint_info.register()
+    if shared.opts.hash_models_in_background and not shared.cmd_opts.no_hashing:
+        hashes.calculate_in_background(CheckpointInfo.calculate_shorthash, unhashed)
 
 
 re_strip_checksum = re.compile(r"\s*\[[^]]+]\s*$")
@@ -175,18 +190,19 @@ def get_closet_checkpoint_match(search_string):
     if not search_string:
         return None
 
-    checkpoint_info = checkpoint_aliases.get(search_string, None)
-    if checkpoint_info is not None:
-        return checkpoint_info
+    with checkpoints_lock:
+        checkpoint_info = checkpoint_aliases.get(search_string, None)
+        if checkpoint_info is not None:
+            return checkpoint_info
 
-    found = sorted([info for info in checkpoints_list.values() if search_string in info.title], key=lambda x: len(x.title))
-    if found:
-        return found[0]
+        found = sorted([info for info in checkpoints_list.values() if search_string in info.title], key=lambda x: len(x.title))
+        if found:
+            return found[0]
 
-    search_string_without_checksum = re.sub(re_strip_checksum, '', search_string)
-    found = sorted([info for info in checkpoints_list.values() if search_string_without_checksum in info.title], key=lambda x: len(x.title))
-    if found:
-        return found[0]
+        search_string_without_checksum = re.sub(re_strip_checksum, '', search_string)
+        found = sorted([info for info in checkpoints_list.values() if search_string_without_checksum in info.title], key=lambda x: len(x.title))
+        if found:
+            return found[0]
 
     return None
 
@@ -210,11 +226,14 @@ def select_checkpoint():
     """Raises `FileNotFoundError` if no checkpoints are found."""
     model_checkpoint = shared.opts.sd_model_checkpoint
 
-    checkpoint_info = checkpoint_aliases.get(model_checkpoint, None)
-    if checkpoint_info is not None:
-        return checkpoint_info
+    with checkpoints_lock:
+        checkpoint_info = checkpoint_aliases.get(model_checkpoint, None)
+        if checkpoint_info is not None:
+            return checkpoint_info
 
-    if len(checkpoints_list) == 0:
+        checkpoint_info = next(iter(checkpoints_list.values()), None)
+
+    if checkpoint_info is None:
         error_message = "No checkpoints found. When searching for checkpoints, looked at:"
         if shared.cmd_opts.ckpt is not None:
             error_message += f"\n - file {os.path.abspath(shared.cmd_opts.ckpt)}"
@@ -224,7 +243,6 @@ def select_checkpoint():
         error_message += "Can't run without a checkpoint. Find and place a .ckpt or .safetensors file into any of those locations."
         raise FileNotFoundError(error_message)
 
-    checkpoint_info = next(iter(checkpoints_list.values()))
     if model_checkpoint is not None:
         print(f"Checkpoint {model_checkpoint} not found; loading fallback {checkpoint_info.title}", file=sys.stderr)
 
@@ -316,7 +334,22 @@ def read_state_dict(checkpoint_file, print_global_state=False, map_location=None
     return sd
 
 
+def uses_streaming_load(checkpoint_info: CheckpointInfo):
+    return shared.opts.sd_checkpoint_streaming_load and checkpoint_info.filename.lower().endswith(".safetensors")
+
+
+def read_checkpoint_state_dict(checkpoint_info: CheckpointInfo, map_location=None):
+    if uses_streaming_load(checkpoint_info):
+        return get_state_dict_from_checkpoint(sd_models_streaming.load_file(checkpoint_info.filename))
+
+    return read_state_dict(checkpoint_info.filename, map_location=map_location)
+
+
 def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
+    prefetched = sd_models_prefetch.take(checkpoint_info)
+    if prefetched is not None:
+        timer.record("wait for prefetch")
+
     sd_model_hash = checkpoint_info.calculate_shorthash()
     timer.record("calculate hash")
 
@@ -327,8 +360,12 @@ def get_checkpoint_state_dict(checkpoint_info: CheckpointInfo, timer):
         checkpoints_loaded.move_to_end(checkpoint_info)
         return checkpoints_loaded[checkpoint_info]
 
+    if prefetched is not None:
+        print(f"Loading weights [{sd_model_hash}] prefetched from {checkpoint_info.filename}")
+        return prefetched
+
     print(f"Loading weights [{sd_model_hash}] from {checkpoint_info.filename}")
-    res = read_state_dict(checkpoint_info.filename)
+    res = read_checkpoint_state_dict(checkpoint_info)
     timer.record("load weights from disk")
 
     return res
@@ -681,9 +718,12 @@ def send_model_to_device(m):
     if not m.lowvram:
         m.to(shared.device)
 
+    sd_models_residency.release_disk_file(m)
+
 
 def send_model_to_trash(m):
     m.to(device="meta")
+    sd_models_residency.release_disk_file(m)
     devices.torch_gc()
 
 
@@ -785,8 +825,12 @@ def reuse_model_from_already_loaded(sd_model, checkpoint_info, timer):
     If not, returns the model that can be used to load weights from checkpoint_info's file.
     If no such model exists, returns None.
     Additionaly deletes loaded models that are over the limit set in settings (sd_checkpoints_limit).
+    If memory budgets are set in settings, the limit is not used; see reuse_model_within_budgets.
     """
 
+    if sd_models_residency.enabled():
+        return reuse_model_within_budgets(sd_model, checkpoint_info, timer)
+
     already_loaded = None
     for i in reversed(range(len(model_data.loaded_sd_models))):
         loaded_model = model_data.loaded_sd_models[i]
@@ -837,6 +881,69 @@ def reuse_model_from_already_loaded(sd_model, checkpoint_info, timer):
         return None
 
 
+def reuse_model_within_budgets(sd_model, checkpoint_info, timer):
+    """
+    Same as reuse_model_from_already_loaded, but instead of keeping a fixed number of models, keeps all of them, and moves
+    least recently used ones from GPU to RAM, from RAM to disk, and off disk to fit into budgets set in settings. If the
+    checkpoint is not loaded and making room for it unloaded some model, returns that model to load weights into;
+    otherwise, the checkpoint is loaded as a new model. Never returns None.
+    """
+
+    already_loaded = next((x for x in model_data.loaded_sd_models if x.sd_checkpoint_info.filename == checkpoint_info.filename), None)
+
+    if already_loaded is not None:
+        sizes = sd_models_residency.get_model_sizes(already_loaded)
+        unload_models(sd_models_residency.enforce_budgets(model_data.loaded_sd_models, keep=already_loaded, reserve_gpu=sizes["cpu"] + sizes["disk"]))
+        timer.record("enforce memory budgets")
+
+        send_model_to_device(already_loaded)
+        timer.record("send model to device")
+
+        model_data.set_sd_model(already_loaded, already_loaded=True)
+
+        if not SkipWritingToConfig.skip:
+            shared.opts.data["sd_model_checkpoint"] = already_loaded.sd_checkpoint_info.title
+            shared.opts.data["sd_checkpoint_hash"] = already_loaded.sd_checkpoint_info.sha256
+
+        print(f"Using already loaded model {already_loaded.sd_checkpoint_info.title}: done in {timer.summary()}; {sd_models_residency.summary(model_data.loaded_sd_models)}")
+        sd_vae.reload_vae_weights(already_loaded)
+        return model_data.sd_model
+
+    size = os.path.getsize(checkpoint_info.filename)
+    removed = sd_models_residency.enforce_budgets(model_data.loaded_sd_models, reserve_gpu=size, reserve_ram=size)
+    timer.record("enforce memory budgets")
+
+    if removed:
+        sd_model = removed.pop(0)
+        unload_models(removed)
+
+        # weights are loaded non-strictly, so ones missing from the new checkpoint must keep their values
+        sd_models_residency.release_disk_file(sd_model)
+        model_data.sd_model = sd_model
+
+        sd_vae.base_vae = getattr(sd_model, "base_vae", None)
+        sd_vae.loaded_vae_file = getattr(sd_model, "loaded_vae_file", None)
+        sd_vae.checkpoint_info = sd_model.sd_checkpoint_info
+
+        print(f"Reusing unloaded model {sd_model.sd_checkpoint_info.title} to load {checkpoint_info.title}")
+        return sd_model
+
+    print(f"Loading model {checkpoint_info.title} ({len(model_data.loaded_sd_models) + 1} loaded)")
+
+    model_data.sd_model = None
+    load_model(checkpoint_info)
+
+    unload_models(sd_models_residency.enforce_budgets(model_data.loaded_sd_models, keep=model_data.sd_model))
+    print(f"Memory used by loaded models: {sd_models_residency.summary(model_data.loaded_sd_models)}")
+
+    return model_data.sd_model
+
+
+def unload_models(models):
+    for m in models:
+        send_model_to_trash(m)
+
+
 def reload_model_weights(sd_model=None, info=None, forced_reload=False):
     checkpoint_info = info or select_checkpoint()
 
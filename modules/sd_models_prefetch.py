@@ -0,0 +1,152 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from modules import errors, shared, sd_models_streaming
+
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint-prefetch")
+lock = threading.Lock()
+
+prefetched = OrderedDict()
+"""filename -> (Future, time when prefetch started) for checkpoints that are being read, or have already been read, in background; oldest first"""
+
+limit = 2
+"""how many checkpoints can be prefetched at once; more than one is needed to read the checkpoint for the next job while one for the current job is still waiting to be used"""
+
+expiration = 600
+"""seconds after which a prefetched checkpoint that has not been used is dropped to free RAM, for example if the request it was read for has been cancelled"""
+
+
+def is_loaded(checkpoint_info):
+    from modules import sd_models
+
+    if checkpoint_info in sd_models.checkpoints_loaded:
+        return True
+
+    return any(m.sd_checkpoint_info.filename == checkpoint_info.filename for m in sd_models.model_data.loaded_sd_models)
+
+
+def read(checkpoint_info):
+    from modules import sd_models
+
+    checkpoint_info.calculate_shorthash()
+
+    # streaming load only maps the file without reading it, so read it here to have the data in file cache when it's needed
+    if sd_models.uses_streaming_load(checkpoint_info):
+        sd_models_streaming.read_ahead(checkpoint_info.filename)
+
+    return sd_models.read_checkpoint_state_dict(checkpoint_info, map_location="cpu")
+
+
+def prefetch(checkpoint_name, replace=True):
+    """
+    Starts reading the checkpoint's state dict and calculating its hash in a background thread, so that when it's needed
+    later, reload_model_weights only has to copy weights into the model. If the limit of prefetched checkpoints is reached,
+    the oldest one is dropped if replace is True; otherwise nothing is done. Returns CheckpointInfo for the checkpoint
+    that is prefetched as a result of this call, or None.
+    """
+
+    from modules import sd_models
+
+    checkpoint_info = sd_models.get_closet_checkpoint_match(checkpoint_name) if isinstance(checkpoint_name, str) else checkpoint_name
+    if checkpoint_info is None or is_loaded(checkpoint_info):
+        return None
+
+    with lock:
+        drop_expired()
+
+        if checkpoint_info.filename in prefetched:
+            return None
+
+        if len(prefetched) >= limit:
+            if not replace:
+                return None
+
+            _, (future, _) = prefetched.popitem(last=False)
+            future.cancel()
+
+        print(f"Prefetching weights for {checkpoint_info.title}")
+        prefetched[checkpoint_info.filename] = (executor.submit(read, checkpoint_info), time.time())
+
+    return checkpoint_info
+
+
+def drop_expired():
+    """drops prefetched checkpoints that have not been used for too long; must be called with lock held"""
+
+    now = time.time()
+    for filename, (future, started) in list(prefetched.items()):
+        if now - started > expiration:
+            del prefetched[filename]
+            future.cancel()
+
+
+def discard(checkpoint_info):
+    """Drops the prefetched state dict for checkpoint_info, if there is one; used when the request it was prefetched for fails"""
+
+    if checkpoint_info is None:
+        return
+
+    with lock:
+        entry = prefetched.pop(checkpoint_info.filename, None)
+
+    if entry is not None:
+        entry[0].cancel()
+
+
+def prefetch_for_request(override_settings):
+    """
+    Starts prefetching checkpoint requested in override_settings of a queued request, if look-ahead prefetching is enabled
+    in settings. Returns CheckpointInfo if prefetching was started by this call, so that the caller can discard it if the
+    request fails, or None.
+    """
+
+    if not shared.opts.sd_checkpoint_prefetch or not override_settings:
+        return None
+
+    checkpoint_name = override_settings.get('sd_model_checkpoint')
+    if checkpoint_name:
+        return prefetch(checkpoint_name, replace=False)
+
+    return None
+
+
+@contextmanager
+def discarded_on_error(checkpoint_info):
+    """Discards the checkpoint prefetched for a request if the with block, which processes the request, fails"""
+
+    try:
+        yield
+    except BaseException:
+        discard(checkpoint_info)
+        raise
+
+
+def discard_if_fails(future, checkpoint_info):
+    """Discards the checkpoint prefetched for a request that is processed in background as future if it fails or is cancelled"""
+
+    def on_done(f):
+        if f.cancelled() or f.exception() is not None:
+            discard(checkpoint_info)
+
+    future.add_done_callback(on_done)
+
+
+def take(checkpoint_info):
+    """Returns state dict for checkpoint_info if it was prefetched, waiting for it to finish reading if needed, or None otherwise"""
+
+    with lock:
+        entry = prefetched.pop(checkpoint_info.filename, None)
+
+    if entry is None:
+        return None
+
+    future, _ = entry
+
+    try:
+        return future.result()
+    except Exception as e:
+        errors.display(e, f"prefetching {checkpoint_info.filename}")
+        return None
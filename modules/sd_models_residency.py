@@ -0,0 +1,173 @@
+import itertools
+import os
+import tempfile
+
+import torch
+
+from modules import devices, shared
+
+alignment = 64
+
+
+def enabled():
+    """True if loaded checkpoints are managed by memory budgets rather than by their count (sd_checkpoints_limit)"""
+
+    return shared.opts.sd_checkpoints_vram_budget > 0 or shared.opts.sd_checkpoints_ram_budget > 0
+
+
+def model_tensors(m):
+    return itertools.chain(m.parameters(), m.buffers())
+
+
+def is_on_disk(m):
+    return getattr(m, 'residency_disk_file', None) is not None
+
+
+def get_model_sizes(m):
+    """returns a dict with number of bytes that model's weights take on GPU, in RAM, and in a memory-mapped file on disk"""
+
+    res = {"gpu": 0, "cpu": 0, "disk": 0}
+    on_disk = is_on_disk(m)
+
+    for t in model_tensors(m):
+        if t.device.type == 'meta':
+            continue
+
+        size = t.numel() * t.element_size()
+        if t.device.type != 'cpu':
+            res["gpu"] += size
+        elif on_disk:
+            res["disk"] += size
+        else:
+            res["cpu"] += size
+
+    return res
+
+
+def total_sizes(models):
+    res = {"gpu": 0, "cpu": 0, "disk": 0}
+
+    for m in models:
+        for k, v in get_model_sizes(m).items():
+            res[k] += v
+
+    return res
+
+
+def send_model_to_disk(m):
+    """
+    Moves all weights of the model that are in RAM into a single memory-mapped temporary file. The model stays fully
+    usable and keeps all its state, but the operating system is free to drop its pages from RAM and read them back on demand.
+    """
+
+    if is_on_disk(m):
+        return
+
+    tensors = [t for t in model_tensors(m) if t.device.type == 'cpu']
+    offsets = []
+    total = 0
+    for t in tensors:
+        offsets.append(total)
+        total += (t.numel() * t.element_size() + alignment - 1) // alignment * alignment
+
+    if total == 0:
+        return
+
+    fd, filename = tempfile.mkstemp(prefix="webui-model-", suffix=".bin")
+    with os.fdopen(fd, "wb") as file:
+        file.truncate(total)
+
+    buffer = torch.from_file(filename, shared=True, size=total, dtype=torch.uint8)
+
+    with torch.no_grad():
+        for t, offset in zip(tensors, offsets):
+            size = t.numel() * t.element_size()
+            view = buffer[offset:offset + size].view(t.dtype).view(t.shape)
+            view.copy_(t.data)
+            t.data = view
+
+    m.residency_disk_file = filename
+    devices.torch_gc()
+
+
+def release_disk_file(m):
+    """Copies weights that are still in the memory-mapped file back into RAM, and deletes the file"""
+
+    filename = getattr(m, 'residency_disk_file', None)
+    if filename is None:
+        return
+
+    with torch.no_grad():
+        for t in model_tensors(m):
+            if t.device.type == 'cpu':
+                t.data = t.data.clone()
+
+    m.residency_disk_file = None
+
+    try:
+        os.remove(filename)
+    except OSError as e:
+        print(f"Failed to remove temporary model file {filename}: {e}")
+
+
+def enforce_budgets(models, keep=None, reserve_gpu=0, reserve_ram=0):
+    """
+    Demotes least recently used models (last in the list) until their total size fits into budgets set in settings:
+    models over VRAM budget are moved to RAM, models over RAM budget are moved to a memory-mapped file on disk, and
+    models over disk budget are removed from the list. The keep model is never demoted. reserve_gpu and reserve_ram are
+    numbers of bytes to free in addition, for a model that's about to be loaded or moved to GPU.
+
+    Without a VRAM budget, all models other than keep are moved to RAM, same as with sd_checkpoints_keep_in_cpu.
+
+    Returns the list of removed models, most recently used first; the caller either reuses or unloads them.
+    """
+
+    from modules import sd_models
+
+    vram_budget = shared.opts.sd_checkpoints_vram_budget * 1024 * 1024
+    ram_budget = shared.opts.sd_checkpoints_ram_budget * 1024 * 1024
+    disk_budget = shared.opts.sd_checkpoints_disk_budget * 1024 * 1024
+
+    candidates = [m for m in reversed(models) if m is not keep]
+
+    if vram_budget > 0:
+        for m in candidates:
+            if total_sizes(models)["gpu"] + reserve_gpu <= vram_budget:
+                break
+
+            if get_model_sizes(m)["gpu"] > 0:
+                print(f"Moving model {m.sd_checkpoint_info.title} to RAM to stay within VRAM budget")
+                sd_models.send_model_to_cpu(m)
+    else:
+        for m in candidates:
+            if get_model_sizes(m)["gpu"] > 0:
+                sd_models.send_model_to_cpu(m)
+
+    if ram_budget > 0:
+        for m in candidates:
+            if total_sizes(models)["cpu"] + reserve_ram <= ram_budget:
+                break
+
+            if get_model_sizes(m)["cpu"] > 0:
+                print(f"Moving model {m.sd_checkpoint_info.title} to disk to stay within RAM budget")
+                if m.lowvram:
+                    sd_models.send_model_to_cpu(m)
+                send_model_to_disk(m)
+
+    removed = []
+    if disk_budget > 0:
+        for m in candidates:
+            if total_sizes(models)["disk"] <= disk_budget:
+                break
+
+            if is_on_disk(m):
+                print(f"Unloading model {m.sd_checkpoint_info.title} to stay within disk budget")
+                models.remove(m)
+                removed.append(m)
+
+    return removed[::-1]
+
+
+def summary(models):
+    sizes = total_sizes(models)
+    return ", ".join(f"{k.upper()}: {v / 1024 / 1024:.0f} MB" for k, v in sizes.items())
@@ -0,0 +1,79 @@
+import json
+import mmap
+import warnings
+
+import torch
+
+dtypes = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+if hasattr(torch, "float8_e4m3fn"):
+    dtypes["F8_E4M3"] = torch.float8_e4m3fn
+    dtypes["F8_E5M2"] = torch.float8_e5m2
+
+
+def read_header(file):
+    header_len = int.from_bytes(file.read(8), "little")
+    header = json.loads(file.read(header_len))
+    header.pop("__metadata__", None)
+
+    return header, 8 + header_len
+
+
+def read_ahead(filename, chunk_size=16 * 1024 * 1024):
+    """
+    Reads the whole file sequentially and discards the data, so that its pages are in the operating system's file cache
+    when tensors returned by load_file for it are used, and copying them into the model does not wait for the disk.
+    """
+
+    buffer = bytearray(chunk_size)
+    with open(filename, mode="rb", buffering=0) as file:
+        while file.readinto(buffer):
+            pass
+
+
+def load_file(filename):
+    """
+    Reads a .safetensors file into a dict of tensors without reading the tensors' data: every returned tensor is a view
+    into a private (copy-on-write) memory mapping of the file. Data is read from disk only when it's used - usually when
+    it's copied into model's parameters - so loading the checkpoint does not require a second copy of the model in RAM,
+    and pages of the mapping can be dropped by the operating system at any time since they are backed by the file.
+    """
+
+    with open(filename, mode="rb") as file:
+        header, data_start = read_header(file)
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    res = {}
+    for key, info in header.items():
+        dtype = dtypes[info["dtype"]]
+        begin, end = info["data_offsets"]
+        shape = info["shape"]
+        offset = data_start + begin
+
+        if end == begin:
+            res[key] = torch.empty(shape, dtype=dtype)
+            continue
+
+        element_size = torch.empty((), dtype=dtype).element_size()
+        if offset % element_size != 0:
+            # misaligned tensor; torch can't make a view for it, so copy it out of the mapping
+            tensor = torch.frombuffer(bytearray(mapping[offset:data_start + end]), dtype=dtype)
+        else:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                tensor = torch.frombuffer(mapping, dtype=dtype, count=(end - begin) // element_size, offset=offset)
+
+        res[key] = tensor.reshape(shape)
+
+    return res
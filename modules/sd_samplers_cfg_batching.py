@@ -0,0 +1,98 @@
+import torch
+
+from modules import devices, shared, sd_vae_tiling
+
+memory_safety_margin = 0.8
+
+memory_per_sample = {}
+"""(C, H, W, cond token count) of one UNet input sample -> peak memory in bytes that a UNet call needed per such sample, as measured on an earlier call"""
+
+
+def memory_key(x, cond):
+    """key for memory_per_sample for UNet calls with samples like those in x and cond; cond can be a tensor or a dict of them"""
+
+    crossattn = cond['crossattn'] if isinstance(cond, dict) else cond
+    return tuple(x.shape[1:]) + (crossattn.shape[1],)
+
+
+def measure_start(key):
+    """
+    Resets peak memory stats so that measure_end only sees the peak of the UNet call; memory monitor keeps earlier peaks
+    for its report. Does nothing and returns None if there already is a measurement for key, so that stats are only reset
+    once per kind of UNet call rather than on every call.
+    """
+
+    if not shared.opts.cfg_batch_planner or devices.device.type != 'cuda' or key in memory_per_sample:
+        return None
+
+    if shared.mem_mon is not None:
+        shared.mem_mon.reset_peak_memory_stats()
+    else:
+        torch.cuda.reset_peak_memory_stats(devices.device)
+
+    return torch.cuda.memory_allocated(devices.device)
+
+
+def measure_end(start, key, count):
+    """records how much memory a UNet call for count samples with the given key used, from memory stats taken by measure_start before the call"""
+
+    if start is None:
+        return
+
+    peak = torch.cuda.max_memory_allocated(devices.device)
+    memory_per_sample[key] = (peak - start) / count
+
+
+def plan(total, default, key):
+    """
+    Returns how many of total samples with the given key to give to UNet in one call: as many as fit into free memory
+    according to earlier measurements, or default (what would be used without planning) if there are no measurements yet.
+    With batch cond/uncond disabled in settings, never returns more than default, so batches can only get smaller.
+    """
+
+    if not shared.opts.cfg_batch_planner:
+        return default
+
+    used = memory_per_sample.get(key)
+    free = sd_vae_tiling.get_free_memory()
+    if used is None or free is None or used <= 0:
+        return default
+
+    fits = int(free * memory_safety_margin // used)
+    if not shared.opts.batch_cond_uncond:
+        fits = min(fits, default)
+
+    return max(1, min(total, fits))
+
+
+def run(func, total, default, key):
+    """
+    Calls func(a, b) for consecutive ranges of [0, total) that cover it, with range length chosen by plan(), and returns
+    results of all calls catenated together. If a call runs out of memory, it's retried with half as many samples, down to one,
+    and the measurement that led to too many samples is discarded so that it's taken again.
+    """
+
+    size = plan(total, default, key)
+    outputs = []
+
+    a = 0
+    while a < total:
+        b = min(a + size, total)
+        start = measure_start(key)
+
+        try:
+            outputs.append(func(a, b))
+        except Exception as e:
+            if not shared.opts.cfg_batch_planner or b - a <= 1 or not sd_vae_tiling.is_out_of_memory(e):
+                raise
+
+            devices.torch_gc()
+            memory_per_sample.pop(key, None)
+            size = max(1, (b - a) // 2)
+            print(f"UNet ran out of memory; retrying with {size} samples at once")
+            continue
+
+        measure_end(start, key, b - a)
+        a = b
+
+    return outputs[0] if len(outputs) == 1 else torch.cat(outputs)
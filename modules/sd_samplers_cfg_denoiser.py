@@ -1,5 +1,5 @@
 import torch
-from modules import prompt_parser, devices, sd_samplers_common
+from modules import prompt_parser, devices, sd_samplers_common, sd_samplers_cfg_batching, sd_unet_cache, script_callbacks
 
 from modules.shared import opts, state
 import modules.shared as shared
@@ -26,8 +26,30 @@ def pad_cond(tensor, repeats, empty):
     if not isinstance(tensor, dict):
         return torch.cat([tensor, empty.repeat((tensor.shape[0], repeats, 1))], axis=1)
 
-    tensor['crossattn'] = pad_cond(tensor['crossattn'], repeats, empty)
-    return tensor
+    # the dict is copied rather than modified because CFGDenoiser reuses unpadded conds between steps
+    return prompt_parser.DictWithShape({**tensor, 'crossattn': pad_cond(tensor['crossattn'], repeats, empty)}, None)
+
+
+def guidance_difference(x_out, conds_list, uncond_count):
+    """
+    Returns how far cond predictions are from uncond predictions in x_out (laid out as in CFGDenoiser.forward): norm of
+    their difference relative to norm of uncond prediction, for the image and prompt where it's the largest.
+    """
+
+    denoised_uncond = x_out[-uncond_count:]
+    differences = [
+        (x_out[cond_index] - denoised_uncond[i]).norm() / denoised_uncond[i].norm().clamp(min=1e-8)
+        for i, conds in enumerate(conds_list)
+        for cond_index, _ in conds
+    ]
+
+    return torch.stack(differences).max().item()
+
+
+def schedule_indexes(schedules, current_step):
+    """for every prompt schedule, returns index of its entry that is used at current_step, the same way as prompt_parser.reconstruct_cond_batch"""
+
+    return tuple(next((i for i, entry in enumerate(schedule) if current_step <= entry.end_at_step), 0) for schedule in schedules)
 
 
 class CFGDenoiser(torch.nn.Module):
@@ -58,6 +80,15 @@ class CFGDenoiser(torch.nn.Module):
         self.model_wrap = None
         self.p = None
 
+        self.reconstructed_conds = None
+        """(cond, uncond, schedule indexes, result) for the last call of reconstruct_conds"""
+
+        self.prepared_conds = None
+        """inputs and results of the last call of prepare_conds"""
+
+        self.guidance_truncated_at = None
+        """step after which uncond is no longer denoised because adaptive guidance truncation found it too close to cond"""
+
         # NOTE: masking before denoising can cause the original latents to be oversmoothed
         # as the original latents do not have noise
         self.mask_before_denoising = False
@@ -142,12 +173,89 @@ class CFGDenoiser(torch.nn.Module):
             self.padded_cond_uncond_v0 = True
 
         if is_dict_cond:
-            uncond['crossattn'] = uncond_vec
+            uncond = prompt_parser.DictWithShape({**uncond, 'crossattn': uncond_vec}, None)
         else:
             uncond = uncond_vec
 
         return cond, uncond
 
+    def reuse_conds(self):
+        """
+        Whether cond tensors built on earlier steps can be given to this step. They can't if any script has a denoiser
+        callback, because those get the tensors and may modify them in place, which would carry over to later steps.
+        """
+
+        return shared.opts.cfg_reuse_conds and not script_callbacks.callback_map['callbacks_cfg_denoiser']
+
+    def reconstruct_conds(self, cond, uncond):
+        """
+        Returns (conds_list, tensor, uncond) for the current step from prompt schedules. Tensors only change on steps where
+        the schedule switches to a different prompt, so they are built on those steps only and reused on others, unless
+        reuse_conds() says otherwise.
+        """
+
+        indexes = (
+            schedule_indexes([prompt.schedules for prompts in cond.batch for prompt in prompts], self.step),
+            schedule_indexes(uncond, self.step),
+        )
+
+        cache = self.reconstructed_conds
+        if self.reuse_conds() and cache is not None and cache[0] is cond and cache[1] is uncond and cache[2] == indexes:
+            return cache[3]
+
+        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
+        uncond_tensor = prompt_parser.reconstruct_cond_batch(uncond, self.step)
+
+        self.reconstructed_conds = (cond, uncond, indexes, (conds_list, tensor, uncond_tensor))
+        return conds_list, tensor, uncond_tensor
+
+    def prepare_conds(self, tensor, uncond, is_edit_model, skip_uncond):
+        """
+        Pads cond and uncond to the same length if enabled in settings, and catenates them into a cond for a single UNet
+        call. Returns (tensor, uncond, cond_in), where cond_in is None if their lengths still differ. Results are reused
+        for as long as the same tensors are passed, which is every step until the prompt schedule changes, unless a script
+        replaces them in a callback, or reuse_conds() says otherwise.
+        """
+
+        options = (shared.opts.pad_cond_uncond_v0, shared.opts.pad_cond_uncond)
+
+        cache = self.prepared_conds
+        if not self.reuse_conds() or cache is None or cache["tensor"] is not tensor or cache["uncond"] is not uncond or cache["options"] != options:
+            padded_tensor, padded_uncond = tensor, uncond
+            self.padded_cond_uncond = False
+            self.padded_cond_uncond_v0 = False
+            if shared.opts.pad_cond_uncond_v0 and tensor.shape[1] != uncond.shape[1]:
+                padded_tensor, padded_uncond = self.pad_cond_uncond_v0(tensor, uncond)
+            elif shared.opts.pad_cond_uncond and tensor.shape[1] != uncond.shape[1]:
+                padded_tensor, padded_uncond = self.pad_cond_uncond(tensor, uncond)
+
+            cache = self.prepared_conds = {
+                "tensor": tensor,
+                "uncond": uncond,
+                "options": options,
+                "padded": (padded_tensor, padded_uncond),
+                "padded_flags": (self.padded_cond_uncond, self.padded_cond_uncond_v0),
+                "cond_in": {},
+            }
+
+        self.padded_cond_uncond, self.padded_cond_uncond_v0 = cache["padded_flags"]
+        tensor, uncond = cache["padded"]
+
+        variant = (is_edit_model, skip_uncond)
+        if variant not in cache["cond_in"]:
+            if skip_uncond:
+                cond_in = tensor
+            elif tensor.shape[1] != uncond.shape[1]:
+                cond_in = None
+            elif is_edit_model:
+                cond_in = catenate_conds([tensor, uncond, uncond])
+            else:
+                cond_in = catenate_conds([tensor, uncond])
+
+            cache["cond_in"][variant] = cond_in
+
+        return tensor, uncond, cache["cond_in"][variant]
+
     def forward(self, x, sigma, uncond, cond, cond_scale, s_min_uncond, image_cond):
         if state.interrupted or state.skipped:
             raise sd_samplers_common.InterruptedException
@@ -160,8 +268,7 @@ class CFGDenoiser(torch.nn.Module):
         # so is_edit_model is set to False to support AND composition.
         is_edit_model = shared.sd_model.cond_stage_key == "edit" and self.image_cfg_scale is not None and self.image_cfg_scale != 1.0
 
-        conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
-        uncond = prompt_parser.reconstruct_cond_batch(uncond, self.step)
+        conds_list, tensor, uncond = self.reconstruct_conds(cond, uncond)
 
         assert not is_edit_model or all(len(conds) == 1 for conds in conds_list), "AND is not supported for InstructPix2Pix checkpoint (unless using Image CFG scale = 1.0)"
 
@@ -212,51 +319,50 @@ class CFGDenoiser(torch.nn.Module):
         uncond = denoiser_params.text_uncond
         skip_uncond = False
 
-        # alternating uncond allows for higher thresholds without the quality loss normally expected from raising it
-        if self.step % 2 and s_min_uncond > 0 and sigma[0] < s_min_uncond and not is_edit_model:
+        # alternating uncond allows for higher thresholds without the quality loss normally expected from raising it;
+        # after adaptive guidance truncation, uncond is skipped on all remaining steps
+        alternate_uncond = self.step % 2 and s_min_uncond > 0 and sigma[0] < s_min_uncond
+        if (alternate_uncond or self.guidance_truncated_at is not None) and not is_edit_model:
             skip_uncond = True
             x_in = x_in[:-batch_size]
             sigma_in = sigma_in[:-batch_size]
 
-        self.padded_cond_uncond = False
-        self.padded_cond_uncond_v0 = False
-        if shared.opts.pad_cond_uncond_v0 and tensor.shape[1] != uncond.shape[1]:
-            tensor, uncond = self.pad_cond_uncond_v0(tensor, uncond)
-        elif shared.opts.pad_cond_uncond and tensor.shape[1] != uncond.shape[1]:
-            tensor, uncond = self.pad_cond_uncond(tensor, uncond)
+        tensor, uncond, cond_in = self.prepare_conds(tensor, uncond, is_edit_model, skip_uncond)
+        sd_unet_cache.start_step(self.step)
+        try:
+            if cond_in is not None:
+                def denoise(a, b):
+                    sd_unet_cache.set_chunk("all", a, b)
+                    return self.inner_model(x_in[a:b], sigma_in[a:b], cond=make_condition_dict(subscript_cond(cond_in, a, b), image_cond_in[a:b]))
 
-        if tensor.shape[1] == uncond.shape[1] or skip_uncond:
-            if is_edit_model:
-                cond_in = catenate_conds([tensor, uncond, uncond])
-            elif skip_uncond:
-                cond_in = tensor
+                x_out = sd_samplers_cfg_batching.run(denoise, x_in.shape[0], x_in.shape[0] if shared.opts.batch_cond_uncond else batch_size, sd_samplers_cfg_batching.memory_key(x_in, cond_in))
             else:
-                cond_in = catenate_conds([tensor, uncond])
+                def denoise_cond(a, b):
+                    if not is_edit_model:
+                        c_crossattn = subscript_cond(tensor, a, b)
+                    else:
+                        c_crossattn = torch.cat([tensor[a:b]], uncond)
 
-            if shared.opts.batch_cond_uncond:
-                x_out = self.inner_model(x_in, sigma_in, cond=make_condition_dict(cond_in, image_cond_in))
-            else:
-                x_out = torch.zeros_like(x_in)
-                for batch_offset in range(0, x_out.shape[0], batch_size):
-                    a = batch_offset
-                    b = a + batch_size
-                    x_out[a:b] = self.inner_model(x_in[a:b], sigma_in[a:b], cond=make_condition_dict(subscript_cond(cond_in, a, b), image_cond_in[a:b]))
-        else:
-            x_out = torch.zeros_like(x_in)
-            batch_size = batch_size*2 if shared.opts.batch_cond_uncond else batch_size
-            for batch_offset in range(0, tensor.shape[0], batch_size):
-                a = batch_offset
-                b = min(a + batch_size, tensor.shape[0])
+                    sd_unet_cache.set_chunk("cond", a, b)
+                    return self.inner_model(x_in[a:b], sigma_in[a:b], cond=make_condition_dict(c_crossattn, image_cond_in[a:b]))
 
-                if not is_edit_model:
-                    c_crossattn = subscript_cond(tensor, a, b)
-                else:
-                    c_crossattn = torch.cat([tensor[a:b]], uncond)
+                def denoise_uncond(a, b):
+                    offset = x_in.shape[0] - uncond.shape[0]
+                    sd_unet_cache.set_chunk("uncond", a, b)
+                    return self.inner_model(x_in[offset + a:offset + b], sigma_in[offset + a:offset + b], cond=make_condition_dict(subscript_cond(uncond, a, b), image_cond_in[offset + a:offset + b]))
+
+                x_out = torch.zeros_like(x_in)
+                x_out[:tensor.shape[0]] = sd_samplers_cfg_batching.run(denoise_cond, tensor.shape[0], batch_size*2 if shared.opts.batch_cond_uncond else batch_size, sd_samplers_cfg_batching.memory_key(x_in, tensor))
 
-                x_out[a:b] = self.inner_model(x_in[a:b], sigma_in[a:b], cond=make_condition_dict(c_crossattn, image_cond_in[a:b]))
+                if not skip_uncond:
+                    x_out[-uncond.shape[0]:] = sd_samplers_cfg_batching.run(denoise_uncond, uncond.shape[0], uncond.shape[0], sd_samplers_cfg_batching.memory_key(x_in, uncond))
+        finally:
+            sd_unet_cache.end_step()
 
-            if not skip_uncond:
-                x_out[-uncond.shape[0]:] = self.inner_model(x_in[-uncond.shape[0]:], sigma_in[-uncond.shape[0]:], cond=make_condition_dict(uncond, image_cond_in[-uncond.shape[0]:]))
+        truncation_threshold = shared.opts.cfg_truncation_threshold
+        if truncation_threshold > 0 and self.guidance_truncated_at is None and not skip_uncond and not is_edit_model:
+            if guidance_difference(x_out, conds_list, uncond.shape[0]) < truncation_threshold:
+                self.guidance_truncated_at = self.step
 
         denoised_image_indexes = [x[0][0] for x in conds_list]
         if skip_uncond:
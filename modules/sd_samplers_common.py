@@ -3,7 +3,7 @@ from collections import namedtuple
 import numpy as np
 import torch
 from PIL import Image
-from modules import devices, images, sd_vae_approx, sd_samplers, sd_vae_taesd, shared, sd_models
+from modules import devices, images, sd_vae_approx, sd_samplers, sd_vae_taesd, sd_vae_tiling, shared, sd_models, sd_unet_cache
 from modules.shared import opts, state
 import k_diffusion.sampling
 
@@ -97,17 +97,12 @@ def images_tensor_to_samples(image, approximation=None, model=None):
             model = shared.sd_model
         model.first_stage_model.to(devices.dtype_vae)
 
-        image = image.to(shared.device, dtype=devices.dtype_vae)
-        image = image * 2 - 1
-        if len(image) > 1:
-            x_latent = torch.stack([
-                model.get_first_stage_encoding(
-                    model.encode_first_stage(torch.unsqueeze(img, 0))
-                )[0]
-                for img in image
-            ])
-        else:
-            x_latent = model.get_first_stage_encoding(model.encode_first_stage(image))
+        def encode(x):
+            x = x.to(shared.device, dtype=devices.dtype_vae)
+            x = x * 2 - 1
+            return model.get_first_stage_encoding(model.encode_first_stage(x))
+
+        x_latent = torch.cat([sd_vae_tiling.encode_image(encode, torch.unsqueeze(img, 0)) for img in image])
 
     return x_latent
 
@@ -184,6 +179,7 @@ def apply_refiner(cfg_denoiser):
     with sd_models.SkipWritingToConfig():
         sd_models.reload_model_weights(info=refiner_checkpoint_info)
 
+    sd_unet_cache.reset()
     devices.torch_gc()
     cfg_denoiser.p.setup_conds()
     cfg_denoiser.update_inner_model()
@@ -278,6 +274,8 @@ class Sampler:
         self.model_wrap_cfg.mask = p.mask if hasattr(p, 'mask') else None
         self.model_wrap_cfg.nmask = p.nmask if hasattr(p, 'nmask') else None
         self.model_wrap_cfg.step = 0
+        self.model_wrap_cfg.guidance_truncated_at = None
+        sd_unet_cache.reset()
         self.model_wrap_cfg.image_cfg_scale = getattr(p, 'image_cfg_scale', None)
         self.eta = p.eta if p.eta is not None else getattr(opts, self.eta_option_field, 0.0)
         self.s_min_uncond = getattr(p, 's_min_uncond', 0.0)
@@ -342,3 +340,10 @@ class Sampler:
 
         if self.model_wrap_cfg.padded_cond_uncond_v0:
             p.extra_generation_params["Pad conds v0"] = True
+
+        if opts.cfg_truncation_threshold > 0:
+            p.extra_generation_params["Adaptive guidance"] = opts.cfg_truncation_threshold
+
+        if sd_unet_cache.is_enabled():
+            p.extra_generation_params["Feature cache"] = opts.unet_feature_cache_interval
+            p.extra_generation_params["Feature cache depth"] = opts.unet_feature_cache_depth
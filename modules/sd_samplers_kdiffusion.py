@@ -1,7 +1,7 @@
 import torch
 import inspect
 import k_diffusion.sampling
-from modules import sd_samplers_common, sd_samplers_extra, sd_samplers_cfg_denoiser
+from modules import sd_samplers_common, sd_samplers_extra, sd_samplers_cfg_denoiser, sd_schedules
 from modules.sd_samplers_cfg_denoiser import CFGDenoiser  # noqa: F401
 from modules.script_callbacks import ExtraNoiseParams, extra_noise_callback
 
@@ -88,6 +88,28 @@ class KDiffusionSampler(sd_samplers_common.Sampler):
         self.model_wrap_cfg = CFGDenoiserKDiffusion(self)
         self.model_wrap = self.model_wrap_cfg.inner_model
 
+    def get_schedule_key(self):
+        """
+        Returns (key, tensors) identifying the model's noise schedule for sd_schedules, or (None, ()) if model_wrap is
+        not one of the k-diffusion's denoisers that derive the schedule from model's alphas_cumprod.
+        """
+
+        if type(self.model_wrap) not in (k_diffusion.external.CompVisDenoiser, k_diffusion.external.CompVisVDenoiser):
+            return None, ()
+
+        return type(self.model_wrap).__name__, (self.model_wrap.inner_model.alphas_cumprod,)
+
+    def get_sigma_range(self):
+        """returns smallest and largest sigma of the model as floats"""
+
+        make = lambda: (self.model_wrap.sigmas[0].item(), self.model_wrap.sigmas[-1].item())
+
+        schedule_key, sources = self.get_schedule_key()
+        if schedule_key is None:
+            return make()
+
+        return sd_schedules.get(("sigma range", schedule_key), make, sources)
+
     def get_sigmas(self, p, steps):
         discard_next_to_last_sigma = self.config is not None and self.config.options.get('discard_next_to_last_sigma', False)
         if opts.always_discard_next_to_last_sigma and not discard_next_to_last_sigma:
@@ -96,10 +118,14 @@ class KDiffusionSampler(sd_samplers_common.Sampler):
 
         steps += 1 if discard_next_to_last_sigma else 0
 
+        # schedules are memoized in sd_schedules; key describes everything make() depends on, other than tensors in sources
+        key = None
+        sources = ()
+
         if p.sampler_noise_scheduler_override:
-            sigmas = p.sampler_noise_scheduler_override(steps)
+            make = lambda: p.sampler_noise_scheduler_override(steps)
         elif opts.k_sched_type != "Automatic":
-            m_sigma_min, m_sigma_max = (self.model_wrap.sigmas[0].item(), self.model_wrap.sigmas[-1].item())
+            m_sigma_min, m_sigma_max = self.get_sigma_range()
             sigma_min, sigma_max = (0.1, 10) if opts.use_old_karras_scheduler_sigmas else (m_sigma_min, m_sigma_max)
             sigmas_kwargs = {
                 'sigma_min': sigma_min,
@@ -122,21 +148,34 @@ class KDiffusionSampler(sd_samplers_common.Sampler):
                 sigmas_kwargs['rho'] = opts.rho
                 p.extra_generation_params["Schedule rho"] = opts.rho
 
-            sigmas = sigmas_func(n=steps, **sigmas_kwargs, device=shared.device)
+            key = (opts.k_sched_type, tuple(sorted(sigmas_kwargs.items())))
+            make = lambda: sigmas_func(n=steps, **sigmas_kwargs, device=shared.device)
         elif self.config is not None and self.config.options.get('scheduler', None) == 'karras':
-            sigma_min, sigma_max = (0.1, 10) if opts.use_old_karras_scheduler_sigmas else (self.model_wrap.sigmas[0].item(), self.model_wrap.sigmas[-1].item())
+            sigma_min, sigma_max = (0.1, 10) if opts.use_old_karras_scheduler_sigmas else self.get_sigma_range()
 
-            sigmas = k_diffusion.sampling.get_sigmas_karras(n=steps, sigma_min=sigma_min, sigma_max=sigma_max, device=shared.device)
+            key = ('karras', sigma_min, sigma_max)
+            make = lambda: k_diffusion.sampling.get_sigmas_karras(n=steps, sigma_min=sigma_min, sigma_max=sigma_max, device=shared.device)
         elif self.config is not None and self.config.options.get('scheduler', None) == 'exponential':
-            m_sigma_min, m_sigma_max = (self.model_wrap.sigmas[0].item(), self.model_wrap.sigmas[-1].item())
-            sigmas = k_diffusion.sampling.get_sigmas_exponential(n=steps, sigma_min=m_sigma_min, sigma_max=m_sigma_max, device=shared.device)
+            m_sigma_min, m_sigma_max = self.get_sigma_range()
+
+            key = ('exponential', m_sigma_min, m_sigma_max)
+            make = lambda: k_diffusion.sampling.get_sigmas_exponential(n=steps, sigma_min=m_sigma_min, sigma_max=m_sigma_max, device=shared.device)
         else:
-            sigmas = self.model_wrap.get_sigmas(steps)
+            key, sources = self.get_schedule_key()
+            make = lambda: self.model_wrap.get_sigmas(steps)
+
+        def make_sigmas():
+            sigmas = make()
+
+            if discard_next_to_last_sigma:
+                sigmas = torch.cat([sigmas[:-2], sigmas[-1:]])
+
+            return sigmas
 
-        if discard_next_to_last_sigma:
-            sigmas = torch.cat([sigmas[:-2], sigmas[-1:]])
+        if key is None:
+            return make_sigmas()
 
-        return sigmas
+        return sd_schedules.get(("k-diffusion sigmas", key, steps, discard_next_to_last_sigma, str(shared.device)), make_sigmas, sources)
 
     def sample_img2img(self, p, x, noise, conditioning, unconditional_conditioning, steps=None, image_conditioning=None):
         steps, t_enc = sd_samplers_common.setup_img2img_steps(p, steps)
@@ -209,8 +248,7 @@ class KDiffusionSampler(sd_samplers_common.Sampler):
             extra_params_kwargs['n'] = steps
 
         if 'sigma_min' in parameters:
-            extra_params_kwargs['sigma_min'] = self.model_wrap.sigmas[0].item()
-            extra_params_kwargs['sigma_max'] = self.model_wrap.sigmas[-1].item()
+            extra_params_kwargs['sigma_min'], extra_params_kwargs['sigma_max'] = self.get_sigma_range()
 
         if 'sigmas' in parameters:
             extra_params_kwargs['sigmas'] = sigmas
@@ -1,7 +1,7 @@
 import torch
 import inspect
 import sys
-from modules import devices, sd_samplers_common, sd_samplers_timesteps_impl
+from modules import devices, sd_samplers_common, sd_samplers_timesteps_impl, sd_schedules
 from modules.sd_samplers_cfg_denoiser import CFGDenoiser
 from modules.script_callbacks import ExtraNoiseParams, extra_noise_callback
 
@@ -90,9 +90,9 @@ class CompVisSampler(sd_samplers_common.Sampler):
 
         steps += 1 if discard_next_to_last_sigma else 0
 
-        timesteps = torch.clip(torch.asarray(list(range(0, 1000, 1000 // steps)), device=devices.device) + 1, 0, 999)
+        make = lambda: torch.clip(torch.asarray(list(range(0, 1000, 1000 // steps)), device=devices.device) + 1, 0, 999)
 
-        return timesteps
+        return sd_schedules.get(("timesteps", steps, str(devices.device)), make)
 
     def sample_img2img(self, p, x, noise, conditioning, unconditional_conditioning, steps=None, image_conditioning=None):
         steps, t_enc = sd_samplers_common.setup_img2img_steps(p, steps)
@@ -101,8 +101,11 @@ class CompVisSampler(sd_samplers_common.Sampler):
         timesteps_sched = timesteps[:t_enc]
 
         alphas_cumprod = shared.sd_model.alphas_cumprod
-        sqrt_alpha_cumprod = torch.sqrt(alphas_cumprod[timesteps[t_enc]])
-        sqrt_one_minus_alpha_cumprod = torch.sqrt(1 - alphas_cumprod[timesteps[t_enc]])
+        sqrt_alpha_cumprod, sqrt_one_minus_alpha_cumprod = sd_schedules.get(
+            ("img2img noise scale", t_enc),
+            lambda: (torch.sqrt(alphas_cumprod[timesteps[t_enc]]), torch.sqrt(1 - alphas_cumprod[timesteps[t_enc]])),
+            (alphas_cumprod, timesteps),
+        )
 
         xi = x * sqrt_alpha_cumprod + noise * sqrt_one_minus_alpha_cumprod
 
@@ -3,17 +3,37 @@ import tqdm
 import k_diffusion.sampling
 import numpy as np
 
-from modules import shared
+from modules import shared, sd_schedules
 from modules.models.diffusion.uni_pc import uni_pc
 
 
+def get_schedule(alphas_cumprod, timesteps, x, eta=None):
+    """
+    Returns timesteps, alphas, previous alphas, sqrt(1 - alphas) and, if eta is given, DDIM sigmas for the steps, as
+    lists of python numbers. They are computed on device and memoized in sd_schedules; samplers read values for each
+    step from the lists, which gives the same numbers as calling .item() on device tensors without syncing with device.
+    """
+
+    high_precision = x.device.type != 'mps' and x.device.type != 'xpu'
+
+    def make():
+        alphas = alphas_cumprod[timesteps]
+        alphas_prev = alphas_cumprod[torch.nn.functional.pad(timesteps[:-1], pad=(1, 0))].to(torch.float64 if high_precision else torch.float32)
+        sqrt_one_minus_alphas = torch.sqrt(1 - alphas)
+
+        sigmas = None
+        if eta is not None:
+            sigmas = (eta * np.sqrt((1 - alphas_prev.cpu().numpy()) / (1 - alphas.cpu()) * (1 - alphas.cpu() / alphas_prev.cpu().numpy()))).tolist()
+
+        return timesteps.tolist(), alphas.tolist(), alphas_prev.tolist(), sqrt_one_minus_alphas.tolist(), sigmas
+
+    return sd_schedules.get(("timesteps schedule", high_precision, eta), make, (alphas_cumprod, timesteps))
+
+
 @torch.no_grad()
 def ddim(model, x, timesteps, extra_args=None, callback=None, disable=None, eta=0.0):
     alphas_cumprod = model.inner_model.inner_model.alphas_cumprod
-    alphas = alphas_cumprod[timesteps]
-    alphas_prev = alphas_cumprod[torch.nn.functional.pad(timesteps[:-1], pad=(1, 0))].to(torch.float64 if x.device.type != 'mps' and x.device.type != 'xpu' else torch.float32)
-    sqrt_one_minus_alphas = torch.sqrt(1 - alphas)
-    sigmas = eta * np.sqrt((1 - alphas_prev.cpu().numpy()) / (1 - alphas.cpu()) * (1 - alphas.cpu() / alphas_prev.cpu().numpy()))
+    timesteps_list, alphas, alphas_prev, sqrt_one_minus_alphas, sigmas = get_schedule(alphas_cumprod, timesteps, x, eta)
 
     extra_args = {} if extra_args is None else extra_args
     s_in = x.new_ones((x.shape[0]))
@@ -21,12 +41,12 @@ def ddim(model, x, timesteps, extra_args=None, callback=None, disable=None, eta=
     for i in tqdm.trange(len(timesteps) - 1, disable=disable):
         index = len(timesteps) - 1 - i
 
-        e_t = model(x, timesteps[index].item() * s_in, **extra_args)
+        e_t = model(x, timesteps_list[index] * s_in, **extra_args)
 
-        a_t = alphas[index].item() * s_x
-        a_prev = alphas_prev[index].item() * s_x
-        sigma_t = sigmas[index].item() * s_x
-        sqrt_one_minus_at = sqrt_one_minus_alphas[index].item() * s_x
+        a_t = alphas[index] * s_x
+        a_prev = alphas_prev[index] * s_x
+        sigma_t = sigmas[index] * s_x
+        sqrt_one_minus_at = sqrt_one_minus_alphas[index] * s_x
 
         pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
         dir_xt = (1. - a_prev - sigma_t ** 2).sqrt() * e_t
@@ -42,9 +62,7 @@ def ddim(model, x, timesteps, extra_args=None, callback=None, disable=None, eta=
 @torch.no_grad()
 def plms(model, x, timesteps, extra_args=None, callback=None, disable=None):
     alphas_cumprod = model.inner_model.inner_model.alphas_cumprod
-    alphas = alphas_cumprod[timesteps]
-    alphas_prev = alphas_cumprod[torch.nn.functional.pad(timesteps[:-1], pad=(1, 0))].to(torch.float64 if x.device.type != 'mps' and x.device.type != 'xpu' else torch.float32)
-    sqrt_one_minus_alphas = torch.sqrt(1 - alphas)
+    timesteps_list, alphas, alphas_prev, sqrt_one_minus_alphas, _ = get_schedule(alphas_cumprod, timesteps, x)
 
     extra_args = {} if extra_args is None else extra_args
     s_in = x.new_ones([x.shape[0]])
@@ -53,9 +71,9 @@ def plms(model, x, timesteps, extra_args=None, callback=None, disable=None):
 
     def get_x_prev_and_pred_x0(e_t, index):
         # select parameters corresponding to the currently considered timestep
-        a_t = alphas[index].item() * s_x
-        a_prev = alphas_prev[index].item() * s_x
-        sqrt_one_minus_at = sqrt_one_minus_alphas[index].item() * s_x
+        a_t = alphas[index] * s_x
+        a_prev = alphas_prev[index] * s_x
+        sqrt_one_minus_at = sqrt_one_minus_alphas[index] * s_x
 
         # current prediction for x_0
         pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
@@ -67,8 +85,8 @@ def plms(model, x, timesteps, extra_args=None, callback=None, disable=None):
 
     for i in tqdm.trange(len(timesteps) - 1, disable=disable):
         index = len(timesteps) - 1 - i
-        ts = timesteps[index].item() * s_in
-        t_next = timesteps[max(index - 1, 0)].item() * s_in
+        ts = timesteps_list[index] * s_in
+        t_next = timesteps_list[max(index - 1, 0)] * s_in
 
         e_t = model(x, ts, **extra_args)
 
@@ -129,7 +147,7 @@ class UniPCCFG(uni_pc.UniPC):
 def unipc(model, x, timesteps, extra_args=None, callback=None, disable=None, is_img2img=False):
     alphas_cumprod = model.inner_model.inner_model.alphas_cumprod
 
-    ns = uni_pc.NoiseScheduleVP('discrete', alphas_cumprod=alphas_cumprod)
+    ns = sd_schedules.get("UniPC noise schedule", lambda: uni_pc.NoiseScheduleVP('discrete', alphas_cumprod=alphas_cumprod), (alphas_cumprod,))
     t_start = timesteps[-1] / 1000 + 1 / 1000 if is_img2img else None  # this is likely off by a bit - if someone wants to fix it please by all means
     unipc_sampler = UniPCCFG(model, extra_args, callback, ns, predict_x0=True, thresholding=False, variant=shared.opts.uni_pc_variant)
     x = unipc_sampler.sample(x, steps=len(timesteps), t_start=t_start, skip_type=shared.opts.uni_pc_skip_type, method="multistep", order=shared.opts.uni_pc_order, lower_order_final=shared.opts.uni_pc_lower_order_final)
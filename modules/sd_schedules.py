@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+
+limit = 64
+"""how many schedules are kept at once; each one is a few kilobytes at most"""
+
+lock = threading.Lock()
+
+cache = OrderedDict()
+"""key -> (tensors the value was computed from, value); most recently used last"""
+
+hits = 0
+misses = 0
+
+
+def tensor_key(tensor):
+    """
+    Identifies contents of a tensor without reading them: the same memory, viewed the same way, not modified in place
+    since. Only valid while the tensor is alive, which is why the cache keeps references to tensors used in keys.
+    """
+
+    return (
+        tensor.untyped_storage().data_ptr(),
+        tensor.storage_offset(),
+        tuple(tensor.shape),
+        tuple(tensor.stride()),
+        tensor.dtype,
+        str(tensor.device),
+        tensor._version,
+    )
+
+
+def get(key, func, sources=()):
+    """
+    Returns func(), computing it only if there is no result for the same key and sources in cache. The key must describe
+    everything the result depends on, except for tensors in sources, which are matched by identity using tensor_key.
+
+    Results are shared between all callers, across batch iterations and requests, and must not be modified in place.
+    """
+
+    global hits, misses
+
+    full_key = (key, tuple(tensor_key(x) for x in sources))
+
+    with lock:
+        entry = cache.get(full_key)
+        if entry is not None:
+            cache.move_to_end(full_key)
+            hits += 1
+            return entry[1]
+
+    value = func()
+
+    with lock:
+        misses += 1
+        cache[full_key] = (tuple(sources), value)
+        while len(cache) > limit:
+            cache.popitem(last=False)
+
+    return value
+
+
+def clear():
+    with lock:
+        cache.clear()
+
+
+def stats():
+    with lock:
+        return {
+            "hits": hits,
+            "misses": misses,
+            "entries": len(cache),
+            "limit": limit,
+        }
@@ -1,6 +1,6 @@
 import torch.nn
 
-from modules import script_callbacks, shared, devices
+from modules import script_callbacks, shared, devices, sd_unet_cache
 
 unet_options = []
 current_unet_option = None
@@ -88,6 +88,9 @@ def create_unet_forward(original_forward):
         if current_unet is not None:
             return current_unet.forward(x, timesteps, context, *args, **kwargs)
 
+        if sd_unet_cache.is_enabled():
+            return sd_unet_cache.forward(self, original_forward, x, timesteps, context, *args, **kwargs)
+
         return original_forward(self, x, timesteps, context, *args, **kwargs)
 
     return UNetModel_forward
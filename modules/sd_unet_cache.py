@@ -0,0 +1,114 @@
+import sys
+
+import torch
+
+from modules import shared
+
+active = False
+"""True while CFGDenoiser runs UNet for a step; UNet calls made outside of sampling are never cached"""
+
+step = 0
+"""number of the current step, as counted by CFGDenoiser"""
+
+chunk = None
+"""(part, start, end) for the part of CFGDenoiser's batch that the current UNet call is for: CFGDenoiser can run UNet several
+times per step for different parts of the batch, and split them differently from step to step if it runs out of memory"""
+
+features = {}
+"""(UNet, chunk, shape of its input) -> (step when the features were computed, features)"""
+
+
+def is_enabled():
+    return shared.opts.unet_feature_cache_interval > 1
+
+
+def reset():
+    """forgets cached features; called when a sampler is initialized for a new job, and when refiner replaces the model"""
+
+    global active, step, chunk
+
+    active = False
+    step = 0
+    chunk = None
+    features.clear()
+
+
+def start_step(new_step):
+    global active, step, chunk
+
+    active = True
+    step = new_step
+    chunk = None
+
+
+def end_step():
+    global active, chunk
+
+    active = False
+    chunk = None
+
+
+def set_chunk(part, start, end):
+    """called by CFGDenoiser before each UNet call with the name of the part of its batch and the range of samples from it"""
+
+    global chunk
+
+    chunk = (part, start, end)
+
+
+def forward(unet, original_forward, x, timesteps=None, context=None, y=None, *args, **kwargs):
+    """
+    UNet forward that reuses deep features between steps, as in DeepCache: on every Nth step (N set in settings) the
+    whole UNet is run, and the input to the output block that pairs with input block number depth is saved; on steps
+    in between, only input blocks up to depth and output blocks from the pairing one are run, with saved features
+    standing in for everything deeper. The shallow blocks are the ones that change the most between steps.
+
+    Falls back to original_forward for calls made outside of sampling or not marked by set_chunk, and for UNets or
+    arguments it does not know.
+    """
+
+    if not active or chunk is None or args or kwargs or not hasattr(unet, "input_blocks"):
+        return original_forward(unet, x, timesteps, context, y, *args, **kwargs)
+
+    depth = max(0, min(shared.opts.unet_feature_cache_depth, len(unet.input_blocks) - 1))
+    cache_at = len(unet.output_blocks) - 1 - depth
+
+    # UNet is a part of the key so that features of one model are never given to another one's output blocks; the chunk
+    # is so that they are only given to the same samples they were computed for, however the batch is split on this step
+    key = (id(unet), chunk, tuple(x.shape))
+
+    cached = features.get(key)
+    refresh = cached is None or step - cached[0] >= shared.opts.unet_feature_cache_interval
+
+    # timestep_embedding is taken from UNet's module so that its hijacks apply
+    module = sys.modules[type(unet).__module__]
+    emb = unet.time_embed(module.timestep_embedding(timesteps, unet.model_channels, repeat_only=False))
+    if unet.num_classes is not None:
+        emb = emb + unet.label_emb(y)
+
+    h = x.type(unet.dtype) if module.__name__.startswith("ldm.") else x
+    hs = []
+    for block in unet.input_blocks if refresh else unet.input_blocks[:depth + 1]:
+        h = block(h, emb, context)
+        hs.append(h)
+
+    if refresh:
+        h = unet.middle_block(h, emb, context)
+        output_start = 0
+    else:
+        h = cached[1]
+        output_start = cache_at
+
+    for i in range(output_start, len(unet.output_blocks)):
+        if refresh and i == cache_at:
+            features[key] = (step, h)
+
+        h = torch.cat([h, hs.pop()], dim=1)
+        h = unet.output_blocks[i](h, emb, context)
+
+    h = h.type(x.dtype)
+
+    if getattr(unet, "predict_codebook_ids", False):
+        return unet.id_predictor(h)
+
+    return unet.out(h)
@@ -0,0 +1,163 @@
+import math
+
+import torch
+
+from modules import devices, shared
+
+# rough peak memory, in bytes per element of the input, that VAE needs to decode a latent or encode an image;
+# the decoder works on 8x upscaled activations, so it needs far more memory per input element than the encoder
+decode_memory_per_latent_pixel = 2178 * 64
+encode_memory_per_image_pixel = 1767
+
+memory_safety_margin = 0.8
+
+
+def is_out_of_memory(e):
+    return isinstance(e, getattr(torch.cuda, 'OutOfMemoryError', ())) or (isinstance(e, RuntimeError) and "out of memory" in str(e).lower())
+
+
+def get_free_memory():
+    """returns number of bytes that can still be allocated on the GPU, or None if it can't be determined"""
+
+    if devices.device.type != 'cuda':
+        return None
+
+    free, _ = torch.cuda.mem_get_info(devices.device)
+    stats = torch.cuda.memory_stats(devices.device)
+
+    return free + stats['reserved_bytes.all.current'] - stats['allocated_bytes.all.current']
+
+
+def pick_batch_size(count, memory_per_sample, allow_batching):
+    """
+    Returns how many samples can be processed by VAE at once given the amount of free memory, or 0 if even a single
+    sample does not fit and it should be processed in tiles. If free memory can't be measured, as on devices other than
+    CUDA, samples are processed one at a time, as they were before batching.
+    """
+
+    mode = shared.opts.sd_vae_tiling
+    if mode == "Always":
+        return 0
+
+    free = get_free_memory()
+    if free is None:
+        return 1
+
+    fits = int(free * memory_safety_margin // memory_per_sample)
+    if fits < 1 and mode == "Automatic":
+        return 0
+
+    if not allow_batching:
+        return 1
+
+    return max(1, min(count, fits))
+
+
+def get_decode_batch_size(latents):
+    element_size = torch.empty((), dtype=devices.dtype_vae).element_size()
+    memory_per_sample = latents.shape[2] * latents.shape[3] * decode_memory_per_latent_pixel * element_size
+
+    return pick_batch_size(latents.shape[0], memory_per_sample, shared.opts.sd_vae_batch_decode)
+
+
+def tile_positions(size, tile, overlap):
+    """returns start positions of tiles of the given size that cover the range [0, size), overlapping by at least overlap"""
+
+    if size <= tile:
+        return [0]
+
+    stride = max(tile - overlap, 1)
+    count = math.ceil((size - tile) / stride) + 1
+
+    return [min(i * stride, size - tile) for i in range(count)]
+
+
+def ramp(length, overlap, fade_start, fade_end, device):
+    """1D blending weights for one tile: linearly fading in over the first overlap elements and fading out over the last ones"""
+
+    weights = torch.ones(length, device=device, dtype=torch.float32)
+    overlap = min(overlap, length)
+
+    if overlap > 0:
+        fade = (torch.arange(overlap, device=device, dtype=torch.float32) + 0.5) / overlap
+        if fade_start:
+            weights[:overlap] = fade
+        if fade_end:
+            weights[-overlap:] = torch.minimum(weights[-overlap:], fade.flip(0))
+
+    return weights
+
+
+def process_tiled(func, x, tile, overlap, unit_in, unit_out):
+    """
+    Applies func to overlapping tiles of x and blends the results together with linear weights, hiding the seams.
+
+    x is a (B, C, H, W) tensor; func must accept a tile of it, and return a tensor where every unit_in x unit_in area
+    of the input corresponds to a unit_out x unit_out area of the output - for VAE decoder those are 1 and 8, for encoder 8 and 1.
+    tile and overlap are measured in units of input: tile=64, overlap=16 for decoder means tiles of 64x64 latent pixels.
+    """
+
+    height, width = x.shape[2] // unit_in, x.shape[3] // unit_in
+    tile_h, tile_w = min(tile, height), min(tile, width)
+
+    out = None
+    weights = None
+
+    for y in tile_positions(height, tile_h, overlap):
+        for x0 in tile_positions(width, tile_w, overlap):
+            res = func(x[:, :, y * unit_in:(y + tile_h) * unit_in, x0 * unit_in:(x0 + tile_w) * unit_in])
+
+            if out is None:
+                out = torch.zeros((res.shape[0], res.shape[1], height * unit_out, width * unit_out), device=res.device, dtype=torch.float32)
+                weights = torch.zeros((1, 1, height * unit_out, width * unit_out), device=res.device, dtype=torch.float32)
+
+            weight_h = ramp(res.shape[2], overlap * unit_out, y > 0, y + tile_h < height, res.device)
+            weight_w = ramp(res.shape[3], overlap * unit_out, x0 > 0, x0 + tile_w < width, res.device)
+            weight = weight_h[:, None] * weight_w[None, :]
+
+            area = (slice(None), slice(None), slice(y * unit_out, y * unit_out + res.shape[2]), slice(x0 * unit_out, x0 * unit_out + res.shape[3]))
+            out[area] += res.float() * weight
+            weights[area] += weight
+
+    return (out / weights).to(res.dtype)
+
+
+def decode_tiled(decode, latents):
+    """decodes latents with decode function, in tiles of size set in settings"""
+
+    return process_tiled(decode, latents, shared.opts.sd_vae_tile_size, shared.opts.sd_vae_tile_overlap, 1, 8)
+
+
+def get_encode_tiling(image):
+    """returns True if the image should be encoded by VAE in tiles: because it's forced in settings, or because it would not fit into free memory"""
+
+    element_size = torch.empty((), dtype=devices.dtype_vae).element_size()
+    memory_per_sample = image.shape[2] * image.shape[3] * encode_memory_per_image_pixel * element_size
+
+    return pick_batch_size(1, memory_per_sample, False) == 0
+
+
+def encode_tiled(encode, image):
+    """encodes image with encode function, in tiles of size set in settings"""
+
+    return process_tiled(encode, image, shared.opts.sd_vae_tile_size, shared.opts.sd_vae_tile_overlap, 8, 1)
+
+
+def encode_image(encode, image):
+    """
+    Encodes a single (1, 3, H, W) image with encode function - either at once, or in overlapping tiles if it's too large
+    for free memory or runs out of memory while encoding (depending on settings). The image can stay on CPU: encode is
+    expected to move its input to the device, so when tiling only one tile at a time is on the GPU.
+    """
+
+    if not get_encode_tiling(image):
+        try:
+            return encode(image)
+        except Exception as e:
+            if not is_out_of_memory(e) or shared.opts.sd_vae_tiling == "Never":
+                raise
+
+            devices.torch_gc()
+            print("VAE ran out of memory; retrying with tiles")
+
+    return encode_tiled(encode, image)
@@ -58,6 +58,8 @@ options_templates.update(options_section(('saving-images', "Saving images/grids"
     "img_downscale_threshold": OptionInfo(4.0, "File size limit for the above option, MB", gr.Number),
     "target_side_length": OptionInfo(4000, "Width/height limit for the above option, in pixels", gr.Number),
     "img_max_size_mp": OptionInfo(200, "Maximum image size", gr.Number).info("in megapixels"),
+    "save_images_in_background": OptionInfo(True, "Save generated images in background").info("encode and write files in separate threads while next batches and jobs are generated; results are returned once all their files are written; not used when an extension handles the image saved callback"),
+    "save_images_threads": OptionInfo(2, "Number of threads for saving images in background", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}).needs_restart(),
 
     "use_original_name_batch": OptionInfo(True, "Use original name for output filename during batch process in extras tab"),
     "use_upscaler_name_as_suffix": OptionInfo(False, "Use upscaler name as filename suffix in the extras tab"),
@@ -122,6 +124,10 @@ options_templates.update(options_section(('system', "System", "system"), {
     "print_hypernet_extra": OptionInfo(False, "Print extra hypernetwork information to console."),
     "list_hidden_files": OptionInfo(True, "Load models/files in hidden directories").info("directory is hidden if its name starts with \".\""),
     "disable_mmap_load_safetensors": OptionInfo(False, "Disable memmapping for loading .safetensors files.").info("fixes very slow loading speed in some cases"),
+    "hash_threads": OptionInfo(4, "Number of threads for calculating hashes of model files in background", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}).needs_restart(),
+    "hash_io_limit": OptionInfo(2, "Maximum number of model files read at the same time for calculating hashes", gr.Slider, {"minimum": 1, "maximum": 16, "step": 1}).info("lower values are better for HDDs, higher for SSDs"),
+    "hash_models_in_background": OptionInfo(False, "Calculate missing hashes of checkpoints and Lora networks in background after listing them").info("hashes are otherwise calculated when a model is first used"),
+    "sd_checkpoint_streaming_load": OptionInfo(False, "Stream .safetensors checkpoints into model weights directly from a memory-mapped file").info("checkpoint is not read into RAM as a whole; every tensor is copied from disk into the model when it's loaded, converting its type if needed"),
     "hide_ldm_prints": OptionInfo(True, "Prevent Stability-AI's ldm/sgm modules from printing noise to console."),
     "dump_stacks_on_signal": OptionInfo(False, "Print stack traces before exiting the program with ctrl+c."),
 }))
@@ -130,6 +136,21 @@ options_templates.update(options_section(('API', "API", "system"), {
     "api_enable_requests": OptionInfo(True, "Allow http:// and https:// URLs for input images in API", restrict_api=True),
     "api_forbid_local_requests": OptionInfo(True, "Forbid URLs to local resources", restrict_api=True),
     "api_useragent": OptionInfo("", "User agent for requests", restrict_api=True),
+    "api_batch_requests": OptionInfo(False, "Generate compatible txt2img API requests together in one batch").info("requests waiting in queue that differ only in prompt, seed and batch size are generated as a single batch"),
+    "api_batch_max_size": OptionInfo(8, "Maximum batch size for combined API requests", gr.Slider, {"minimum": 1, "maximum": 64, "step": 1}),
+    "api_async_results_limit": OptionInfo(64, "Number of finished async API task results to keep", gr.Number, {"precision": 0}),
+    "api_async_results_ttl": OptionInfo(600, "Keep finished async API task results for", gr.Number, {"precision": 0}).info("in seconds; 0 = until evicted by the limit above"),
+    "api_coalesce_requests": OptionInfo(False, "Generate identical API requests only once").info("a txt2img or img2img request with a fixed seed that is identical to one already being generated waits for it and gets the same result, without running scripts again; requests that save images are never combined"),
+    "api_result_cache_ttl": OptionInfo(0, "Return results of identical API requests finished within", gr.Number, {"precision": 0}).info("in seconds; 0 = disable; only requests with a fixed seed are cached, and only when the option above is enabled"),
+}))
+
+options_templates.update(options_section(('queue', "Queue", "system"), {
+    "queue_fair_share": OptionInfo(False, "Share the generation queue fairly between users").info("among waiting tasks of the same priority, the one whose user has used the GPU the least recently goes first; otherwise tasks run in order of arrival"),
+    "queue_fair_share_half_life": OptionInfo(300, "Fair share usage half-life", gr.Number, {"precision": 0}).info("in seconds; how fast the time a user has spent generating is forgotten; 0 = never"),
+    "queue_preemption": OptionInfo(False, "Let waiting tasks run between batches of a running job").info("a task with higher priority, or from a user with a bigger fair share, runs between batch iterations or X/Y/Z plot cells of the current job, which then continues"),
+    "queue_ui_priority": OptionInfo("normal", "Priority of tasks from the web UI", gr.Radio, {"choices": ["high", "normal", "low"]}),
+    "queue_priority_header": OptionInfo("", "HTTP header with priority of API requests", restrict_api=True).info("for example, X-Priority; values: high, normal, low; any client that can reach the API can set it, so only use behind a proxy that sets or strips it; empty = all API requests have normal priority"),
+    "queue_user_header": OptionInfo("", "HTTP header with user name of API requests", restrict_api=True).info("used for fair share when API authentication is not enabled; empty = use client's address"),
 }))
 
 options_templates.update(options_section(('training', "Training", "training"), {
@@ -149,8 +170,12 @@ options_templates.update(options_section(('training', "Training", "training"), {
 
 options_templates.update(options_section(('sd', "Stable Diffusion", "sd"), {
     "sd_model_checkpoint": OptionInfo(None, "Stable Diffusion checkpoint", gr.Dropdown, lambda: {"choices": shared_items.list_checkpoint_tiles(shared.opts.sd_checkpoint_dropdown_use_short)}, refresh=shared_items.refresh_checkpoints, infotext='Model hash'),
-    "sd_checkpoints_limit": OptionInfo(1, "Maximum number of checkpoints loaded at the same time", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}),
-    "sd_checkpoints_keep_in_cpu": OptionInfo(True, "Only keep one model on device").info("will keep models other than the currently used one in RAM rather than VRAM"),
+    "sd_checkpoints_limit": OptionInfo(1, "Maximum number of checkpoints loaded at the same time", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}).info("not used if either of budgets below is set"),
+    "sd_checkpoints_keep_in_cpu": OptionInfo(True, "Only keep one model on device").info("will keep models other than the currently used one in RAM rather than VRAM; always on if RAM budget below is set without VRAM budget"),
+    "sd_checkpoints_vram_budget": OptionInfo(0, "VRAM budget for loaded checkpoints (MB)", gr.Number, {"precision": 0}).info("0 = disable; keep every loaded checkpoint, moving least recently used ones to RAM when their total size on GPU goes over this"),
+    "sd_checkpoints_ram_budget": OptionInfo(0, "RAM budget for loaded checkpoints (MB)", gr.Number, {"precision": 0}).info("0 = disable; keep every loaded checkpoint, moving least recently used ones to a memory-mapped temporary file on disk when their total size in RAM goes over this"),
+    "sd_checkpoints_disk_budget": OptionInfo(0, "Disk budget for loaded checkpoints (MB)", gr.Number, {"precision": 0}).info("0 = disable; only used with RAM budget; unload least recently used checkpoints and delete their temporary files when their total size on disk goes over this"),
+    "sd_checkpoint_prefetch": OptionInfo(False, "Prefetch checkpoints for queued requests").info("when an API request or X/Y/Z plot is going to switch to another checkpoint, read it into RAM in background while the current job is running"),
     "sd_checkpoint_cache": OptionInfo(0, "Checkpoints to cache in RAM", gr.Slider, {"minimum": 0, "maximum": 10, "step": 1}).info("obsolete; set to 0 and use the two settings above instead"),
     "sd_unet": OptionInfo("Automatic", "SD Unet", gr.Dropdown, lambda: {"choices": shared_items.sd_unet_items()}, refresh=shared_items.refresh_unet_list).info("choose Unet model: Automatic = use one with same filename as checkpoint; None = use Unet from checkpoint"),
     "enable_quantization": OptionInfo(False, "Enable quantization in K samplers for sharper and cleaner results. This may change existing seeds").needs_reload_ui(),
@@ -185,6 +210,10 @@ For img2img, VAE is used to process user's input image before the sampling, and
     "auto_vae_precision": OptionInfo(True, "Automatically revert VAE to 32-bit floats").info("triggers when a tensor with NaNs is produced in VAE; disabling the option in this case will result in a black square image"),
     "sd_vae_encode_method": OptionInfo("Full", "VAE type for encode", gr.Radio, {"choices": ["Full", "TAESD"]}, infotext='VAE Encoder').info("method to encode image to latent (use in img2img, hires-fix or inpaint mask)"),
     "sd_vae_decode_method": OptionInfo("Full", "VAE type for decode", gr.Radio, {"choices": ["Full", "TAESD"]}, infotext='VAE Decoder').info("method to decode latent to image"),
+    "sd_vae_batch_decode": OptionInfo(True, "Decode multiple images with VAE at once").info("as many as fits into free VRAM"),
+    "sd_vae_tiling": OptionInfo("Automatic", "Tiled VAE", gr.Radio, {"choices": ["Automatic", "Always", "Never"]}).info("process images that are too large to fit into VRAM in overlapping tiles; Automatic = only when needed"),
+    "sd_vae_tile_size": OptionInfo(64, "Tiled VAE tile size", gr.Slider, {"minimum": 16, "maximum": 256, "step": 8}).info("in latent pixels; 64 = 512 image pixels"),
+    "sd_vae_tile_overlap": OptionInfo(16, "Tiled VAE tile overlap", gr.Slider, {"minimum": 0, "maximum": 64, "step": 4}).info("in latent pixels; tiles are blended together in the overlapping area to hide seams"),
 }))
 
 options_templates.update(options_section(('img2img', "img2img", "sd"), {
@@ -207,13 +236,19 @@ options_templates.update(options_section(('img2img', "img2img", "sd"), {
 options_templates.update(options_section(('optimizations', "Optimizations", "sd"), {
     "cross_attention_optimization": OptionInfo("Automatic", "Cross attention optimization", gr.Dropdown, lambda: {"choices": shared_items.cross_attention_optimizations()}),
     "s_min_uncond": OptionInfo(0.0, "Negative Guidance minimum sigma", gr.Slider, {"minimum": 0.0, "maximum": 15.0, "step": 0.01}).link("PR", "https://github.com/AUTOMATIC1111/stable-diffusion-webui/pull/9177").info("skip negative prompt for some steps when the image is almost ready; 0=disable, higher=faster"),
+    "cfg_truncation_threshold": OptionInfo(0.0, "Adaptive guidance truncation threshold", gr.Slider, {"minimum": 0.0, "maximum": 0.2, "step": 0.001}, infotext='Adaptive guidance').info("stop denoising negative prompt for the remaining steps once predictions for prompt and negative prompt differ by less than this fraction; 0=disable, higher=faster"),
     "token_merging_ratio": OptionInfo(0.0, "Token merging ratio", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}, infotext='Token merging ratio').link("PR", "https://github.com/AUTOMATIC1111/stable-diffusion-webui/pull/9256").info("0=disable, higher=faster"),
     "token_merging_ratio_img2img": OptionInfo(0.0, "Token merging ratio for img2img", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}).info("only applies if non-zero and overrides above"),
     "token_merging_ratio_hr": OptionInfo(0.0, "Token merging ratio for high-res pass", gr.Slider, {"minimum": 0.0, "maximum": 0.9, "step": 0.1}, infotext='Token merging ratio hr').info("only applies if non-zero and overrides above"),
     "pad_cond_uncond": OptionInfo(False, "Pad prompt/negative prompt", infotext='Pad conds').info("improves performance when prompt and negative prompt have different lengths; changes seeds"),
     "pad_cond_uncond_v0": OptionInfo(False, "Pad prompt/negative prompt (v0)", infotext='Pad conds v0').info("alternative implementation for the above; used prior to 1.6.0 for DDIM sampler; overrides the above if set; WARNING: truncates negative prompt if it's too long; changes seeds"),
     "persistent_cond_cache": OptionInfo(True, "Persistent cond cache").info("do not recalculate conds from prompts if prompts have not changed since previous calculation"),
+    "cond_cache_size": OptionInfo(128, "Prompt conditioning cache size", gr.Number).info("in megabytes; keeps conds for recently used prompts across all requests; 0 = disable"),
     "batch_cond_uncond": OptionInfo(True, "Batch cond/uncond").info("do both conditional and unconditional denoising in one batch; uses a bit more VRAM during sampling, but improves speed; previously this was controlled by --always-batch-cond-uncond comandline argument"),
+    "cfg_batch_planner": OptionInfo(True, "Fit cond/uncond batches into free VRAM").info("denoise as many samples in one UNet call as fit into free VRAM, as measured on previous steps; with the option above disabled, only make batches smaller when they do not fit; split the batch instead of failing when VRAM runs out"),
+    "unet_feature_cache_interval": OptionInfo(1, "UNet feature cache refresh interval", gr.Slider, {"minimum": 1, "maximum": 10, "step": 1}, infotext='Feature cache').info("run the whole UNet only on every Nth step, and reuse its deep features on steps in between, running only shallow blocks; 1=disable, higher=faster, lower quality; for drafts"),
+    "unet_feature_cache_depth": OptionInfo(0, "UNet feature cache depth", gr.Slider, {"minimum": 0, "maximum": 11, "step": 1}, infotext='Feature cache depth').info("how many blocks below the topmost one to still run on cached steps; 0=fastest, higher=closer to the uncached result"),
+    "cfg_reuse_conds": OptionInfo(True, "Reuse cond/uncond tensors between steps").info("build padded and combined prompt/negative prompt tensors only when prompt schedule changes, instead of on every step; not done while a script with a denoiser callback is active"),
     "fp8_storage": OptionInfo("Disable", "FP8 weight", gr.Radio, {"choices": ["Disable", "Enable for SDXL", "Enable"]}).info("Use FP8 to store Linear/Conv layers' weight. Require pytorch>=2.1.0."),
     "cache_fp16_weight": OptionInfo(False, "Cache FP16 weight for LoRA").info("Cache fp16 weight when enabling FP8, will increase the quality of LoRA. Use more system ram."),
 }))
@@ -263,7 +263,7 @@ class UiSettings:
             )
 
             def calculate_all_checkpoint_hash_fn(max_thread):
-                checkpoints_list = sd_models.checkpoints_list.values()
+                checkpoints_list = list(sd_models.checkpoints_list.values())
                 with ThreadPoolExecutor(max_workers=max_thread) as executor:
                     futures = [executor.submit(checkpoint.calculate_shorthash) for checkpoint in checkpoints_list]
                     completed = 0
@@ -0,0 +1,217 @@
+import atexit
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+import urllib3
+
+from modules import errors, shared
+from modules.paths_internal import script_path
+
+# command line options that are set differently for every worker, or only make sense for the process serving users
+removed_options_with_value = {"--worker-devices", "--worker-base-port", "--worker-timeout", "--port", "--device-id", "--server-name", "--ngrok", "--ngrok-region", "--ngrok-options", "--subpath", "--tls-keyfile", "--tls-certfile"}
+removed_flags = {"--nowebui", "--listen", "--share", "--autolaunch", "--api-server-stop"}
+
+connect_timeout = 10
+"""seconds to wait for a worker to accept a connection; the time to wait for a response is set by --worker-timeout"""
+
+pool = None
+
+
+def worker_arguments(argv, device, port):
+    """returns command line arguments for a worker process that serves API on the given port and generates on the given device"""
+
+    res = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+            continue
+
+        name = arg.split("=", 1)[0]
+        if name in removed_options_with_value:
+            skip = "=" not in arg
+            continue
+
+        if name in removed_flags:
+            continue
+
+        res.append(arg)
+
+    res += ["--nowebui", "--port", str(port)]
+
+    if device == "cpu":
+        res += ["--use-cpu", "all"]
+    else:
+        res += ["--device-id", device]
+
+    return res
+
+
+class Worker:
+    def __init__(self, index, device, port):
+        self.index = index
+        self.device = device
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.process = None
+        self.ready = False
+        self.busy = False
+        self.tasks_done = 0
+
+    def start(self):
+        args = worker_arguments(sys.argv[1:], self.device, self.port)
+        print(f"Starting worker {self.index} for device {self.device} on port {self.port}")
+
+        self.ready = False
+        self.process = subprocess.Popen([sys.executable, os.path.join(script_path, "webui.py"), *args], cwd=script_path)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.is_alive():
+            self.process.terminate()
+
+
+class WorkerPool:
+    """
+    Runs one API-only webui process per device, each with its own model, and dispatches generation requests to them.
+    Every request is given to a worker that is idle, waiting for one if all are busy; workers share settings and the
+    cache of model hashes with this process through config files and the cache database.
+    """
+
+    def __init__(self, devices, base_port):
+        self.workers = [Worker(i, device, base_port + i) for i, device in enumerate(devices)]
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.auth = None
+
+        if shared.cmd_opts.api_auth:
+            user, password = shared.cmd_opts.api_auth.split(",")[0].split(":")
+            self.auth = (user, password)
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+        atexit.register(self.stop)
+        threading.Thread(target=self.monitor, name="worker-pool-monitor", daemon=True).start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def monitor(self):
+        """waits for workers to become ready, and restarts the ones that have exited"""
+
+        while True:
+            for worker in self.workers:
+                with self.lock:
+                    if not worker.is_alive():
+                        if worker.process is not None:
+                            print(f"Worker {worker.index} for device {worker.device} has exited with code {worker.process.returncode}; restarting")
+                        worker.busy = False
+                        worker.start()
+                        continue
+
+                    if worker.ready:
+                        continue
+
+                try:
+                    requests.get(f"{worker.url}/sdapi/v1/cmd-flags", auth=self.auth, timeout=5).raise_for_status()
+                except Exception:
+                    continue
+
+                with self.lock:
+                    worker.ready = True
+                    print(f"Worker {worker.index} for device {worker.device} is ready")
+                    self.idle.put(worker)
+
+            time.sleep(1)
+
+    def acquire(self):
+        """waits until some worker is idle, marks it as busy and returns it"""
+
+        while True:
+            worker = self.idle.get()
+
+            with self.lock:
+                if worker.ready and not worker.busy and worker.is_alive():
+                    worker.busy = True
+                    return worker
+
+    def release(self, worker):
+        with self.lock:
+            worker.busy = False
+            worker.tasks_done += 1
+
+            if worker.ready and worker.is_alive():
+                self.idle.put(worker)
+
+    def post(self, path, payload, stream=False, on_acquire=None):
+        """
+        Sends the request to an idle worker. Returns a tuple of (worker, response); the caller must call release(worker)
+        once it's done with the response. on_acquire(worker) is called as soon as a worker is picked for the request.
+
+        If the worker can't be connected to, it's marked as not ready, and the request is retried on another worker. Any
+        other error, including timeouts and connection errors after the request may have been sent, releases the worker
+        and is raised.
+        """
+
+        while True:
+            worker = self.acquire()
+
+            try:
+                if on_acquire is not None:
+                    on_acquire(worker)
+
+                return worker, requests.post(f"{worker.url}{path}", json=payload, auth=self.auth, stream=stream, timeout=(connect_timeout, shared.cmd_opts.worker_timeout))
+            except requests.ConnectionError as e:
+                if not is_connect_error(e):
+                    self.release(worker)
+                    raise
+
+                errors.display(e, f"sending request to worker {worker.index}")
+
+                with self.lock:
+                    worker.ready = False
+                    worker.busy = False
+            except BaseException:
+                self.release(worker)
+                raise
+
+    def status(self):
+        with self.lock:
+            return [{"index": w.index, "device": w.device, "url": w.url, "ready": w.ready, "busy": w.busy, "tasks_done": w.tasks_done} for w in self.workers]
+
+
+def is_connect_error(e):
+    """True if requests failed to connect to the server, so the request was never sent and can be safely sent elsewhere"""
+
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+
+    reason = e.args[0] if e.args else None
+    reason = getattr(reason, "reason", reason)
+
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+
+def start():
+    """starts the worker pool if --worker-devices is set on command line"""
+
+    global pool
+
+    if not shared.cmd_opts.worker_devices or pool is not None:
+        return
+
+    devices = [x.strip().lower() for x in shared.cmd_opts.worker_devices.split(",") if x.strip()]
+    base_port = shared.cmd_opts.worker_base_port or (shared.cmd_opts.port or 7860) + 1
+
+    pool = WorkerPool(devices, base_port)
+    pool.start()
@@ -11,7 +11,7 @@ import numpy as np
 import modules.scripts as scripts
 import gradio as gr
 
-from modules import images, sd_samplers, processing, sd_models, sd_vae, sd_samplers_kdiffusion, errors
+from modules import images, sd_samplers, processing, sd_models, sd_vae, sd_samplers_kdiffusion, errors, sd_models_prefetch, queue_scheduler
 from modules.processing import process_images, Processed, StableDiffusionProcessingTxt2Img
 from modules.shared import opts, state
 import modules.shared as shared
@@ -79,6 +79,11 @@ def apply_checkpoint(p, x, xs):
         raise RuntimeError(f"Unknown checkpoint: {x}")
     p.override_settings['sd_model_checkpoint'] = info.name
 
+    # start reading the checkpoint for the next cell while this one is being generated
+    next_index = xs.index(x) + 1
+    if next_index < len(xs):
+        sd_models_prefetch.prefetch_for_request({'sd_model_checkpoint': xs[next_index]})
+
 
 def confirm_checkpoints(p, xs):
     for x in xs:
@@ -265,6 +270,7 @@ axis_options = [
     AxisOption("Face restore", str, apply_face_restore, format_value=format_value),
     AxisOption("Token merging ratio", float, apply_override('token_merging_ratio')),
     AxisOption("Token merging ratio high-res", float, apply_override('token_merging_ratio_hr')),
+    AxisOption("UNet feature cache interval", int, apply_override('unet_feature_cache_interval')),
     AxisOption("Always discard next-to-last sigma", str, apply_override('always_discard_next_to_last_sigma', boolean=True), choices=boolean_choice(reverse=True)),
     AxisOption("SGM noise multiplier", str, apply_override('sgm_noise_multiplier', boolean=True), choices=boolean_choice(reverse=True)),
     AxisOption("Refiner checkpoint", str, apply_field('refiner_checkpoint'), format_value=format_remove_path, confirm=confirm_checkpoints_or_none, cost=1.0, choices=lambda: ['None'] + sorted(sd_models.checkpoints_list, key=str.casefold)),
@@ -391,7 +397,9 @@ class SharedSettingsStackHelper(object):
         self.vae = opts.sd_vae
         self.uni_pc_order = opts.uni_pc_order
 
-    def __exit__(self, exc_type, exc_value, tb):
+        return self
+
+    def restore(self):
         opts.data["sd_vae"] = self.vae
         opts.data["uni_pc_order"] = self.uni_pc_order
         modules.sd_models.reload_model_weights()
@@ -399,6 +407,9 @@ class SharedSettingsStackHelper(object):
 
         opts.data["CLIP_stop_at_last_layers"] = self.CLIP_stop_at_last_layers
 
+    def __exit__(self, exc_type, exc_value, tb):
+        self.restore()
+
 
 re_range = re.compile(r"\s*([+-]?\s*\d+)\s*-\s*([+-]?\s*\d+)(?:\s*\(([+-]\d+)\s*\))?\s*")
 re_range_float = re.compile(r"\s*([+-]?\s*\d+(?:.\d*)?)\s*-\s*([+-]?\s*\d+(?:.\d*)?)(?:\s*\(([+-]\d+(?:.\d*)?)\s*\))?\s*")
@@ -703,6 +714,9 @@ class Script(scripts.Script):
             if shared.state.interrupted or state.stopping_generation:
                 return Processed(p, [], p.seed, "")
 
+            # every cell is a separate job for the queue; settings changed by axes are set again below, after other jobs
+            queue_scheduler.preemption_point(prepare=shared_settings.restore)
+
             pc = copy(p)
             pc.styles = pc.styles[:]
             x_opt.apply(pc, x, xs)
@@ -760,7 +774,7 @@ class Script(scripts.Script):
 
             return res
 
-        with SharedSettingsStackHelper():
+        with SharedSettingsStackHelper() as shared_settings:
             processed = draw_xyz_grid(
                 p,
                 xs=xs,
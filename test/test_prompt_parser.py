@@ -0,0 +1,39 @@
+import pytest
+
+prompts = [
+    "a photograph of an astronaut riding a horse",
+    "masterpiece, (photorealistic:1.3), ((sharp focus)), [blurry] BREAK (film grain:0.8), bokeh",
+    "a [cat:dog:0.4] in a [forest|city] at [dawn:dusk:12], \\(literal\\)",
+]
+
+
+@pytest.mark.parametrize("prompt", prompts)
+def test_parse_prompt_attention_memoized(initialize, prompt):
+    from modules import prompt_parser
+
+    prompt_parser.parse_prompt_attention_cached.cache_clear()
+    cold = prompt_parser.parse_prompt_attention(prompt)
+
+    # callers modify returned lists, which must not change what's returned for the same prompt later
+    cold[0][1] = 100.0
+    cold.append(["extra", 1.0])
+
+    memoized = prompt_parser.parse_prompt_attention(prompt)
+    prompt_parser.parse_prompt_attention_cached.cache_clear()
+
+    assert memoized == prompt_parser.parse_prompt_attention(prompt)
+    assert memoized[0][1] != 100.0
+
+
+@pytest.mark.parametrize("prompt", prompts)
+def test_prompt_schedules_memoized(initialize, prompt):
+    from modules import prompt_parser
+
+    prompt_parser.get_prompt_schedule.cache_clear()
+    cold = prompt_parser.get_learned_conditioning_prompt_schedules([prompt], 20, 30)
+    expected = [[list(entry) for entry in schedule] for schedule in cold]
+    cold[0][0][1] = "changed"
+
+    memoized = prompt_parser.get_learned_conditioning_prompt_schedules([prompt], 20, 30)
+
+    assert memoized == expected
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import torch
+
+seeds = [1, 42, 2 ** 32 + 7]
+
+
+@pytest.mark.parametrize("shape", [(5,), (3, 7), (4, 8, 8)])
+@pytest.mark.parametrize("offset", [0, 1])
+def test_philox_randn_seeds(initialize, shape, offset):
+    from modules import rng_philox
+
+    res = rng_philox.randn_seeds(seeds, offset, shape)
+
+    assert res.shape == (len(seeds),) + shape
+    for i, seed in enumerate(seeds):
+        generator = rng_philox.Generator(seed)
+        for _ in range(offset):
+            generator.randn(shape)
+
+        assert np.array_equal(res[i], generator.randn(shape))
+
+
+@pytest.mark.parametrize("randn_source", ["NV", "CPU"])
+@pytest.mark.parametrize("subseed_strength", [0.0, 0.3])
+@pytest.mark.parametrize("resize_from", [(0, 0), (96, 256)])
+def test_image_rng_first(initialize, monkeypatch, randn_source, subseed_strength, resize_from):
+    from modules import rng, shared
+
+    monkeypatch.setitem(shared.opts.data, "randn_source", randn_source)
+    monkeypatch.setitem(shared.opts.data, "eta_noise_seed_delta", 0)
+    monkeypatch.setattr(rng, "noise_cache", type(rng.noise_cache)())
+
+    shape = (4, 16, 24)
+    subseeds = [100, 200]
+
+    def make():
+        return rng.ImageRNG(shape, seeds, subseeds=subseeds, subseed_strength=subseed_strength, seed_resize_from_h=resize_from[0], seed_resize_from_w=resize_from[1])
+
+    # noise made for every seed and subseed separately, without the noise cache
+    g = make()
+    noise_shape = shape if resize_from == (0, 0) else (shape[0], resize_from[0] // 8, resize_from[1] // 8)
+    g.is_first = False
+    expected = g.first_torch(noise_shape), g.next()
+
+    g = make()
+    assert all(torch.equal(a, b) for a, b in zip(expected, (g.next(), g.next())))
+    assert len(rng.noise_cache) == 1
+
+    # the same parameters again take noise from the cache, and must leave generators in the same state
+    g = make()
+    assert all(torch.equal(a, b) for a, b in zip(expected, (g.next(), g.next())))
+    assert len(rng.noise_cache) == 1
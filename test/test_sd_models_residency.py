@@ -0,0 +1,122 @@
+import os
+import types
+
+import pytest
+import torch
+
+mb = 1024 * 1024
+
+
+class FakeModel:
+    def __init__(self, title, gpu=0, cpu=0):
+        self.sd_checkpoint_info = types.SimpleNamespace(title=title)
+        self.lowvram = False
+        self.residency_disk_file = None
+        self.sizes = {"gpu": gpu, "cpu": cpu, "disk": 0}
+
+
+@pytest.fixture()
+def residency(initialize, monkeypatch):
+    from modules import sd_models, sd_models_residency
+
+    def send_model_to_cpu(m):
+        m.sizes["cpu"] += m.sizes["gpu"]
+        m.sizes["gpu"] = 0
+
+    def send_model_to_disk(m):
+        m.sizes["disk"] += m.sizes["cpu"]
+        m.sizes["cpu"] = 0
+        m.residency_disk_file = f"{m.sd_checkpoint_info.title}.bin"
+
+    monkeypatch.setattr(sd_models, "send_model_to_cpu", send_model_to_cpu)
+    monkeypatch.setattr(sd_models_residency, "send_model_to_disk", send_model_to_disk)
+    monkeypatch.setattr(sd_models_residency, "get_model_sizes", lambda m: dict(m.sizes))
+
+    return sd_models_residency
+
+
+def test_ram_budget_without_vram_budget(residency, monkeypatch):
+    from modules import shared
+
+    monkeypatch.setitem(shared.opts.data, "sd_checkpoints_vram_budget", 0)
+    monkeypatch.setitem(shared.opts.data, "sd_checkpoints_ram_budget", 3000)
+
+    current = FakeModel("current", gpu=2000 * mb)
+    recent = FakeModel("recent", gpu=2000 * mb)
+    old = FakeModel("old", cpu=2000 * mb)
+    models = [current, recent, old]
+
+    residency.enforce_budgets(models, keep=current)
+
+    # only the model in use stays on GPU, and the least recently used one goes to disk to fit others into RAM budget
+    assert current.sizes == {"gpu": 2000 * mb, "cpu": 0, "disk": 0}
+    assert recent.sizes == {"gpu": 0, "cpu": 2000 * mb, "disk": 0}
+    assert old.sizes == {"gpu": 0, "cpu": 0, "disk": 2000 * mb}
+
+
+def test_vram_budget(residency, monkeypatch):
+    from modules import shared
+
+    monkeypatch.setitem(shared.opts.data, "sd_checkpoints_vram_budget", 5000)
+    monkeypatch.setitem(shared.opts.data, "sd_checkpoints_ram_budget", 0)
+
+    current = FakeModel("current", gpu=2000 * mb)
+    recent = FakeModel("recent", gpu=2000 * mb)
+    old = FakeModel("old", gpu=2000 * mb)
+    models = [current, recent, old]
+
+    residency.enforce_budgets(models, keep=current)
+
+    assert current.sizes["gpu"] == 2000 * mb
+    assert recent.sizes["gpu"] == 2000 * mb
+    assert old.sizes == {"gpu": 0, "cpu": 2000 * mb, "disk": 0}
+
+
+def test_disk_budget(residency, monkeypatch):
+    from modules import shared
+
+    monkeypatch.setitem(shared.opts.data, "sd_checkpoints_vram_budget", 0)
+    monkeypatch.setitem(shared.opts.data, "sd_checkpoints_ram_budget", 1000)
+    monkeypatch.setitem(shared.opts.data, "sd_checkpoints_disk_budget", 3000)
+
+    current = FakeModel("current", gpu=2000 * mb)
+    recent = FakeModel("recent", cpu=2000 * mb)
+    old = FakeModel("old", cpu=2000 * mb)
+    models = [current, recent, old]
+
+    removed = residency.enforce_budgets(models, keep=current)
+
+    # both models go to disk to fit into RAM budget, and then the least recently used one is unloaded to fit into disk budget
+    assert removed == [old]
+    assert models == [current, recent]
+    assert recent.sizes == {"gpu": 0, "cpu": 0, "disk": 2000 * mb}
+
+
+def test_disk_round_trip(initialize):
+    from modules import sd_models_residency
+
+    model = torch.nn.Sequential(torch.nn.Linear(7, 5), torch.nn.BatchNorm1d(5))
+    model.eval()
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+    x = torch.randn(3, 7)
+    with torch.no_grad():
+        expected_output = model(x)
+
+    sd_models_residency.send_model_to_disk(model)
+    filename = model.residency_disk_file
+
+    assert os.path.exists(filename)
+    assert sd_models_residency.get_model_sizes(model)["cpu"] == 0
+    assert sd_models_residency.get_model_sizes(model)["disk"] > 0
+    with torch.no_grad():
+        assert torch.equal(model(x), expected_output)
+
+    sd_models_residency.release_disk_file(model)
+
+    assert not os.path.exists(filename)
+    assert not sd_models_residency.is_on_disk(model)
+    assert sd_models_residency.get_model_sizes(model)["disk"] == 0
+    for k, v in model.state_dict().items():
+        assert torch.equal(v, expected[k])
+    with torch.no_grad():
+        assert torch.equal(model(x), expected_output)
@@ -0,0 +1,86 @@
+import types
+
+import pytest
+import torch
+
+
+@pytest.fixture()
+def denoiser(initialize, monkeypatch):
+    from modules import prompt_parser, sd_models, sd_samplers_cfg_denoiser, sd_samplers_common
+
+    fake_model = types.SimpleNamespace(cond_stage_key="crossattn", model=types.SimpleNamespace(conditioning_key="crossattn"))
+    monkeypatch.setattr(sd_models.model_data, "sd_model", fake_model)
+    monkeypatch.setattr(sd_models.model_data, "was_loaded_at_least_once", True)
+    monkeypatch.setattr(sd_samplers_common, "apply_refiner", lambda cfg_denoiser: False)
+    monkeypatch.setattr(sd_samplers_common, "store_latent", lambda decoded: None)
+
+    class Denoiser(sd_samplers_cfg_denoiser.CFGDenoiser):
+        """CFGDenoiser around a model whose prediction depends on the prompt; records sizes of batches given to it"""
+
+        def __init__(self):
+            super().__init__(types.SimpleNamespace(sampler_extra_args={}, last_latent=None))
+            self.total_steps = 10
+            self.batch_sizes = []
+
+        @property
+        def inner_model(self):
+            return self.predict
+
+        def predict(self, x, sigma, cond):
+            self.batch_sizes.append(x.shape[0])
+            return x * 0.5 + cond["c_crossattn"][0].mean(dim=(1, 2))[:, None, None, None] / (sigma[:, None, None, None] + 1)
+
+    cond = prompt_parser.MulticondLearnedConditioning(shape=(1,), batch=[[prompt_parser.ComposableScheduledPromptConditioning([prompt_parser.ScheduledPromptConditioning(10, torch.ones((8, 4)))])]])
+    uncond = [[prompt_parser.ScheduledPromptConditioning(10, torch.zeros((8, 4)))]]
+
+    def run(steps, cond_scale=7.0):
+        model = Denoiser()
+        x = torch.randn((1, 4, 8, 8), generator=torch.Generator().manual_seed(0))
+        image_cond = torch.zeros((1, 5, 1, 1))
+
+        outputs = []
+        with torch.no_grad():
+            for sigma in torch.linspace(10, 1, steps):
+                outputs.append(model(x, sigma[None], uncond, cond, cond_scale, 0, image_cond))
+
+        return model, outputs
+
+    return run
+
+
+def expected_cfg(x, sigma, cond_scale):
+    denoised_cond = x * 0.5 + 1 / (sigma + 1)
+    denoised_uncond = x * 0.5
+    return denoised_uncond + (denoised_cond - denoised_uncond) * cond_scale
+
+
+def test_truncation_disabled_at_threshold_zero(denoiser, monkeypatch):
+    from modules import shared
+
+    monkeypatch.setitem(shared.opts.data, "cfg_truncation_threshold", 0)
+    model, outputs = denoiser(5)
+
+    # at threshold 0, every step denoises both cond and uncond, and results are the same as plain CFG
+    assert model.guidance_truncated_at is None
+    assert sum(model.batch_sizes) == 2 * 5
+
+    x = torch.randn((1, 4, 8, 8), generator=torch.Generator().manual_seed(0))
+    for sigma, output in zip(torch.linspace(10, 1, 5), outputs):
+        assert torch.allclose(output, expected_cfg(x, sigma, 7.0))
+
+
+def test_truncation_skips_uncond(denoiser, monkeypatch):
+    from modules import shared
+
+    monkeypatch.setitem(shared.opts.data, "cfg_truncation_threshold", 1e9)
+    model, outputs = denoiser(5)
+
+    # guidance is truncated after the first step, so uncond is only denoised there, and only cond prediction is used after
+    assert model.guidance_truncated_at == 0
+    assert sum(model.batch_sizes) == 2 + 4
+
+    x = torch.randn((1, 4, 8, 8), generator=torch.Generator().manual_seed(0))
+    sigmas = torch.linspace(10, 1, 5)
+    assert torch.allclose(outputs[0], expected_cfg(x, sigmas[0], 7.0))
+    for sigma, output in zip(sigmas[1:], outputs[1:]):
+        assert torch.allclose(output, expected_cfg(x, sigma, 1.0))
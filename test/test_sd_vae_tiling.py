@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+
+@pytest.mark.parametrize("size,tile,overlap", [(64, 64, 16), (100, 64, 16), (130, 32, 8), (7, 3, 1)])
+def test_tile_positions_cover_range(initialize, size, tile, overlap):
+    from modules import sd_vae_tiling
+
+    positions = sd_vae_tiling.tile_positions(size, tile, overlap)
+
+    assert positions[0] == 0
+    assert positions[-1] + min(tile, size) == size
+    for a, b in zip(positions, positions[1:]):
+        assert b - a <= tile - overlap
+
+
+@pytest.mark.parametrize("unit_in,unit_out", [(1, 1), (1, 8), (8, 1)])
+def test_process_tiled_matches_whole_for_local_func(initialize, unit_in, unit_out):
+    from modules import sd_vae_tiling
+
+    # a function where every output pixel depends only on its own input area gives the same result in tiles as at once
+    def func(x):
+        if unit_out > unit_in:
+            x = torch.nn.functional.interpolate(x, scale_factor=unit_out, mode="nearest")
+        elif unit_in > unit_out:
+            x = torch.nn.functional.avg_pool2d(x, unit_in)
+
+        return x * 2 + 1
+
+    x = torch.randn((2, 3, 40 * unit_in, 56 * unit_in), generator=torch.Generator().manual_seed(0))
+
+    tiled = sd_vae_tiling.process_tiled(func, x, 16, 4, unit_in, unit_out)
+
+    assert torch.allclose(tiled, func(x), atol=1e-5)
+
+
+@pytest.mark.parametrize("allow_batching", [True, False])
+def test_pick_batch_size_without_memory_info(initialize, monkeypatch, allow_batching):
+    from modules import sd_vae_tiling, shared
+
+    monkeypatch.setitem(shared.opts.data, "sd_vae_tiling", "Automatic")
+    monkeypatch.setattr(sd_vae_tiling, "get_free_memory", lambda: None)
+
+    assert sd_vae_tiling.pick_batch_size(4, 1024, allow_batching) == 1
@@ -1,4 +1,7 @@
 
+import base64
+import json
+
 import pytest
 import requests
 
@@ -88,3 +91,97 @@ def test_txt2img_multiple_batches_performed(url_txt2img, simple_txt2img_request)
 def test_txt2img_batch_performed(url_txt2img, simple_txt2img_request):
     simple_txt2img_request["batch_size"] = 2
     assert requests.post(url_txt2img, json=simple_txt2img_request).status_code == 200
+
+
+def test_txt2img_async_performed(base_url, url_txt2img, simple_txt2img_request):
+    response = requests.post(f"{url_txt2img}/async", json=simple_txt2img_request)
+    assert response.status_code == 200
+
+    task_id = response.json()["task_id"]
+    status = requests.get(f"{base_url}/sdapi/v1/tasks/{task_id}", params={"wait": 60}).json()
+    assert status["status"] == "done"
+    assert len(status["result"]["images"]) == 1
+
+
+def test_txt2img_webp_in_json(url_txt2img, simple_txt2img_request):
+    simple_txt2img_request["accept"] = "image/webp"
+    response = requests.post(url_txt2img, json=simple_txt2img_request)
+    assert response.status_code == 200
+    assert base64.b64decode(response.json()["images"][0])[8:12] == b"WEBP"
+
+
+def test_txt2img_multipart(url_txt2img, simple_txt2img_request):
+    simple_txt2img_request["accept"] = "multipart/mixed, image/png"
+    response = requests.post(url_txt2img, json=simple_txt2img_request)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("multipart/mixed")
+    assert b"\x89PNG" in response.content
+
+
+def test_txt2img_file_references(url_txt2img, simple_txt2img_request):
+    simple_txt2img_request["accept"] = "text/uri-list"
+    assert requests.post(url_txt2img, json=simple_txt2img_request).status_code == 422
+
+    simple_txt2img_request["save_images"] = True
+    response = requests.post(url_txt2img, json=simple_txt2img_request)
+    assert response.status_code == 200
+    assert response.json()["images"][0].startswith("/file=")
+
+
+def test_txt2img_unsupported_accept(base_url, url_txt2img, simple_txt2img_request):
+    simple_txt2img_request["accept"] = "video/mp4"
+    simple_txt2img_request["force_task_id"] = "task(test-unsupported-accept)"
+    assert requests.post(url_txt2img, json=simple_txt2img_request).status_code == 406
+
+    # the request is rejected before it's queued, so it's never run
+    progress = requests.post(f"{base_url}/internal/progress", json={"id_task": "task(test-unsupported-accept)"}).json()
+    assert not progress["queued"]
+    assert not progress["completed"]
+
+
+def test_txt2img_streaming(url_txt2img, simple_txt2img_request):
+    simple_txt2img_request["n_iter"] = 2
+    simple_txt2img_request["accept"] = "application/x-ndjson"
+    response = requests.post(url_txt2img, json=simple_txt2img_request, stream=True)
+    assert response.status_code == 200
+
+    events = [json.loads(line) for line in response.iter_lines() if line]
+    assert [event["event"] for event in events] == ["image", "image", "done"]
+    assert all(event["image"] and event["info"] for event in events[:2])
+
+
+def test_txt2img_batched_requests(base_url, url_txt2img, simple_txt2img_request):
+    from concurrent.futures import ThreadPoolExecutor
+
+    def make_request(i):
+        return {**simple_txt2img_request, "prompt": f"example prompt {i}", "batch_size": i + 1}
+
+    requests.post(f"{base_url}/sdapi/v1/options", json={"api_batch_requests": True})
+    try:
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            responses = list(executor.map(lambda i: requests.post(url_txt2img, json=make_request(i)), range(3)))
+    finally:
+        requests.post(f"{base_url}/sdapi/v1/options", json={"api_batch_requests": False})
+
+    for i, response in enumerate(responses):
+        assert response.status_code == 200
+        assert len(response.json()["images"]) == i + 1
+
+        info = json.loads(response.json()["info"])
+        assert len(info["infotexts"]) == i + 1
+        assert all(text.startswith(f"example prompt {i}\n") for text in info["infotexts"])
+
+
+def test_txt2img_coalesced_duplicates(base_url, url_txt2img, simple_txt2img_request):
+    from concurrent.futures import ThreadPoolExecutor
+
+    simple_txt2img_request["seed"] = 12345
+    requests.post(f"{base_url}/sdapi/v1/options", json={"api_coalesce_requests": True})
+    try:
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            responses = list(executor.map(lambda _: requests.post(url_txt2img, json=simple_txt2img_request), range(3)))
+    finally:
+        requests.post(f"{base_url}/sdapi/v1/options", json={"api_coalesce_requests": False})
+
+    assert all(response.status_code == 200 for response in responses)
+    assert len({response.json()["images"][0] for response in responses}) == 1
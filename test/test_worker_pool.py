@@ -0,0 +1,86 @@
+import types
+
+import pytest
+import requests
+import urllib3
+
+from modules import worker_pool
+
+
+def make_pool(devices):
+    pool = worker_pool.WorkerPool(devices, 7861)
+
+    for worker in pool.workers:
+        worker.process = types.SimpleNamespace(poll=lambda: None, terminate=lambda: None)
+        worker.ready = True
+        pool.idle.put(worker)
+
+    return pool
+
+
+def test_worker_arguments():
+    args = worker_pool.worker_arguments(["--api", "--port", "7860", "--listen", "--worker-devices=0,1", "--worker-timeout", "60", "--xformers"], "1", 7862)
+    assert args == ["--api", "--xformers", "--nowebui", "--port", "7862", "--device-id", "1"]
+
+
+def test_worker_released_after_error(monkeypatch):
+    pool = make_pool(["cpu"])
+    worker = pool.workers[0]
+
+    def post(*args, **kwargs):
+        assert kwargs["timeout"] is not None
+        raise requests.ReadTimeout("timed out")
+
+    monkeypatch.setattr(worker_pool.requests, "post", post)
+
+    acquired = []
+    with pytest.raises(requests.ReadTimeout):
+        pool.post("/sdapi/v1/txt2img", {}, on_acquire=acquired.append)
+
+    assert acquired == [worker]
+    assert not worker.busy
+    assert pool.acquire() is worker
+
+
+def test_request_retried_on_another_worker(monkeypatch):
+    pool = make_pool(["0", "1"])
+    first, second = pool.workers
+
+    def post(url, **kwargs):
+        if url.startswith(first.url):
+            raise requests.ConnectionError(urllib3.exceptions.MaxRetryError(None, url, urllib3.exceptions.NewConnectionError(None, "refused")))
+
+        return types.SimpleNamespace(status_code=200)
+
+    monkeypatch.setattr(worker_pool.requests, "post", post)
+
+    worker, response = pool.post("/sdapi/v1/txt2img", {})
+
+    assert worker is second
+    assert second.busy
+    assert not first.ready
+
+    pool.release(worker)
+    assert not second.busy
+    assert second.tasks_done == 1
+
+
+def test_request_not_retried_after_sending(monkeypatch):
+    pool = make_pool(["0", "1"])
+    first, second = pool.workers
+
+    calls = []
+
+    def post(url, **kwargs):
+        calls.append(url)
+        raise requests.ConnectionError(urllib3.exceptions.ProtocolError("Connection aborted.", ConnectionResetError()))
+
+    monkeypatch.setattr(worker_pool.requests, "post", post)
+
+    # the worker may have started generating before the connection broke, so the request must not run again elsewhere
+    with pytest.raises(requests.ConnectionError):
+        pool.post("/sdapi/v1/txt2img", {})
+
+    assert calls == [f"{first.url}/sdapi/v1/txt2img"]
+    assert first.ready
+    assert not first.busy
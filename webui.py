@@ -18,6 +18,9 @@ initialize.check_versions()
 def create_api(app):
     from modules.api.api import Api
     from modules.call_queue import queue_lock
+    from modules import worker_pool
+
+    worker_pool.start()
 
     api = Api(app, queue_lock)
     return api